@@ -0,0 +1,98 @@
+# cython: language_level=3
+"""
+Compiled version of mustache.sctools.make_clip_profile. Both must return the same values for the same read; sctools
+falls back to its pure-Python version when this extension is not built.
+"""
+
+cdef enum:
+    CLIP_NONE = 0
+    CLIP_SOFTCLIP = 1
+    CLIP_MISMATCH = 2
+
+
+cdef inline bint is_md_digit(Py_UCS4 c):
+    return c >= u'0' and c <= u'9'
+
+
+cdef bint md_starts_with_mismatch(str md):
+    cdef Py_ssize_t n = len(md)
+    return n > 1 and md[0] == u'0' and not is_md_digit(md[1]) and md[1] != u'^'
+
+
+cdef bint md_ends_with_mismatch(str md):
+    cdef Py_ssize_t n = len(md)
+    cdef Py_ssize_t i = n - 2
+
+    if n == 0 or md[n - 1] != u'0':
+        return False
+
+    while i >= 0 and not is_md_digit(md[i]) and md[i] != u'^':
+        i -= 1
+
+    return i < n - 2 and (i < 0 or md[i] != u'^')
+
+
+def make_clip_profile(list cigartuples, str md, long reference_start, str query_sequence):
+
+    cdef long query_length = 0
+    cdef long ref_pos = reference_start
+    cdef long aligned_length = 0
+    cdef long softclipped_length = 0
+    cdef long first_aligned_query = -1, first_aligned_ref = -1
+    cdef long last_aligned_query = -1, last_aligned_ref = -1
+    cdef long alignment_length
+    cdef int op, left_op, right_op
+    cdef long length, left_cigar_length, right_cigar_length
+    cdef int left_clip_type = CLIP_NONE, right_clip_type = CLIP_NONE
+    cdef long left_clip_length = 0, right_clip_length = 0
+    cdef Py_ssize_t n_md = len(md)
+    cdef Py_ssize_t n_query = len(query_sequence)
+    cdef double perc_identity
+
+    for op, length in cigartuples:
+        if op == 0 or op == 7 or op == 8:
+            if first_aligned_ref < 0:
+                first_aligned_query = query_length
+                first_aligned_ref = ref_pos
+            query_length += length
+            ref_pos += length
+            aligned_length += length
+            last_aligned_query = query_length - 1
+            last_aligned_ref = ref_pos - 1
+        elif op == 1:
+            query_length += length
+        elif op == 4:
+            query_length += length
+            softclipped_length += length
+        elif op == 2 or op == 3:
+            ref_pos += length
+
+    left_op, left_cigar_length = cigartuples[0]
+    right_op, right_cigar_length = cigartuples[-1]
+
+    left_site = None
+    if left_op == 4:
+        left_clip_type, left_clip_length = CLIP_SOFTCLIP, left_cigar_length
+        left_site = first_aligned_ref - 1
+    else:
+        if n_md > 0 and md[0] == u'0':
+            left_clip_type, left_clip_length = CLIP_MISMATCH, 1
+        if md_starts_with_mismatch(md) or (n_query > 0 and query_sequence[0] != query_sequence[first_aligned_query]):
+            left_site = first_aligned_ref
+
+    right_site = None
+    if right_op == 4:
+        right_clip_type, right_clip_length = CLIP_SOFTCLIP, right_cigar_length
+        right_site = last_aligned_ref + 1
+    else:
+        if n_md > 1 and md[n_md - 1] == u'0' and not is_md_digit(md[n_md - 2]):
+            right_clip_type, right_clip_length = CLIP_MISMATCH, 1
+        if md_ends_with_mismatch(md) or (n_query > 0 and query_sequence[n_query - 1] != query_sequence[last_aligned_query]):
+            right_site = last_aligned_ref
+
+    alignment_length = query_length - softclipped_length
+    perc_identity = <double> aligned_length / alignment_length if alignment_length > 0 else 0.0
+
+    return (left_clip_type, left_clip_length, left_site,
+            right_clip_type, right_clip_length, right_site,
+            query_length - left_clip_length - right_clip_length, perc_identity)
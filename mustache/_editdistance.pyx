@@ -0,0 +1,78 @@
+# cython: language_level=3
+"""
+Compiled version of mustache.misc.bounded_levenshtein_distance. misc falls back to a full jellyfish distance when this
+extension is not built.
+"""
+
+from libc.stdlib cimport malloc, free
+
+
+def bounded_levenshtein_distance(str seq1, str seq2, long max_dist):
+    """
+    Returns the Levenshtein distance between seq1 and seq2 if it is at most max_dist, and max_dist + 1 otherwise.
+    Only cells within max_dist of the diagonal are filled, and the scan stops once a whole row exceeds max_dist.
+    """
+
+    cdef Py_ssize_t n1 = len(seq1), n2 = len(seq2)
+    cdef Py_ssize_t i, j, lo, hi
+    cdef long too_far = max_dist + 1
+    cdef long value, row_min, result
+    cdef long *prev
+    cdef long *curr
+    cdef long *swap
+    cdef Py_UCS4 char1
+
+    if max_dist < 0:
+        return 0 if seq1 == seq2 else too_far
+    if abs(n1 - n2) > max_dist:
+        return too_far
+    if n1 == 0 or n2 == 0:
+        return n1 + n2
+
+    prev = <long *> malloc((n2 + 1) * sizeof(long))
+    curr = <long *> malloc((n2 + 1) * sizeof(long))
+    if prev == NULL or curr == NULL:
+        free(prev)
+        free(curr)
+        raise MemoryError()
+
+    try:
+        for j in range(n2 + 1):
+            prev[j] = j if j <= max_dist else too_far
+
+        for i in range(1, n1 + 1):
+            lo = i - max_dist if i - max_dist > 1 else 1
+            hi = i + max_dist if i + max_dist < n2 else n2
+
+            curr[lo - 1] = i if lo == 1 and i <= max_dist else too_far
+            row_min = curr[lo - 1]
+            char1 = seq1[i - 1]
+
+            for j in range(lo, hi + 1):
+                value = prev[j - 1] + (char1 != seq2[j - 1])
+                if prev[j] + 1 < value:
+                    value = prev[j] + 1
+                if curr[j - 1] + 1 < value:
+                    value = curr[j - 1] + 1
+                if value > too_far:
+                    value = too_far
+                curr[j] = value
+                if value < row_min:
+                    row_min = value
+
+            if hi < n2:
+                curr[hi + 1] = too_far
+
+            if row_min > max_dist:
+                return too_far
+
+            swap = prev
+            prev = curr
+            curr = swap
+
+        result = prev[n2]
+        return result if result < too_far else too_far
+
+    finally:
+        free(prev)
+        free(curr)
@@ -1,14 +1,17 @@
 import sys
 from glob import glob
-from snakemake import shell
+import shlex
 from os.path import isfile
+import click
+from mustache import processtools
 
 def index_genome(genome_path, silence=True):
 
-    if silence:
-        shell('makeblastdb -dbtype nucl -in {genome_path} &> /dev/null;'.format(genome_path=genome_path))
-    else:
-        shell('makeblastdb -dbtype nucl -in {genome_path}'.format(genome_path=genome_path))
+    command = ['makeblastdb', '-dbtype', 'nucl', '-in', genome_path]
+    if not silence:
+        click.echo("Executing command: %s" % ' '.join(command))
+
+    processtools.run_command(command)
 
     return genome_is_indexed(genome_path)
 
@@ -32,10 +35,9 @@ def genome_is_indexed(genome_path):
 
 def align_fasta_to_genome(fasta, genome_path, outfile, threads=1, silence=True, additional_flags=''):
 
-    shell('blastn -query {fasta} -db {genome_path} -outfmt 5 -max_target_seqs 100000 -out {outfile} -parse_deflines '
-          '{additional_flags}'.format(
-        fasta=fasta, genome_path=genome_path, outfile=outfile, additional_flags=additional_flags
-    ))
+    command = ['blastn', '-query', fasta, '-db', genome_path, '-outfmt', '5', '-max_target_seqs', '100000',
+               '-out', outfile, '-parse_deflines'] + shlex.split(additional_flags)
+    processtools.run_command(command)
 
     if isfile(outfile):
         return True
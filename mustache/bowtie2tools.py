@@ -1,13 +1,17 @@
-from snakemake import shell
+import shlex
 from glob import glob
 from os.path import isfile
 import click
+from mustache import processtools
 
 def index_genome(genome_path, silence=True):
     if silence:
-        shell('bowtie2-build -o 0 -q {genome_path} {genome_path} 2> /dev/null;'.format(genome_path=genome_path))
+        command = ['bowtie2-build', '-o', '0', '-q', genome_path, genome_path]
     else:
-        shell('bowtie2-build -o 0 {genome_path} {genome_path}'.format(genome_path=genome_path))
+        command = ['bowtie2-build', '-o', '0', genome_path, genome_path]
+        click.echo("Executing command: %s" % ' '.join(command))
+
+    processtools.run_command(command)
 
     return genome_is_indexed(genome_path)
 
@@ -34,64 +38,38 @@ def genome_is_indexed(genome_path):
 
 def align_fasta_to_genome(fasta, genome_path, out_bam, threads=1, silence=True, additional_flags=''):
 
-    if silence:
-        command = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bowtie2 {additional_flags} --local -x {genome_path} -p {threads} -f -U {fasta} -S {out_bam}.sam 2> /dev/null; " \
-                  "samtools view -h -q 1 {out_bam}.sam 2> /dev/null 1> {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp 2> /dev/null 1> {out_bam}; " \
-                  "samtools index {out_bam} 2> /dev/null;" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta=fasta, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
-
-    else:
-        command = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bowtie2 {additional_flags} --local -x {genome_path} -p {threads} -f -U {fasta} -S {out_bam}.sam; " \
-                  "samtools view -h -q 1 {out_bam}.sam > {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp > {out_bam}; " \
-                  "samtools index {out_bam};" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta=fasta, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
-
+    bowtie2_command = ['bowtie2'] + shlex.split(additional_flags) + \
+                      ['--local', '-x', genome_path, '-p', str(threads), '-f', '-U', fasta]
 
-
-    if not silence:
-        click.echo("Executing command: %s" % command)
-
-    shell(command, read=silence)
-
-    if isfile(out_bam):
-        return True
-    else:
-        return False
+    return align_and_sort(bowtie2_command, out_bam, silence)
 
 def align_paired_fasta_to_genome(fasta1, fasta2, genome_path, out_bam, threads=1, silence=False, additional_flags=''):
 
-    if silence:
-        command = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bowtie2 {additional_flags} --local -x {genome_path} -p {threads} -f -1 {fasta1} -2 {fasta2} -S {out_bam}.sam &> /dev/null; " \
-                  "samtools view -h -q 1 {out_bam}.sam 2> /dev/null 1> {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp 2> /dev/null 1> {out_bam}; " \
-                  "samtools index {out_bam} 2> /dev/null;" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta1=fasta1, fasta2=fasta2, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
+    bowtie2_command = ['bowtie2'] + shlex.split(additional_flags) + \
+                      ['--local', '-x', genome_path, '-p', str(threads), '-f', '-1', fasta1, '-2', fasta2]
 
-    else:
-        command = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bowtie2 {additional_flags} --local -x {genome_path} -p {threads} -f -1 {fasta1} -2 {fasta2} -S {out_bam}.sam; " \
-                  "samtools view -h -q 1 {out_bam}.sam > {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp > {out_bam}; " \
-                  "samtools index {out_bam};" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta1=fasta1, fasta2=fasta2, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
+    return align_and_sort(bowtie2_command, out_bam, silence)
 
 
+def align_and_sort(bowtie2_command, out_bam, silence=True):
+    """
+    Streams the SAM output of bowtie2 through samtools view and samtools sort into a sorted, indexed out_bam, keeping
+    the alignments with a mapping quality of at least 1. Nothing is written between the steps.
+    """
+
+    commands = [
+        bowtie2_command,
+        ['samtools', 'view', '-h', '-q', '1', '-'],
+        ['samtools', 'sort', '-O', 'bam', '-o', out_bam, '-']
+    ]
 
     if not silence:
-        click.echo("Executing command: %s" % command)
+        click.echo("Executing command: %s" % ' | '.join(' '.join(command) for command in commands))
 
-    shell(command, read=silence)
+    processtools.run_pipeline(commands)
+    processtools.run_command(['samtools', 'index', out_bam])
 
     if isfile(out_bam):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
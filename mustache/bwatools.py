@@ -2,20 +2,20 @@ import warnings
 warnings.filterwarnings("ignore")
 import sys
 from glob import glob
-from snakemake import shell
+import shlex
 import pygogo as gogo
 from os.path import isfile
 import pysam
-from mustache import misc
+from mustache import misc, processtools
 
 verbose=False
 logger = gogo.Gogo(__name__, verbose=verbose).logger
 
 def index_genome(genome_path, silence=True):
-    if silence:
-        shell('bwa index {genome_path} &> /dev/null;'.format(genome_path=genome_path))
-    else:
-        shell('bwa index {genome_path}'.format(genome_path=genome_path))
+    command = ['bwa', 'index', genome_path]
+    if not silence:
+        logger.info("Executing command: %s" % ' '.join(command))
+    processtools.run_command(command)
 
     return genome_is_indexed(genome_path)
 
@@ -38,31 +38,21 @@ def genome_is_indexed(genome_path):
     return indexed
 
 def align_to_genome_pe(fastq1, fastq2, genome_path, out_sam, threads=1, verbose=False):
-    if verbose:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} {fastq2} > {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fastq1, fastq2=fastq2, out_sam=out_sam, threads=threads)
-    else:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} {fastq2} 2> /dev/null 1> {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fastq1, fastq2=fastq2, out_sam=out_sam, threads=threads)
+    command = ['bwa', 'mem', '-t', str(threads), genome_path, fastq1, fastq2]
 
-    logger.debug("Executing command: %s" % command)
-    shell(command)
+    logger.debug("Executing command: %s" % ' '.join(command))
+    processtools.run_command(command, stdout=out_sam)
 
     if isfile(out_sam):
         return True
     else:
         return False
 
-def align_to_genome_se(fastq1, genome_path, out_sam, threads=1, verbose=False):
-    if verbose:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} > {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fastq1, out_sam=out_sam, threads=threads)
-    else:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} 2> /dev/null 1> {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fastq1, out_sam=out_sam, threads=threads)
+def align_to_genome_se(fastq1, genome_path, out_sam, threads=1, verbose=False, additional_flags=''):
+    command = ['bwa', 'mem'] + shlex.split(additional_flags) + ['-t', str(threads), genome_path, fastq1]
 
-    logger.debug("Executing command: %s" % command)
-    shell(command)
+    logger.debug("Executing command: %s" % ' '.join(command))
+    processtools.run_command(command, stdout=out_sam)
 
     if isfile(out_sam):
         return True
@@ -70,17 +60,10 @@ def align_to_genome_se(fastq1, genome_path, out_sam, threads=1, verbose=False):
         return False
 
 def align_to_genome_fasta_pe(fasta1, fasta2, genome_path, out_sam, threads=1, verbose=False, additional_flags=''):
-    if verbose:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} {fastq2} {additional_flags} > {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fasta1, fastq2=fasta2, out_sam=out_sam, threads=threads,
-            additional_flags=additional_flags)
-    else:
-        command = "bwa mem -t {threads} {genome_path} {fastq1} {fastq2} {additional_flags} 2> /dev/null 1> {out_sam}; ".format(
-            genome_path=genome_path, fastq1=fasta1, fastq2=fasta2, out_sam=out_sam, threads=threads,
-            additional_flags=additional_flags)
+    command = ['bwa', 'mem', '-t', str(threads), genome_path, fasta1, fasta2] + shlex.split(additional_flags)
 
-    logger.debug("Executing command: %s" % command)
-    shell(command)
+    logger.debug("Executing command: %s" % ' '.join(command))
+    processtools.run_command(command, stdout=out_sam)
 
     if isfile(out_sam):
         return True
@@ -89,30 +72,25 @@ def align_to_genome_fasta_pe(fasta1, fasta2, genome_path, out_sam, threads=1, ve
 
 
 def align_fasta_to_genome(fasta, genome_path, out_bam, threads=1, silence=True, additional_flags=''):
+    """
+    Aligns fasta with bwa mem, fills in the sequence of secondary alignments, and writes the mapped alignments to a
+    sorted, indexed out_bam. samtools view streams straight into samtools sort.
+    """
 
-    if silence:
-        command1 = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bwa mem {additional_flags} -t {threads} {genome_path} {fasta} 2> /dev/null 1> {out_bam}.sam;"
-        command2 = "samtools view -h -F 4 {out_bam}.sam.secseq 2> /dev/null 1> {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp 2> /dev/null 1> {out_bam}; " \
-                  "samtools index {out_bam} 2> /dev/null;" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.secseq {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta=fasta, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
+    out_sam, secseq_sam = out_bam + '.sam', out_bam + '.sam.secseq'
 
-    else:
-        command1 = "rm -f {out_bam}.sam {out_bam}.sam.tmp; " \
-                  "bwa mem {additional_flags} -t {threads} {genome_path} {fasta} 1> {out_sam}.sam;"
-        command2 = "samtools view -h -F 4 {out_bam}.sam.secseq 1> {out_bam}.sam.tmp; " \
-                  "samtools sort {out_bam}.sam.tmp 1> {out_bam}; " \
-                  "samtools index {out_bam};" \
-                  "rm -f {out_bam}.sam {out_bam}.sam.secseq {out_bam}.sam.tmp".format(
-            genome_path=genome_path, fasta=fasta, out_bam=out_bam, threads=threads, additional_flags=additional_flags)
-
-    #print(command)
-    shell(command1)
-    add_sequence_to_secondary_alignment('{out_bam}.sam'.format(out_bam=out_bam),
-                                        '{out_bam}.sam.secseq'.format(out_bam=out_bam))
-    shell(command2)
+    command = ['bwa', 'mem'] + shlex.split(additional_flags) + ['-t', str(threads), genome_path, fasta]
+    logger.debug("Executing command: %s" % ' '.join(command))
+    processtools.run_command(command, stdout=out_sam)
+
+    add_sequence_to_secondary_alignment(out_sam, secseq_sam)
+
+    processtools.run_pipeline([
+        ['samtools', 'view', '-h', '-F', '4', secseq_sam],
+        ['samtools', 'sort', '-O', 'bam', '-o', out_bam, '-']
+    ])
+    processtools.run_command(['samtools', 'index', out_bam])
+    processtools.remove_files(out_sam, secseq_sam)
 
     if isfile(out_bam):
         return True
@@ -1,17 +1,15 @@
 import warnings
 warnings.filterwarnings("ignore")
 import sys
-from snakemake import shell
+from mustache import processtools
 from mustache.fastatools import read_fasta
 from pandas import Series
 
-def run_einverted(fasta, gap=12, threshold=15, match=3, mismatch=-4, outfile='einverted.tmp.out', outseq='einverted.tmp.outseq'):
-    command = 'einverted -sequence {fasta} -gap {gap} -threshold {threshold} -match {match} ' \
-              '-mismatch {mismatch} -outfile {outfile} -outseq {outseq} -auto Y -warning N'.format(
-        fasta=fasta, gap=gap, threshold=threshold, match=match, mismatch=mismatch, outfile=outfile, outseq=outseq
-    )
-    #print(command)
-    shell(command)
+def run_einverted(fasta, gap=12, threshold=15, match=3, mismatch=-4, outfile='einverted.tmp.out', outseq='einverted.tmp.outseq',
+                  timeout=None):
+    command = ['einverted', '-sequence', fasta, '-gap', str(gap), '-threshold', str(threshold), '-match', str(match),
+               '-mismatch', str(mismatch), '-outfile', outfile, '-outseq', outseq, '-auto', 'Y', '-warning', 'N']
+    processtools.run_command(command, timeout=timeout)
 
 
 def read_emboss_seq_results(outseq_path):
@@ -1,32 +1,69 @@
 import warnings
 warnings.filterwarnings("ignore")
 import sys
+import time
 import click
 import pysam
 import pygogo as gogo
 import pandas as pd
 import numpy as np
-from snakemake import shell
 from random import randint
-from mustache import fastatools, embosstools, sctools, pysamtools, minimustools
+from mustache import fastatools, embosstools, sctools, pysamtools, minimustools, flankassembler, processtools
 from mustache.misc import revcomp
 from os.path import basename
 from multiprocessing import Pool
-from os.path import join, dirname
+from os import rmdir
+from os.path import join, dirname, isdir
 
 verbose=True
 logger = gogo.Gogo(__name__, verbose=verbose).logger
 
-def extend(row):
-    bam = pysam.AlignmentFile(row['bam_path'], 'rb')
-    contig, pos_5p, pos_3p, seq_5p, seq_3p = row['contig'], row['pos_5p'], row['pos_3p'], row['seq_5p'], row['seq_3p']
-    tmp_outdir = row['outdir']
+def extend(pair):
+    contig, pos_5p, pos_3p, seq_5p, seq_3p = pair['contig'], pair['pos_5p'], pair['pos_3p'], pair['seq_5p'], pair['seq_3p']
 
     logger.info("Attempting to extend flank sequences at %s..." % ' '.join(map(str, [contig, pos_3p, pos_5p])))
 
-    extended_seq_5p = get_extended_sequence(bam, contig, pos_5p, seq_5p, 'R', tmp_outdir)
-    extended_seq_3p = get_extended_sequence(bam, contig, pos_3p, seq_3p, 'L', tmp_outdir)
+    extended_seq_5p = get_extended_sequence(contig, pos_5p, seq_5p, 'R', pair['reads_5p'], pair['quals_5p'],
+                                            pair['outdir'], pair['assembler'])
+    extended_seq_3p = get_extended_sequence(contig, pos_3p, seq_3p, 'L', pair['reads_3p'], pair['quals_3p'],
+                                            pair['outdir'], pair['assembler'])
+    report_extensions(contig, pos_5p, pos_3p, seq_5p, seq_3p, extended_seq_5p, extended_seq_3p)
 
+    return pair['index'], extended_seq_5p, extended_seq_3p
+
+
+def extend_batch(pairs):
+    """
+    Extends a batch of pairs. With the minimus assembler, the reads of all of their flanks are assembled together in
+    one AMOS run; otherwise, the pairs are extended one by one.
+    """
+
+    if len(pairs) == 1 or pairs[0]['assembler'] != 'minimus':
+        return [extend(pair) for pair in pairs]
+
+    flank_reads, flank_quals, seeds = {}, {}, {}
+    for pair in pairs:
+        logger.info("Attempting to extend flank sequences at %s..." % ' '.join(
+            map(str, [pair['contig'], pair['pos_3p'], pair['pos_5p']])))
+        for flank_id, orient, side in (('%dR' % pair['index'], 'R', '5p'), ('%dL' % pair['index'], 'L', '3p')):
+            if len(pair['reads_' + side]) > 0:
+                flank_reads[flank_id], flank_quals[flank_id] = pair['reads_' + side], pair['quals_' + side]
+                seeds[flank_id] = (pair['seq_' + side].upper(), orient)
+
+    extensions = get_batch_extended_sequences(flank_reads, flank_quals, seeds, pairs[0]['outdir'])
+
+    results = []
+    for pair in pairs:
+        extended_seq_5p = extensions.get('%dR' % pair['index'], pair['seq_5p'].upper())
+        extended_seq_3p = extensions.get('%dL' % pair['index'], pair['seq_3p'].upper())
+        report_extensions(pair['contig'], pair['pos_5p'], pair['pos_3p'], pair['seq_5p'], pair['seq_3p'],
+                          extended_seq_5p, extended_seq_3p)
+        results.append((pair['index'], extended_seq_5p, extended_seq_3p))
+
+    return results
+
+
+def report_extensions(contig, pos_5p, pos_3p, seq_5p, seq_3p, extended_seq_5p, extended_seq_3p):
     if extended_seq_5p != seq_5p:
         logger.info("5' sequence at %s extended successfully by %d base pairs" % (
             ':'.join(map(str, [contig, pos_5p])), len(extended_seq_5p) - len(seq_5p)))
@@ -34,28 +71,29 @@ def extend(row):
         logger.info("3' sequence at %s extended successfully by %d base pairs" % (
             ':'.join(map(str, [contig, pos_3p])), len(extended_seq_3p) - len(seq_3p)))
 
-    return extended_seq_5p, extended_seq_3p
 
-def get_extended_sequence(bam, contig, pos, seq, orient, tmp_outdir):
+def get_extended_sequence(contig, pos, seq, orient, reads, quals, tmp_outdir, assembler='minimus'):
     seq = seq.upper()
-    reads, quals = get_reads_to_assemble(bam, contig, pos, orient, get_quals=True)
 
     if len(reads) == 0:
         return seq
 
-    # print("RUNNING ASSEMBLY")
-    assembler = minimustools.MinimusAssembler(reads, quals, outdir=tmp_outdir)
-    assembler.assemble()
+    if assembler == 'native':
+        return flankassembler.FlankAssembler(reads, quals).extend_seed(seq, orient)
 
-    # print("CHECKING IF SOMETHING ASSEMBLED")
-    if not assembler.something_assembled():
-        assembler.delete_files()
-        return seq
-
-    # print("ALIGNING TO ASSEMBLY")
-    assembler.align_seq_to_assembly(seq)
-    # print("RETRIEVING EXTENDED SEQUENCE")
-    extended_seq = assembler.retrieve_extended_sequence(orient)
+    assembler = minimustools.MinimusAssembler(reads, quals, outdir=tmp_outdir)
+    try:
+        assembler.assemble()
+
+        if not assembler.something_assembled():
+            assembler.delete_files()
+            return seq
+
+        assembler.align_seq_to_assembly(seq)
+        extended_seq = assembler.retrieve_extended_sequence(orient)
+    except processtools.ExternalToolError as error:
+        logger.info("Could not assemble the reads at %s: %s" % (':'.join(map(str, [contig, pos])), error))
+        extended_seq = None
     assembler.delete_files()
 
     if extended_seq is None:
@@ -64,33 +102,49 @@ def get_extended_sequence(bam, contig, pos, seq, orient, tmp_outdir):
     return extended_seq.upper()
 
 
-def get_reads_to_assemble(bam, contig, pos, orient, get_quals=False):
+def get_batch_extended_sequences(flank_reads, flank_quals, seeds, tmp_outdir):
+    """Returns {flank id: extended sequence} for the seeds that were extended by a batched minimus assembly."""
 
-    if get_quals:
+    if len(flank_reads) == 0:
+        return {}
 
-        if orient == 'R':
-            softclipped_reads, softclipped_quals = pysamtools.get_right_softclipped_reads_at_site(bam, contig, pos, get_quals=True)
-            unmapped_reads, unmapped_quals = pysamtools.get_right_unmapped_reads(bam, contig, pos, get_quals=True)
-        elif orient == 'L':
-            softclipped_reads, softclipped_quals = pysamtools.get_left_softclipped_reads_at_site(bam, contig, pos, get_quals=True)
-            unmapped_reads, unmapped_quals = pysamtools.get_left_unmapped_reads(bam, contig, pos, get_quals=True)
+    assembler = minimustools.MinimusBatchAssembler(flank_reads, flank_quals, outdir=tmp_outdir)
+    try:
+        assembler.assemble()
+        extensions = assembler.extend_seeds(seeds)
+    except processtools.ExternalToolError as error:
+        logger.info("Could not assemble the reads of a batch of %d flanks: %s" % (len(flank_reads), error))
+        extensions = {}
+    assembler.delete_files()
 
-    else:
-        if orient == 'R':
-            softclipped_reads = pysamtools.get_right_softclipped_reads_at_site(bam, contig, pos, get_quals=True)
-            unmapped_reads = pysamtools.get_right_unmapped_reads(bam, contig, pos, get_quals=True)
-        elif orient == 'L':
-            softclipped_reads = pysamtools.get_left_softclipped_reads_at_site(bam, contig, pos, get_quals=True)
-            unmapped_reads = pysamtools.get_left_unmapped_reads(bam, contig, pos, get_quals=True)
+    return {flank_id: extensions[flank_id].upper() for flank_id in extensions if extensions[flank_id] is not None}
 
 
-    if get_quals:
-        return softclipped_reads + unmapped_reads, softclipped_quals + unmapped_quals
-    else:
-        return softclipped_reads + unmapped_reads
+def get_reads_to_assemble(bamfile, pairs):
+    """
+    Gathers the reads to assemble at the 5' and 3' sites of every pair in one sweep over the bam: the reads softclipped
+    at the site, followed by the unmapped mates of the reads near it. Returns (5' reads, 5' qualities, 3' reads,
+    3' qualities) for each pair.
+    """
 
+    sites = []
+    for contig, pos_5p, pos_3p in zip(pairs['contig'], pairs['pos_5p'], pairs['pos_3p']):
+        sites += [(contig, pos_5p, 'R'), (contig, pos_3p, 'L')]
 
-def _extendpairs(pairsfile, bamfile, threads, output_file):
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        site_reads = pysamtools.get_reads_to_assemble_at_sites(bam, sites)
+
+    pair_reads = []
+    for i in range(0, len(site_reads), 2):
+        reads = []
+        for softclipped_reads, softclipped_quals, unmapped_reads, unmapped_quals in site_reads[i:i + 2]:
+            reads += [softclipped_reads + unmapped_reads, softclipped_quals + unmapped_quals]
+        pair_reads.append(tuple(reads))
+
+    return pair_reads
+
+
+def _extendpairs(pairsfile, bamfile, threads, output_file, assembler='minimus', batch_size=1):
     pairs = pd.read_csv(pairsfile, sep='\t')
 
     if pairs.shape[0] == 0:
@@ -102,16 +156,41 @@ def _extendpairs(pairsfile, bamfile, threads, output_file):
 
         logger.info("Running extendpairs algorithm on %d total pairs..." % pairs.shape[0])
 
-        pair_rows = [row for index, row in pairs.iterrows()]
         tmp_outdir = join(dirname(output_file), 'tmp.mustache.minimus.' + str(randint(1, 1e20)))
-        for row in pair_rows:
-            row['bam_path'] = bamfile
-            row['outdir'] = tmp_outdir
-
-        agents = threads
-        with Pool(processes=agents) as pool:
-            extensions = np.array(pool.map(extend, pair_rows))
-        shell("rmdir %s" % tmp_outdir)
+
+        logger.info("Gathering the reads at each site...")
+        pair_args = []
+        for index, (contig, pos_5p, pos_3p, seq_5p, seq_3p, (reads_5p, quals_5p, reads_3p, quals_3p)) in enumerate(
+                zip(pairs['contig'], pairs['pos_5p'], pairs['pos_3p'], sequences_5p, sequences_3p,
+                    get_reads_to_assemble(bamfile, pairs))):
+            pair_args.append({'index': index, 'contig': contig, 'pos_5p': pos_5p, 'pos_3p': pos_3p,
+                              'seq_5p': seq_5p, 'seq_3p': seq_3p, 'reads_5p': reads_5p, 'quals_5p': quals_5p,
+                              'reads_3p': reads_3p, 'quals_3p': quals_3p, 'outdir': tmp_outdir,
+                              'assembler': assembler})
+
+        # The pairs with the most reads are extended first, so that one of them does not hold up the end of the run.
+        pair_args.sort(key=lambda pair: -(len(pair['reads_5p']) + len(pair['reads_3p'])))
+
+        if assembler != 'minimus':
+            batch_size = 1
+        batches = [pair_args[i:i + batch_size] for i in range(0, len(pair_args), batch_size)]
+
+        extensions = [None] * len(pair_args)
+        report_every = max(len(pair_args) // 20, 1)
+        n_done, n_reported = 0, 0
+        start_time = time.time()
+        with Pool(processes=threads) as pool:
+            for batch_extensions in pool.imap_unordered(extend_batch, batches):
+                for index, extended_seq_5p, extended_seq_3p in batch_extensions:
+                    extensions[index] = (extended_seq_5p, extended_seq_3p)
+                n_done += len(batch_extensions)
+                if n_done - n_reported >= report_every or n_done == len(pair_args):
+                    n_reported = n_done
+                    elapsed = max(time.time() - start_time, 1e-6)
+                    logger.info("Extended %d of %d pairs (%.2f pairs per second)..." % (
+                        n_done, len(pair_args), n_done / elapsed))
+        if isdir(tmp_outdir):
+            rmdir(tmp_outdir)
 
         extensions_5p = [pair[0] for pair in extensions]
         extensions_3p = [pair[1] for pair in extensions]
@@ -1,26 +1,29 @@
 import sys
-from mustache import pysamtools, sctools, misc, flanktrie
+from mustache import pysamtools, sctools, misc, flanktrie, flankpwm
 import pysam
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from multiprocessing import Pool
+from array import array
+import heapq
 import pandas as pd
-from jellyfish import levenshtein_distance
-import itertools
-from scipy.sparse.csgraph import connected_components
 import numpy as np
 
 import pygogo as gogo
 verbose = True
 logger = gogo.Gogo(__name__, verbose=False).logger
 
+# Evidence files record the read filters applied while parsing the BAM file, as re-running from the evidence can
+# only change the filters applied afterwards.
+EVIDENCE_VERSION = 1
+EVIDENCE_PARSE_PARAMS = ['min_alignment_quality', 'min_alignment_inner_length', 'min_softclip_length']
 
 
 def _findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_quality, min_alignment_inner_length,
-                min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, output_file=None):
+                min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, output_file=None,
+                one_pass=False, threads=1, consensus_engine='trie', evidence_file=None, from_evidence=False,
+                regions=None, exclude=None):
 
-    bam = pysam.AlignmentFile(bamfile, 'rb')
-
-    softclip_parser = SoftclipParser(
-        bam, verbose=True,
+    parser_params = dict(
         min_softclip_length=min_softclip_length,
         min_softclip_count=min_softclip_count,
         min_alignment_quality=min_alignment_quality,
@@ -28,14 +31,66 @@ def _findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_
         min_distance_to_mate=min_distance_to_mate,
         min_softclip_ratio=min_softclip_ratio,
         max_indel_ratio=max_indel_ratio,
-        min_count_consensus=min_count_consensus
+        min_count_consensus=min_count_consensus,
+        consensus_engine=consensus_engine,
+        regions=misc.read_bed_file(regions) if regions else None,
+        exclude=misc.read_bed_file(exclude) if exclude else None
     )
 
-    softclip_parser.parse_softclips()
+    keep_evidence = evidence_file is not None
+
+    if from_evidence:
+        # Here bamfile is an evidence file written by an earlier run, and the BAM file itself is not needed.
+        softclip_parser = SoftclipParser(None, verbose=True, **parser_params)
+        softclip_parser.load_evidence(bamfile)
+        final_df, evidence = run_softclip_parser(softclip_parser, from_evidence=True)
+    elif threads > 1:
+        final_df, evidence = find_flanks_parallel(bamfile, parser_params, one_pass, threads, keep_evidence)
+    else:
+        bam = pysam.AlignmentFile(bamfile, 'rb')
+        softclip_parser = SoftclipParser(bam, verbose=True, **parser_params)
+        final_df, evidence = run_softclip_parser(softclip_parser, one_pass, keep_evidence=keep_evidence)
+
+    if keep_evidence and not from_evidence:
+        logger.info("Saving site evidence to file %s" % evidence_file)
+        bam = pysam.AlignmentFile(bamfile, 'rb')
+        save_evidence(evidence_file, evidence, pysamtools.get_bam_contig_dict(bam), parser_params)
+        bam.close()
+
+    final_df.index.names = ['flank_id']
+    final_df.index = final_df.index + 1
+
+    if output_file:
+        logger.info("Saving results to file %s" % output_file)
+        final_df.to_csv(output_file, sep='\t')
+
+    return final_df
+
+
+def run_softclip_parser(softclip_parser, one_pass=False, region=None, keep_evidence=False, evidence_bounds=None,
+                        from_evidence=False):
+    # evidence_bounds keeps the evidence of sites with start <= pos < end. from_evidence skips parsing the BAM file.
+    evidence = None
+    if not from_evidence:
+        if one_pass:
+            softclip_parser.parse_softclips_one_pass(region)
+        else:
+            softclip_parser.parse_softclips(region)
+
+        if keep_evidence:
+            # The unclipped read information is needed for every site in the evidence, not only the sites that pass
+            # the filters below. Each site is handled on its own, so the results are the same.
+            if not one_pass:
+                softclip_parser.parse_unclipped_read_info()
+            evidence = softclip_parser.get_evidence(evidence_bounds)
+
+    has_unclipped_read_info = one_pass or keep_evidence or from_evidence
+
     softclip_parser.filter_softclips_minlength()
     softclip_parser.filter_softclips_mincount()
     softclip_parser.filter_softclips_mindistance()
-    softclip_parser.parse_unclipped_read_info()
+    if not has_unclipped_read_info:
+        softclip_parser.parse_unclipped_read_info()
     softclip_parser.filter_softclips_count_ratios()
     softclip_parser.filter_softclips_mindistance()
     softclip_parser.make_consensus_sequences()
@@ -44,20 +99,111 @@ def _findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_
 
     softclip_parser.filter_softclips_mindistance()
 
-    final_df = softclip_parser.make_dataframe()
-    final_df.index.names = ['flank_id']
-    final_df.index = final_df.index + 1
+    return softclip_parser.make_dataframe(), evidence
 
-    if output_file:
-        logger.info("Saving results to file %s" % output_file)
-        final_df.to_csv(output_file, sep='\t')
 
-    return final_df
+def find_flanks_parallel(bamfile, parser_params, one_pass, threads, keep_evidence=False, shards_per_thread=4):
+
+    bam = pysam.AlignmentFile(bamfile, 'rb')
+    shards = get_balanced_shards(bam, threads * shards_per_thread)
+    bam.close()
+
+    # The mate-distance filter is applied three times, so a site can depend on sites up to three mate distances away.
+    margin = 3 * (parser_params['min_distance_to_mate'] + 1)
+
+    logger.info("Searching for flanks in %d regions using %d processes..." % (len(shards), threads))
+
+    # Start the most expensive shards first so that a large contig does not hold up the end of the run.
+    shard_order = sorted(range(len(shards)), key=lambda i: shards[i][3], reverse=True)
+    shard_args = [(bamfile, shards[i][0], shards[i][1], shards[i][2], margin, parser_params, one_pass, keep_evidence)
+                  for i in shard_order]
+
+    with Pool(processes=threads) as pool:
+        shard_results = pool.map(find_flanks_in_shard, shard_args, chunksize=1)
+
+    shard_results = [result for i, result in sorted(zip(shard_order, shard_results), key=lambda x: x[0])]
+    final_df = pd.concat([shard_df for shard_df, shard_evidence in shard_results]).reset_index(drop=True)
+
+    evidence = None
+    if keep_evidence:
+        evidence = combine_evidence([shard_evidence for shard_df, shard_evidence in shard_results])
+
+    return final_df, evidence
+
+
+def find_flanks_in_shard(shard_args):
+
+    bamfile, contig, start, end, margin, parser_params, one_pass, keep_evidence = shard_args
+
+    bam = pysam.AlignmentFile(bamfile, 'rb')
+    softclip_parser = SoftclipParser(bam, verbose=False, **parser_params)
+    contig_length = softclip_parser.contig_lengths[contig]
+
+    # Sites can fall just outside of the contig, so the first and last shards keep everything on their side.
+    core_start = start if start > 0 else -sys.maxsize
+    core_end = end if end < contig_length else sys.maxsize
+
+    region = (contig, max(start - margin, 0), min(end + margin, contig_length))
+    shard_df, shard_evidence = run_softclip_parser(softclip_parser, one_pass, region, keep_evidence,
+                                                   evidence_bounds=(core_start, core_end))
+    bam.close()
+
+    return shard_df[(shard_df['pos'] >= core_start) & (shard_df['pos'] < core_end)], shard_evidence
+
+
+def get_balanced_shards(bam, total_shards):
+    # Each shard should hold about the same number of mapped reads, according to the BAM index.
+    contig_lengths = pysamtools.get_bam_contig_dict(bam)
+    try:
+        mapped_reads = {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+    except (AttributeError, ValueError):
+        # pysam before 0.14 has no get_index_statistics, and it needs an index with mapping information.
+        logger.warning("No read counts available from the BAM index, splitting the contigs by length instead.")
+        mapped_reads = dict(contig_lengths)
+    target_reads = max(sum(mapped_reads.values()) / total_shards, 1)
+
+    shards = []
+    for contig in bam.references:
+        contig_reads = mapped_reads.get(contig, 0)
+        if contig_reads == 0:
+            continue
+
+        contig_length = contig_lengths[contig]
+        n_shards = int(min(max(np.ceil(contig_reads / target_reads), 1), contig_length))
+        bounds = np.linspace(0, contig_length, n_shards + 1).astype(int)
+
+        for i in range(n_shards):
+            shards.append((contig, int(bounds[i]), int(bounds[i+1]), contig_reads / n_shards))
+
+    return shards
+
+
+def combine_evidence(evidence_list):
+    if len(evidence_list) == 0:
+        return SoftclipParser(None, verbose=False).get_evidence()
+
+    return OrderedDict((key, np.concatenate([evidence[key] for evidence in evidence_list]))
+                       for key in evidence_list[0])
+
+
+def save_evidence(evidence_file, evidence, contig_lengths, parser_params):
+    arrays = OrderedDict()
+    arrays['evidence_version'] = np.array(EVIDENCE_VERSION)
+    arrays['contig_names'] = np.array(list(contig_lengths.keys()), dtype=str)
+    arrays['contig_lengths'] = np.array(list(contig_lengths.values()), dtype=np.int64)
+    for param in EVIDENCE_PARSE_PARAMS:
+        arrays[param] = np.array(parser_params[param])
+    arrays.update(evidence)
+
+    # Writing to an open file stops NumPy from adding a .npz extension to the file name.
+    with open(evidence_file, 'wb') as outfile:
+        np.savez_compressed(outfile, **arrays)
 
 
 class SoftclipParser:
 
     softclipped_sites = None
+    site_table = None
     bam = None
     contig_lengths = None
     verbose = None
@@ -70,14 +216,20 @@ class SoftclipParser:
     min_softclip_ratio = None
     max_indel_ratio = None
     min_count_consensus = None
+    consensus_engine = None
+
+    target_intervals = None
+    excluded_intervals = None
+    fetch_intervals = None
 
 
     def __init__(self, bam, verbose=True, min_alignment_quality=20, min_alignment_inner_length=21,
                  min_softclip_length=4, min_softclip_count=4, min_distance_to_mate=22,
-                 min_softclip_ratio=0.15, max_indel_ratio=0.03, min_count_consensus=2):
+                 min_softclip_ratio=0.15, max_indel_ratio=0.03, min_count_consensus=2, consensus_engine='trie',
+                 regions=None, exclude=None):
         self.verbose = verbose
         self.bam = bam
-        self.contig_lengths = pysamtools.get_bam_contig_dict(bam)
+        self.contig_lengths = pysamtools.get_bam_contig_dict(bam) if bam is not None else {}
 
         self.softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
         self.min_alignment_quality = min_alignment_quality
@@ -88,15 +240,48 @@ class SoftclipParser:
         self.min_softclip_ratio = min_softclip_ratio
         self.max_indel_ratio = max_indel_ratio
         self.min_count_consensus = min_count_consensus
+        self.consensus_engine = consensus_engine
+
+        self.set_target_intervals(regions, exclude)
+
+
+    def set_target_intervals(self, regions=None, exclude=None):
+        # regions and exclude are lists of (contig, start, end) tuples.
+        self.target_intervals = misc.IntervalIndex(regions) if regions is not None else None
+        self.excluded_intervals = misc.IntervalIndex(exclude) if exclude is not None else None
+
+        if self.bam is None or (regions is None and exclude is None):
+            self.fetch_intervals = None
+            return
+
+        if self.target_intervals is not None:
+            scan_intervals = misc.IntervalIndex(region for region in regions if region[0] in self.contig_lengths)
+        else:
+            scan_intervals = misc.IntervalIndex((contig, 0, length) for contig, length in self.contig_lengths.items())
+        if self.excluded_intervals is not None:
+            scan_intervals = scan_intervals.subtract(self.excluded_intervals)
+
+        # Reads just outside an interval can be clipped at, or run through, a site on its edge.
+        self.fetch_intervals = scan_intervals.pad(1, self.contig_lengths)
+
+        if self.verbose:
+            logger.info("Searching for softclipped sites in %d intervals..." % self.fetch_intervals.count_intervals())
+
+    def is_target_site(self, contig, pos):
+        if self.target_intervals is not None and not self.target_intervals.contains(contig, pos):
+            return False
+        if self.excluded_intervals is not None and self.excluded_intervals.contains(contig, pos):
+            return False
+        return True
 
 
-    def parse_softclips(self):
+    def parse_softclips(self, region=None):
 
         if self.verbose:
             logger.info("Parsing softclipped sites from provided BAM file...")
 
         read_count = 0
-        for read in self.bam:
+        for read in self.get_reads(region):
 
             read_count += 1
 
@@ -104,280 +289,360 @@ class SoftclipParser:
                 logger.info("\tAfter checking %d reads, %d softclipped sites found..." % (read_count, self.count_softclips()))
                 pass
 
-            if not self.passes_read_filters(read):
+            profile = sctools.get_clip_profile(read)
+
+            if not self.passes_read_filters(read, profile):
                 continue
 
-            if sctools.is_right_softclipped_lenient(read):
-                self.parse_right_softclipped_read(read)
+            if sctools.is_right_softclipped_lenient(read, profile):
+                self.parse_right_softclipped_read(read, profile)
 
-            if sctools.is_left_softclipped_lenient(read):
-                self.parse_left_softclipped_read(read)
+            if sctools.is_left_softclipped_lenient(read, profile):
+                self.parse_left_softclipped_read(read, profile)
 
 
-    def filter_softclips_minlength(self):
+    def parse_softclips_one_pass(self, region=None):
+        # Each site is resolved once the scan has moved past every read that could overlap it.
+        if self.verbose:
+            logger.info("Parsing softclipped sites and unclipped read information from provided BAM file in one pass...")
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+        current_contig = None
+        window_reads = deque()
+        pending_sites = []
+        pending_site_set = set()
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
+        read_count = 0
+        for read in self.get_reads(region):
 
-                if not self.softclipped_sites[contig][pos].meets_minlength_5p:
-                    self.softclipped_sites[contig][pos].keep_softclips_5p = False
+            read_count += 1
 
-                if not self.softclipped_sites[contig][pos].meets_minlength_3p:
-                    self.softclipped_sites[contig][pos].keep_softclips_3p = False
+            if self.verbose and read_count % 100000 == 0:
+                logger.info("\tAfter checking %d reads, %d softclipped sites found..." % (read_count, self.count_softclips()))
+                pass
 
-                if self.softclipped_sites[contig][pos].keep_softclips_5p or \
-                    self.softclipped_sites[contig][pos].keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = self.softclipped_sites[contig][pos]
+            if read.reference_name != current_contig:
+                self.resolve_window_sites(current_contig, pending_sites, pending_site_set, window_reads)
+                current_contig = read.reference_name
+                window_reads.clear()
 
-        self.softclipped_sites = filtered_softclipped_sites
+            # Sites more than one base behind the current read start can no longer gain clipped or unclipped reads.
+            self.resolve_window_sites(current_contig, pending_sites, pending_site_set, window_reads,
+                                      max_pos=read.reference_start - 2)
 
-        if verbose:
-            logger.info("After filtering by minimum softclip length of %d, %d sites remain" % (self.min_softclip_length, self.count_softclips()))
-            pass
+            profile = sctools.get_clip_profile(read)
 
+            if not self.passes_read_filters(read, profile):
+                continue
 
-    def filter_softclips_mincount(self):
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+            right_site, left_site = None, None
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+            if sctools.is_right_softclipped_lenient(read, profile):
+                right_site = self.parse_right_softclipped_read(read, profile)
 
-                if softclip_site.get_softclip_5p_count() < self.min_softclip_count:
-                    softclip_site.keep_softclips_5p = False
+            if sctools.is_left_softclipped_lenient(read, profile):
+                left_site = self.parse_left_softclipped_read(read, profile)
 
-                if softclip_site.get_softclip_3p_count() < self.min_softclip_count:
-                    softclip_site.keep_softclips_3p = False
+            # Sites that are not searched are still kept with the read, so it is not counted as unclipped there.
+            for site in (right_site, left_site):
+                if site is not None and site not in pending_site_set and self.is_target_site(current_contig, site):
+                    heapq.heappush(pending_sites, site)
+                    pending_site_set.add(site)
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+            window_reads.append((read.reference_start, read.reference_end, get_read_name_key(read.query_name),
+                                 read.get_blocks(), right_site, left_site))
 
-        self.softclipped_sites = filtered_softclipped_sites
+        self.resolve_window_sites(current_contig, pending_sites, pending_site_set, window_reads)
 
-        if verbose:
-            logger.info("After filtering by minimum softclipped read count of %d, %d sites remain" % (
-                self.min_softclip_count, self.count_softclips()))
-            pass
 
-    def filter_softclips_mindistance(self):
+    def get_reads(self, region=None):
+        if self.fetch_intervals is not None:
+            return self.get_interval_reads(region)
+        if region is None:
+            return self.bam
+        else:
+            contig, start, end = region
+            return self.bam.fetch(contig, start, end)
+
+    def get_interval_reads(self, region=None):
+        # A read overlapping several fetch intervals is only returned by the first of them.
+        for contig in self.contig_lengths:
+            if region is None:
+                intervals = self.fetch_intervals.get_intervals(contig)
+            elif region[0] == contig:
+                intervals = self.fetch_intervals.get_intervals(contig, region[1], region[2])
+            else:
+                continue
 
-        softclip_5p_positions = self.get_softclip_5p_positions()
-        softclip_3p_positions = self.get_softclip_3p_positions()
+            previous_end = None
+            for start, end in intervals:
+                for read in self.bam.fetch(contig, start, end):
+                    if previous_end is not None and read.reference_start < previous_end:
+                        continue
+                    yield read
+                previous_end = end
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+    def resolve_window_sites(self, contig, pending_sites, pending_site_set, window_reads, max_pos=None):
 
-                if softclip_site.get_softclip_5p_count() > 0:
+        while pending_sites and (max_pos is None or pending_sites[0] <= max_pos):
+            pos = heapq.heappop(pending_sites)
+            pending_site_set.remove(pos)
+            self.add_unclipped_read_info_from_window(contig, pos, window_reads)
 
-                    if not self.has_nearby_3p_mate(pos, softclip_3p_positions[contig]):
-                        softclip_site.keep_softclips_5p = False
+        # Future sites start at least one base before the current read, so reads ending before that are done.
+        if max_pos is not None:
+            min_needed_pos = max_pos + 1
+            if pending_sites:
+                min_needed_pos = min(min_needed_pos, pending_sites[0])
+            while window_reads and window_reads[0][1] <= min_needed_pos - 1:
+                window_reads.popleft()
 
-                if softclip_site.get_softclip_3p_count() > 0:
 
-                    if not self.has_nearby_5p_mate(pos, softclip_5p_positions[contig]):
-                        softclip_site.keep_softclips_3p = False
+    def add_unclipped_read_info_from_window(self, contig, pos, window_reads):
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+        softclip_site = self.softclipped_sites[contig][pos]
 
-        self.softclipped_sites = filtered_softclipped_sites
+        start = max(pos - 1, 0)
+        end = min(pos + 2, self.contig_lengths[contig])
 
-        if verbose:
-            logger.info("After filtering by minimum nearest mate distance %d, %d sites remain" % (
-                self.min_distance_to_mate, self.count_softclips()))
-            pass
+        site_positions = [pos]
+        if pos - 1 >= 0:
+            site_positions.append(pos - 1)
+        if pos + 1 < self.contig_lengths[contig]:
+            site_positions.append(pos + 1)
 
+        site_reads = {site_pos: defaultdict(set) for site_pos in site_positions}
 
-    def filter_softclips_count_ratios(self):
+        for read_start, read_end, name_key, blocks, right_site, left_site in window_reads:
+            if read_start >= end:
+                break
+            if read_end <= start:
+                continue
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+            for site_pos in site_positions:
+                if site_pos == right_site or site_pos == left_site:
+                    continue
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+                processed_read = self.process_aligned_blocks_at_site(site_pos, blocks)
+                if processed_read is not None:
+                    site_reads[site_pos][processed_read].add(name_key)
 
-                if softclip_site.keep_softclips_5p:
+        softclip_site.add_runthrough_reads(site_reads[pos]['runthrough'])
+        softclip_site.add_insertion_5p_reads(site_reads[pos]['insertion_5p'])
+        softclip_site.add_insertion_3p_reads(site_reads[pos]['insertion_3p'])
+        softclip_site.add_deletion_reads(site_reads[pos]['deletion'])
 
-                    if softclip_site.get_softclip_ratio_5p() < self.min_softclip_ratio or \
-                        softclip_site.get_indel_ratio_5p() > self.max_indel_ratio:
-                            softclip_site.keep_softclips_5p = False
+        if pos - 1 in site_reads:
+            softclip_site.add_upstream_deletion_reads(site_reads[pos - 1]['deletion'])
 
-                if softclip_site.keep_softclips_3p:
+        if pos + 1 in site_reads:
+            softclip_site.add_downstream_deletion_reads(site_reads[pos + 1]['deletion'])
 
-                    if softclip_site.get_softclip_ratio_3p() < self.min_softclip_ratio or \
-                        softclip_site.get_indel_ratio_3p() > self.max_indel_ratio:
-                        softclip_site.keep_softclips_3p = False
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
+    def get_site_table(self):
+        if self.site_table is None:
+            self.site_table = SoftclipSiteTable(self.softclipped_sites)
+        return self.site_table
 
-                    if softclip_site.get_downstream_deletion_ratio() > self.max_indel_ratio or \
-                       softclip_site.get_upstream_deletion_ratio() > self.max_indel_ratio:
-                        softclip_site.keep_softclips_5p = False
-                        softclip_site.keep_softclips_3p = False
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+    def filter_softclips_minlength(self):
 
-        self.softclipped_sites = filtered_softclipped_sites
+        site_table = self.get_site_table()
 
-        if verbose:
-            logger.info("After filtering by minimum softclip ratio of %f and a "
-                        "maximum indel ratio of %f, %d sites remain" % (
-                self.min_softclip_ratio, self.max_indel_ratio, self.count_softclips()))
+        for contig_sites in site_table.contig_tables():
+            contig_sites.keep_5p &= contig_sites.meets_minlength_5p
+            contig_sites.keep_3p &= contig_sites.meets_minlength_3p
+
+        site_table.remove_unkept_sites()
+
+        if self.verbose:
+            logger.info("After filtering by minimum softclip length of %d, %d sites remain" % (self.min_softclip_length, self.count_softclips()))
             pass
 
-    def filter_consensus_sequences_minlength(self):
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+    def filter_softclips_mincount(self):
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+        site_table = self.get_site_table()
 
+        for contig_sites in site_table.contig_tables():
+            contig_sites.keep_5p &= contig_sites.counts['softclip_count_5p'] >= self.min_softclip_count
+            contig_sites.keep_3p &= contig_sites.counts['softclip_count_3p'] >= self.min_softclip_count
 
-                if softclip_site.keep_softclips_5p:
+        site_table.remove_unkept_sites()
 
-                    consensus_seqs = []
-                    for consensus in softclip_site.consensus_sequences_5p:
+        if self.verbose:
+            logger.info("After filtering by minimum softclipped read count of %d, %d sites remain" % (
+                self.min_softclip_count, self.count_softclips()))
+            pass
 
-                        if len(consensus[1]) >= self.min_softclip_length:
-                            consensus_seqs.append(consensus)
+    def filter_softclips_mindistance(self):
 
-                    softclip_site.consensus_sequences_5p = consensus_seqs
-                    if len(consensus_seqs) == 0:
-                        softclip_site.keep_softclips_5p = False
+        site_table = self.get_site_table()
 
-                if softclip_site.keep_softclips_3p:
+        for contig_sites in site_table.contig_tables():
+            positions = contig_sites.positions
+            has_softclips_5p = contig_sites.counts['softclip_count_5p'] > 0
+            has_softclips_3p = contig_sites.counts['softclip_count_3p'] > 0
 
-                    consensus_seqs = []
-                    for consensus in softclip_site.consensus_sequences_3p:
+            has_3p_mate = self.has_nearby_3p_mates(positions, positions[has_softclips_3p])
+            has_5p_mate = self.has_nearby_5p_mates(positions, positions[has_softclips_5p])
 
-                        if len(consensus[1]) >= self.min_softclip_length:
-                            consensus_seqs.append(consensus)
+            contig_sites.keep_5p &= ~has_softclips_5p | has_3p_mate
+            contig_sites.keep_3p &= ~has_softclips_3p | has_5p_mate
 
-                    softclip_site.consensus_sequences_3p = consensus_seqs
-                    if len(consensus_seqs) == 0:
-                        softclip_site.keep_softclips_3p = False
+        site_table.remove_unkept_sites()
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+        if self.verbose:
+            logger.info("After filtering by minimum nearest mate distance %d, %d sites remain" % (
+                self.min_distance_to_mate, self.count_softclips()))
+            pass
 
 
-        self.softclipped_sites = filtered_softclipped_sites
+    def filter_softclips_count_ratios(self):
 
-        if verbose:
-            logger.info("After filtering consensus sequences by a minimum length of %d, %d flank sequences remain" % (
-                            self.min_softclip_count, self.count_consensus_seqs())
-                        )
+        site_table = self.get_site_table()
 
-    def filter_consensus_sequences_mincount(self):
+        for contig_sites in site_table.contig_tables():
+            counts = contig_sites.counts
+            total_count = contig_sites.get_total_counts()
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                softclip_ratio_5p = counts['softclip_count_5p'] / total_count
+                softclip_ratio_3p = counts['softclip_count_3p'] / total_count
+                indel_ratio_5p = (counts['small_insertion_count_5p'] + counts['deletion_count']) / total_count
+                indel_ratio_3p = (counts['small_insertion_count_3p'] + counts['deletion_count']) / total_count
+                upstream_deletion_ratio = counts['upstream_deletion_count'] / total_count
+                downstream_deletion_ratio = counts['downstream_deletion_count'] / total_count
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+            contig_sites.keep_5p &= ~((softclip_ratio_5p < self.min_softclip_ratio) |
+                                      (indel_ratio_5p > self.max_indel_ratio))
+            contig_sites.keep_3p &= ~((softclip_ratio_3p < self.min_softclip_ratio) |
+                                      (indel_ratio_3p > self.max_indel_ratio))
 
-                if softclip_site.keep_softclips_5p:
+            nearby_deletions = (downstream_deletion_ratio > self.max_indel_ratio) | \
+                               (upstream_deletion_ratio > self.max_indel_ratio)
+            contig_sites.keep_5p &= ~nearby_deletions
+            contig_sites.keep_3p &= ~nearby_deletions
 
-                    consensus_seqs = []
-                    for consensus in softclip_site.consensus_sequences_5p:
+        site_table.remove_unkept_sites()
 
-                        if consensus[0] >= self.min_softclip_count:
-                            consensus_seqs.append(consensus)
-                    softclip_site.consensus_sequences_5p = consensus_seqs
-                    if len(consensus_seqs) == 0:
-                        softclip_site.keep_softclips_5p = False
+        if self.verbose:
+            logger.info("After filtering by minimum softclip ratio of %f and a "
+                        "maximum indel ratio of %f, %d sites remain" % (
+                self.min_softclip_ratio, self.max_indel_ratio, self.count_softclips()))
+            pass
 
-                if softclip_site.keep_softclips_3p:
+    def filter_consensus_sequences_minlength(self):
 
-                    consensus_seqs = []
-                    for consensus in softclip_site.consensus_sequences_3p:
+        site_table = self.get_site_table()
 
-                        if consensus[0] >= self.min_softclip_count:
-                            consensus_seqs.append(consensus)
-                    softclip_site.consensus_sequences_3p = consensus_seqs
-                    if len(consensus_seqs) == 0:
-                        softclip_site.keep_softclips_3p = False
+        for contig_sites in site_table.contig_tables():
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+            for i in np.flatnonzero(contig_sites.keep_5p):
+                softclip_site = contig_sites.sites[i]
+                softclip_site.consensus_sequences_5p = [consensus for consensus in softclip_site.consensus_sequences_5p
+                                                        if len(consensus[1]) >= self.min_softclip_length]
+                if len(softclip_site.consensus_sequences_5p) == 0:
+                    contig_sites.keep_5p[i] = False
 
-        self.softclipped_sites = filtered_softclipped_sites
+            for i in np.flatnonzero(contig_sites.keep_3p):
+                softclip_site = contig_sites.sites[i]
+                softclip_site.consensus_sequences_3p = [consensus for consensus in softclip_site.consensus_sequences_3p
+                                                        if len(consensus[1]) >= self.min_softclip_length]
+                if len(softclip_site.consensus_sequences_3p) == 0:
+                    contig_sites.keep_3p[i] = False
 
-        if verbose:
-            logger.info("After filtering consensus sequences by a minimum softclip count of %d, %d flank sequences remain" % (
-                self.min_softclip_count, self.count_consensus_seqs())
+        site_table.remove_unkept_sites()
+
+        if self.verbose:
+            logger.info("After filtering consensus sequences by a minimum length of %d, %d flank sequences remain" % (
+                            self.min_softclip_count, self.count_consensus_seqs())
                         )
 
-    def filter_multiple_consensus_sequences(self):
+    def filter_consensus_sequences_mincount(self):
 
-        filtered_softclipped_sites = defaultdict(lambda: defaultdict(SoftclipSite))
+        site_table = self.get_site_table()
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                softclip_site = self.softclipped_sites[contig][pos]
+        for contig_sites in site_table.contig_tables():
+
+            for i in np.flatnonzero(contig_sites.keep_5p):
+                softclip_site = contig_sites.sites[i]
+                softclip_site.consensus_sequences_5p = [consensus for consensus in softclip_site.consensus_sequences_5p
+                                                        if consensus[0] >= self.min_softclip_count]
+                if len(softclip_site.consensus_sequences_5p) == 0:
+                    contig_sites.keep_5p[i] = False
+
+            for i in np.flatnonzero(contig_sites.keep_3p):
+                softclip_site = contig_sites.sites[i]
+                softclip_site.consensus_sequences_3p = [consensus for consensus in softclip_site.consensus_sequences_3p
+                                                        if consensus[0] >= self.min_softclip_count]
+                if len(softclip_site.consensus_sequences_3p) == 0:
+                    contig_sites.keep_3p[i] = False
+
+        site_table.remove_unkept_sites()
+
+        if self.verbose:
+            logger.info("After filtering consensus sequences by a minimum softclip count of %d, %d flank sequences remain" % (
+                self.min_softclip_count, self.count_consensus_seqs())
+                        )
 
+    def filter_multiple_consensus_sequences(self):
 
-                if len(softclip_site.consensus_sequences_5p) > 1:
-                    softclip_site.keep_softclips_5p = False
+        site_table = self.get_site_table()
 
-                if len(softclip_site.consensus_sequences_3p) > 1:
-                    softclip_site.keep_softclips_3p = False
+        for contig_sites in site_table.contig_tables():
+            n_consensus_5p = np.array([len(site.consensus_sequences_5p) for site in contig_sites.sites], dtype=int)
+            n_consensus_3p = np.array([len(site.consensus_sequences_3p) for site in contig_sites.sites], dtype=int)
 
-                if softclip_site.keep_softclips_5p or softclip_site.keep_softclips_3p:
-                    filtered_softclipped_sites[contig][pos] = softclip_site
+            contig_sites.keep_5p &= n_consensus_5p <= 1
+            contig_sites.keep_3p &= n_consensus_3p <= 1
 
-        self.softclipped_sites = filtered_softclipped_sites
+        site_table.remove_unkept_sites()
 
-        if verbose:
+        if self.verbose:
             logger.info("After filtering out sites with multiple consensus sequences, %d sites remain." % (
                 self.count_softclips())
                         )
 
 
     def parse_unclipped_read_info(self):
-        if verbose:
+        if self.verbose:
             logger.info("Getting unclipped read information near softclipped sites...")
             pass
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
+        site_table = self.get_site_table()
 
-                softclip_site = self.softclipped_sites[contig][pos]
+        for contig, pos, softclip_site in site_table.iterate_sites():
 
-                reads_at_site = self.get_reads_at_site(contig, pos)
+            reads_at_site = self.get_reads_at_site(contig, pos)
 
-                runthrough_reads, insertion_5p_reads, insertion_3p_reads, deletion_reads = \
-                    self.get_unclipped_read_info_at_site(contig, pos, reads_at_site)
+            runthrough_reads, insertion_5p_reads, insertion_3p_reads, deletion_reads = \
+                self.get_unclipped_read_info_at_site(contig, pos, reads_at_site)
 
-                softclip_site.add_runthrough_reads(runthrough_reads)
-                softclip_site.add_insertion_5p_reads(insertion_5p_reads)
-                softclip_site.add_insertion_3p_reads(insertion_3p_reads)
-                softclip_site.add_deletion_reads(deletion_reads)
+            softclip_site.add_runthrough_reads(runthrough_reads)
+            softclip_site.add_insertion_5p_reads(insertion_5p_reads)
+            softclip_site.add_insertion_3p_reads(insertion_3p_reads)
+            softclip_site.add_deletion_reads(deletion_reads)
 
-                upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = None, None, None, None
-                downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads = None, None, None, None
+            upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = None, None, None, None
+            downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads = None, None, None, None
 
 
-                if pos - 1 >= 0:
-                    upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = \
-                        self.get_unclipped_read_info_at_site(contig, pos - 1, reads_at_site)
+            if pos - 1 >= 0:
+                upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = \
+                    self.get_unclipped_read_info_at_site(contig, pos - 1, reads_at_site)
 
-                if pos + 1 < self.contig_lengths[contig]:
-                    downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads = \
-                        self.get_unclipped_read_info_at_site(contig, pos + 1, reads_at_site)
+            if pos + 1 < self.contig_lengths[contig]:
+                downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads = \
+                    self.get_unclipped_read_info_at_site(contig, pos + 1, reads_at_site)
 
-                if upstream_deletion_reads:
-                    softclip_site.add_upstream_deletion_reads(upstream_deletion_reads)
+            if upstream_deletion_reads:
+                softclip_site.add_upstream_deletion_reads(upstream_deletion_reads)
 
-                if downstream_deletion_reads:
-                    softclip_site.add_downstream_deletion_reads(downstream_deletion_reads)
+            if downstream_deletion_reads:
+                softclip_site.add_downstream_deletion_reads(downstream_deletion_reads)
+
+        site_table.refresh_counts()
 
 
     def get_reads_at_site(self, contig, pos):
@@ -412,16 +677,17 @@ class SoftclipParser:
                 continue
 
             processed_read = self.process_aligned_blocks_at_site(pos, read.get_blocks())
+            name_key = get_read_name_key(read.query_name)
             if processed_read is None:
                 continue
             elif processed_read == 'runthrough':
-                runthrough_reads.add(read.query_name)
+                runthrough_reads.add(name_key)
             elif processed_read == 'insertion_5p':
-                insertion_5p_reads.add(read.query_name)
+                insertion_5p_reads.add(name_key)
             elif processed_read == 'insertion_3p':
-                insertion_3p_reads.add(read.query_name)
+                insertion_3p_reads.add(name_key)
             else:
-                deletion_reads.add(read.query_name)
+                deletion_reads.add(name_key)
 
         return runthrough_reads, insertion_5p_reads, insertion_3p_reads, deletion_reads
 
@@ -467,23 +733,22 @@ class SoftclipParser:
 
         if self.verbose:
             logger.info('Generating consensus sequences from softclipped flanks...')
-        for contig in self.softclipped_sites:
 
-            for pos in self.softclipped_sites[contig]:
+        site_table = self.get_site_table()
 
-                site = self.softclipped_sites[contig][pos]
+        for contig_sites in site_table.contig_tables():
 
-                if site.keep_softclips_5p:
+            for i in np.flatnonzero(contig_sites.keep_5p):
+                site, pos = contig_sites.sites[i], int(contig_sites.positions[i])
+                softclip_consensus = SoftclipConsensus(site.softclip_5p_reads, '5p', pos, self.min_count_consensus,
+                                                       self.consensus_engine)
+                site.consensus_sequences_5p = softclip_consensus.consensus_seqs
 
-                    reads = site.softclip_5p_reads
-                    softclip_consensus = SoftclipConsensus(reads, '5p', pos, self.min_count_consensus)
-                    site.consensus_sequences_5p = softclip_consensus.consensus_seqs
-
-                if site.keep_softclips_3p:
-
-                    reads = site.softclip_3p_reads
-                    softclip_consensus = SoftclipConsensus(reads, '3p', pos, self.min_count_consensus)
-                    site.consensus_sequences_3p = softclip_consensus.consensus_seqs
+            for i in np.flatnonzero(contig_sites.keep_3p):
+                site, pos = contig_sites.sites[i], int(contig_sites.positions[i])
+                softclip_consensus = SoftclipConsensus(site.softclip_3p_reads, '3p', pos, self.min_count_consensus,
+                                                       self.consensus_engine)
+                site.consensus_sequences_3p = softclip_consensus.consensus_seqs
 
 
     def block_overlaps_site(self, block, position):
@@ -493,67 +758,70 @@ class SoftclipParser:
         else:
             return False
 
-    def has_nearby_5p_mate(self, pos, positions):
-        closest_5p = misc.takeClosestLarger(positions, pos)
-        if closest_5p is None:
-            return False
-        if closest_5p - pos <= self.min_distance_to_mate:
-            return True
-        else:
-            return False
+    def has_nearby_5p_mates(self, positions, positions_5p):
+        if len(positions_5p) == 0:
+            return np.zeros(len(positions), dtype=bool)
 
-    def has_nearby_3p_mate(self, pos, positions):
-        closest_3p = misc.takeClosestSmaller(positions, pos)
-        if closest_3p is None:
-            return False
-        if pos - closest_3p <= self.min_distance_to_mate:
-            return True
-        else:
-            return False
+        closest_index = np.searchsorted(positions_5p, positions, side='right')
+        has_closest = closest_index < len(positions_5p)
+        closest_5p = positions_5p[np.minimum(closest_index, len(positions_5p) - 1)]
+
+        return has_closest & (closest_5p - positions <= self.min_distance_to_mate)
+
+    def has_nearby_3p_mates(self, positions, positions_3p):
+        if len(positions_3p) == 0:
+            return np.zeros(len(positions), dtype=bool)
+
+        closest_index = np.searchsorted(positions_3p, positions, side='left') - 1
+        has_closest = closest_index >= 0
+        closest_3p = positions_3p[np.maximum(closest_index, 0)]
+
+        return has_closest & (positions - closest_3p <= self.min_distance_to_mate)
 
     def get_softclip_5p_positions(self):
         positions = defaultdict(list)
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                if self.softclipped_sites[contig][pos].get_softclip_5p_count() > 0:
-                    positions[contig].append(pos)
-
-        for contig in positions:
-            positions[contig] = sorted(positions[contig])
+        for contig_sites in self.get_site_table().contig_tables():
+            has_softclips_5p = contig_sites.counts['softclip_count_5p'] > 0
+            positions[contig_sites.contig] = list(contig_sites.positions[has_softclips_5p])
 
         return positions
 
     def get_softclip_3p_positions(self):
         positions = defaultdict(list)
 
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                if self.softclipped_sites[contig][pos].get_softclip_3p_count() > 0:
-                    positions[contig].append(pos)
-
-        for contig in positions:
-            positions[contig] = sorted(positions[contig])
+        for contig_sites in self.get_site_table().contig_tables():
+            has_softclips_3p = contig_sites.counts['softclip_count_3p'] > 0
+            positions[contig_sites.contig] = list(contig_sites.positions[has_softclips_3p])
 
         return positions
 
-    def passes_read_filters(self, read):
-        if read.mapping_quality < self.min_alignment_quality:
+    def passes_read_filters(self, read, profile=None):
+        if profile is None:
+            profile = sctools.get_clip_profile(read)
+
+        if profile is None:
+            return False
+        elif read.mapping_quality < self.min_alignment_quality:
             return False
-        elif not sctools.read_meets_min_alignment_inner_length(read, self.min_alignment_inner_length):
+        elif not sctools.read_meets_min_alignment_inner_length(read, self.min_alignment_inner_length, profile):
             return False
         else:
             return True
 
-    def parse_right_softclipped_read(self, read):
-        meets_minlength = self.meets_minlength_right(read)
-        contig, pos = sctools.right_softclipped_site_lenient(read)
-        self.softclipped_sites[contig][pos].add_softclip_5p(read, meets_minlength)
+    def parse_right_softclipped_read(self, read, profile=None):
+        contig, pos = sctools.right_softclipped_site_lenient(read, profile)
+        if self.is_target_site(contig, pos):
+            meets_minlength = self.meets_minlength_right(read)
+            self.softclipped_sites[contig][pos].add_softclip_5p(read, meets_minlength, profile)
+        return pos
 
-    def parse_left_softclipped_read(self, read):
-        meets_minlength = self.meets_minlength_left(read)
-        contig, pos = sctools.left_softclipped_site_lenient(read)
-        self.softclipped_sites[contig][pos].add_softclip_3p(read, meets_minlength)
+    def parse_left_softclipped_read(self, read, profile=None):
+        contig, pos = sctools.left_softclipped_site_lenient(read, profile)
+        if self.is_target_site(contig, pos):
+            meets_minlength = self.meets_minlength_left(read)
+            self.softclipped_sites[contig][pos].add_softclip_3p(read, meets_minlength, profile)
+        return pos
 
     def meets_minlength_right(self, read):
         meets_minlength = False
@@ -569,17 +837,18 @@ class SoftclipParser:
 
 
     def count_softclips(self):
-        count = 0
-        for contig in self.softclipped_sites:
-            count += len(self.softclipped_sites[contig])
-        return count
+        if self.site_table is None:
+            count = 0
+            for contig in self.softclipped_sites:
+                count += len(self.softclipped_sites[contig])
+            return count
+        return self.site_table.count_sites()
 
     def count_consensus_seqs(self):
         count = 0
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                count += len(self.softclipped_sites[contig][pos].consensus_sequences_5p)
-                count += len(self.softclipped_sites[contig][pos].consensus_sequences_3p)
+        for contig, pos, site in self.get_site_table().iterate_sites():
+            count += len(site.consensus_sequences_5p)
+            count += len(site.consensus_sequences_3p)
         return count
 
     def make_dataframe(self):
@@ -589,82 +858,326 @@ class SoftclipParser:
                         'upstream_deletion_count', 'downstream_deletion_count', 'total_count',
                         'consensus_softclip_count', 'consensus_seq']
 
-        outdata= dict()
-        for contig in self.softclipped_sites:
-            sorted_positions = sorted(list(self.softclipped_sites[contig].keys()))
-
-            for pos in sorted_positions:
-                site = self.softclipped_sites[contig][pos]
+        contig_dfs = []
+        for contig_sites in self.get_site_table().contig_tables():
+            contig_dfs.append(contig_sites.make_flank_columns(column_names))
 
-                if site.keep_softclips_5p:
+        if len(contig_dfs) == 0:
+            return pd.DataFrame(columns=column_names)
 
-                    for consensus_sequence in site.consensus_sequences_5p:
+        out_df = pd.concat(contig_dfs).reset_index(drop=True)
 
-                        outdata[len(outdata)] = [
-                            contig, pos, '5p', site.get_softclip_5p_count(), site.get_softclip_3p_count(),
-                            site.get_runthrough_count(), site.get_insertion_5p_count(), site.get_insertion_3p_count(),
-                            site.get_deletion_count(), site.get_upstream_deletion_count(), site.get_downstream_deletion_count(),
-                            site.get_total_count(), consensus_sequence[0], consensus_sequence[1]
-                        ]
-
-                if site.keep_softclips_3p:
-                    for consensus_sequence in site.consensus_sequences_3p:
-                        outdata[len(outdata)] = [
-                            contig, pos, '3p', site.get_softclip_5p_count(), site.get_softclip_3p_count(),
-                            site.get_runthrough_count(), site.get_insertion_5p_count(), site.get_insertion_3p_count(),
-                            site.get_deletion_count(), site.get_upstream_deletion_count(), site.get_downstream_deletion_count(),
-                            site.get_total_count(), consensus_sequence[0], consensus_sequence[1]
-                        ]
+        return out_df
 
-        out_df = pd.DataFrame.from_dict(outdata, orient='index', columns=column_names)
 
-        return out_df
+    def get_evidence(self, bounds=None):
+        # Sites, read names and mates keep the order they were found in, as the consensus sequences depend on it.
+        site_contigs, site_positions, sites = [], [], []
+        for contig in self.softclipped_sites:
+            for pos in sorted(self.softclipped_sites[contig]):
+                if bounds is None or bounds[0] <= pos < bounds[1]:
+                    site_contigs.append(contig)
+                    site_positions.append(pos)
+                    sites.append(self.softclipped_sites[contig][pos])
+
+        mate_counts, read_hashes, clip_lengths, seqs, quals = [], [], [], [], []
+        for site in sites:
+            for clipped_reads in (site.softclip_5p_reads, site.softclip_3p_reads):
+                for mates in clipped_reads.values():
+                    mate_counts.append(len(mates))
+                    for read_hash, seq, qual in mates:
+                        read_hashes.append(read_hash)
+                        clip_lengths.append(len(seq))
+                        seqs.append(seq)
+                        quals.append(qual)
+
+        evidence = OrderedDict()
+        evidence['site_contig'] = np.array(site_contigs, dtype=str)
+        evidence['site_pos'] = np.array(site_positions, dtype=np.int64)
+        evidence['meets_minlength_5p'] = np.array([site.meets_minlength_5p for site in sites], dtype=bool)
+        evidence['meets_minlength_3p'] = np.array([site.meets_minlength_3p for site in sites], dtype=bool)
+        evidence.update(get_site_counts(sites))
+        evidence['mate_count'] = np.array(mate_counts, dtype=np.int64)
+        evidence['read_hash'] = np.array(read_hashes, dtype=np.int64)
+        evidence['clip_length'] = np.array(clip_lengths, dtype=np.int64)
+        evidence['clipped_seqs'] = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        evidence['clipped_quals'] = np.frombuffer(b''.join(quals), dtype=np.uint8)
+
+        return evidence
+
+    def load_evidence(self, evidence_file):
+        # The read filters that were applied while parsing are taken from the file.
+        if self.verbose:
+            logger.info("Loading site evidence from file %s..." % evidence_file)
+
+        with np.load(evidence_file) as archive:
+            evidence = {key: archive[key] for key in archive.files}
+
+        if evidence['evidence_version'].item() != EVIDENCE_VERSION:
+            logger.error("Fatal error: %s was written by another version of findflanks." % evidence_file)
+            sys.exit(1)
+
+        for param in EVIDENCE_PARSE_PARAMS:
+            saved_value = evidence[param].item()
+            if getattr(self, param) != saved_value:
+                logger.info("The evidence was gathered with %s=%s, which is used in place of %s." %
+                            (param, saved_value, getattr(self, param)))
+                setattr(self, param, saved_value)
+
+        self.contig_lengths = OrderedDict(zip(evidence['contig_names'].tolist(), evidence['contig_lengths'].tolist()))
+
+        mate_counts = evidence['mate_count'].tolist()
+        read_hashes = evidence['read_hash'].tolist()
+        read_ends = np.cumsum(evidence['clip_length']).tolist()
+        seqs = evidence['clipped_seqs'].tobytes()
+        quals = evidence['clipped_quals'].tobytes()
+
+        site_counts = {column: evidence[column].tolist() for column in SITE_COUNT_METHODS}
+
+        name_index, read_index = 0, 0
+        for i, (contig, pos) in enumerate(zip(evidence['site_contig'].tolist(), evidence['site_pos'].tolist())):
+            site = SoftclipSite()
+            site.meets_minlength_5p = bool(evidence['meets_minlength_5p'][i])
+            site.meets_minlength_3p = bool(evidence['meets_minlength_3p'][i])
+
+            for clipped_reads, n_names in ((site.softclip_5p_reads, site_counts['softclip_count_5p'][i]),
+                                           (site.softclip_3p_reads, site_counts['softclip_count_3p'][i])):
+                # Read names are not saved. They only need to tell the reads at one site apart.
+                for name_key in range(n_names):
+                    mates = []
+                    for j in range(read_index, read_index + mate_counts[name_index]):
+                        read_start = read_ends[j - 1] if j > 0 else 0
+                        mates.append((read_hashes[j], seqs[read_start:read_ends[j]], quals[read_start:read_ends[j]]))
+                    clipped_reads[name_key] = mates
+                    read_index += mate_counts[name_index]
+                    name_index += 1
+
+            site.runthrough_reads = ReadNameCount(site_counts['runthrough_count'][i])
+            site.insertion_5p_reads = ReadNameCount(site_counts['small_insertion_count_5p'][i])
+            site.insertion_3p_reads = ReadNameCount(site_counts['small_insertion_count_3p'][i])
+            site.deletion_reads = ReadNameCount(site_counts['deletion_count'][i])
+            site.upstream_deletion_reads = ReadNameCount(site_counts['upstream_deletion_count'][i])
+            site.downstream_deletion_reads = ReadNameCount(site_counts['downstream_deletion_count'][i])
+
+            if self.is_target_site(contig, pos):
+                self.softclipped_sites[contig][pos] = site
 
+        if self.verbose:
+            logger.info("Loaded %d softclipped sites." % self.count_softclips())
 
     def print_sites(self):
 
         print('contig\tpos\ttotal\trunthrough_count\tsoftclip_5p_count\tsoftclip_3p_count'
               '\tinsertions_5p_count\tinsertions_3p_count\tdeletion_count', file=sys.stderr)
-        for contig in self.softclipped_sites:
-            for pos in self.softclipped_sites[contig]:
-                site = self.softclipped_sites[contig][pos]
-                print('{contig}\t{pos}\t'.format(contig=contig, pos=pos) + str(site), file=sys.stderr)
+        for contig, pos, site in self.get_site_table().iterate_sites():
+            print('{contig}\t{pos}\t'.format(contig=contig, pos=pos) + str(site), file=sys.stderr)
 
 
-class SoftclipSite:
+class SoftclipSiteTable:
+    # Per-contig arrays of site counts and keep flags, sorted by position, so the filters are mask operations.
+    contig_sites = None
+
+    def __init__(self, softclipped_sites):
+        self.contig_sites = OrderedDict()
+
+        for contig in softclipped_sites:
+            if len(softclipped_sites[contig]) > 0:
+                self.contig_sites[contig] = ContigSiteTable(contig, softclipped_sites[contig])
+
+    def contig_tables(self):
+        return list(self.contig_sites.values())
+
+    def iterate_sites(self):
+        for contig_sites in self.contig_tables():
+            for pos, site in zip(contig_sites.positions, contig_sites.sites):
+                yield contig_sites.contig, int(pos), site
+
+    def remove_unkept_sites(self):
+        for contig in list(self.contig_sites.keys()):
+            self.contig_sites[contig].remove_unkept_sites()
+            if len(self.contig_sites[contig].positions) == 0:
+                del self.contig_sites[contig]
 
-    softclip_5p_reads = None
-    softclip_3p_reads = None
+    def refresh_counts(self):
+        for contig_sites in self.contig_tables():
+            contig_sites.refresh_counts()
 
+    def count_sites(self):
+        return sum(len(contig_sites.positions) for contig_sites in self.contig_tables())
+
+
+# The read counts kept for every site, and the SoftclipSite methods that give them.
+SITE_COUNT_METHODS = OrderedDict([
+    ('softclip_count_5p', 'get_softclip_5p_count'),
+    ('softclip_count_3p', 'get_softclip_3p_count'),
+    ('runthrough_count', 'get_runthrough_count'),
+    ('small_insertion_count_5p', 'get_insertion_5p_count'),
+    ('small_insertion_count_3p', 'get_insertion_3p_count'),
+    ('deletion_count', 'get_deletion_count'),
+    ('upstream_deletion_count', 'get_upstream_deletion_count'),
+    ('downstream_deletion_count', 'get_downstream_deletion_count')
+])
+
+
+def get_site_counts(sites):
+    counts = OrderedDict()
+    for column, method_name in SITE_COUNT_METHODS.items():
+        count_method = getattr(SoftclipSite, method_name)
+        counts[column] = np.fromiter((count_method(site) for site in sites), dtype=np.int64, count=len(sites))
+    return counts
+
+
+class ContigSiteTable:
+
+    count_columns = list(SITE_COUNT_METHODS.keys())
+
+    total_count_columns = ['softclip_count_5p', 'softclip_count_3p', 'runthrough_count', 'small_insertion_count_5p',
+                           'small_insertion_count_3p', 'deletion_count']
+
+    contig = None
+    positions = None
+    sites = None
+    counts = None
     meets_minlength_5p = None
     meets_minlength_3p = None
+    keep_5p = None
+    keep_3p = None
+
+    def __init__(self, contig, sites):
+        self.contig = contig
+        self.positions = np.array(sorted(sites.keys()), dtype=np.int64)
+        self.sites = np.empty(len(self.positions), dtype=object)
+        self.sites[:] = [sites[pos] for pos in self.positions]
+
+        self.meets_minlength_5p = np.array([site.meets_minlength_5p for site in self.sites], dtype=bool)
+        self.meets_minlength_3p = np.array([site.meets_minlength_3p for site in self.sites], dtype=bool)
+        self.keep_5p = np.array([site.keep_softclips_5p for site in self.sites], dtype=bool)
+        self.keep_3p = np.array([site.keep_softclips_3p for site in self.sites], dtype=bool)
+
+        self.refresh_counts()
+
+    def refresh_counts(self):
+        self.counts = get_site_counts(self.sites)
+
+    def get_total_counts(self):
+        return sum(self.counts[column] for column in self.total_count_columns)
+
+    def remove_unkept_sites(self):
+        keep = self.keep_5p | self.keep_3p
+
+        self.positions = self.positions[keep]
+        self.sites = self.sites[keep]
+        self.meets_minlength_5p = self.meets_minlength_5p[keep]
+        self.meets_minlength_3p = self.meets_minlength_3p[keep]
+        self.keep_5p = self.keep_5p[keep]
+        self.keep_3p = self.keep_3p[keep]
+        self.counts = {column: self.counts[column][keep] for column in self.counts}
+
+    def make_flank_columns(self, column_names):
+        # One row per consensus sequence, ordered by position with 5' flanks first.
+        orient_columns = []
+        for orient, orient_rank, keep in (('5p', 0, self.keep_5p), ('3p', 1, self.keep_3p)):
+            rows = np.flatnonzero(keep)
+            if orient == '5p':
+                consensus_seqs = [self.sites[i].consensus_sequences_5p for i in rows]
+            else:
+                consensus_seqs = [self.sites[i].consensus_sequences_3p for i in rows]
+
+            n_consensus = np.array([len(seqs) for seqs in consensus_seqs], dtype=np.int64)
+            flank_rows = np.repeat(rows, n_consensus)
+
+            orient_columns.append((
+                flank_rows,
+                np.full(len(flank_rows), orient_rank),
+                np.array([consensus[0] for seqs in consensus_seqs for consensus in seqs], dtype=np.int64),
+                np.array([consensus[1] for seqs in consensus_seqs for consensus in seqs], dtype=object)
+            ))
+
+        flank_rows, orient_ranks, consensus_counts, consensus_seqs = [np.concatenate(c) for c in zip(*orient_columns)]
+        order = np.lexsort((np.arange(len(flank_rows)), orient_ranks, self.positions[flank_rows]))
+        flank_rows = flank_rows[order]
+
+        columns = OrderedDict()
+        columns['contig'] = np.full(len(flank_rows), self.contig, dtype=object)
+        columns['pos'] = self.positions[flank_rows]
+        columns['orient'] = np.where(orient_ranks[order] == 0, '5p', '3p').astype(object)
+        for column in self.count_columns[:6]:
+            columns[column] = self.counts[column][flank_rows]
+        columns['upstream_deletion_count'] = self.counts['upstream_deletion_count'][flank_rows]
+        columns['downstream_deletion_count'] = self.counts['downstream_deletion_count'][flank_rows]
+        columns['total_count'] = self.get_total_counts()[flank_rows]
+        columns['consensus_softclip_count'] = consensus_counts[order]
+        columns['consensus_seq'] = consensus_seqs[order]
+
+        return pd.DataFrame(columns, columns=column_names)
+
 
-    insertion_5p_reads = None
-    insertion_3p_reads = None
-    runthrough_reads = None
-    deletion_reads = None
-    upstream_deletion_reads = None
-    downstream_deletion_reads = None
+def get_read_name_key(query_name):
+    # Keys are only comparable within a single process, as string hashes are salted.
+    return hash(query_name)
 
-    keep_softclips_5p = None
-    keep_softclips_3p = None
 
-    consensus_sequences_5p = None
-    consensus_sequences_3p = None
+class ReadNameSet:
+    # Keys are appended as they arrive, and only deduplicated when the set is measured or iterated.
+    __slots__ = ('keys', 'is_unique')
+
+    def __init__(self, keys=()):
+        self.keys = array('q', keys)
+        self.is_unique = len(self.keys) == 0
+
+    def add(self, key):
+        self.keys.append(key)
+        self.is_unique = False
+
+    def update(self, keys):
+        self.keys.extend(keys)
+        self.is_unique = False
+
+    def make_unique(self):
+        if not self.is_unique:
+            self.keys = array('q', sorted(set(self.keys)))
+            self.is_unique = True
+
+    def __len__(self):
+        self.make_unique()
+        return len(self.keys)
+
+    def __iter__(self):
+        self.make_unique()
+        return iter(self.keys)
+
+
+class ReadNameCount:
+    # Stands in for a ReadNameSet at sites loaded from an evidence file, where only the read count is known.
+    __slots__ = ('count',)
+
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class SoftclipSite:
+    # Mates are kept as (read hash, clipped sequence, clipped qualities) tuples, not as alignment objects.
+    __slots__ = ('softclip_5p_reads', 'softclip_3p_reads', 'meets_minlength_5p', 'meets_minlength_3p',
+                 'insertion_5p_reads', 'insertion_3p_reads', 'runthrough_reads', 'deletion_reads',
+                 'upstream_deletion_reads', 'downstream_deletion_reads', 'keep_softclips_5p', 'keep_softclips_3p',
+                 'consensus_sequences_5p', 'consensus_sequences_3p')
 
     def __init__(self):
-        self.softclip_5p_reads = defaultdict(set)
-        self.softclip_3p_reads = defaultdict(set)
+        self.softclip_5p_reads = dict()
+        self.softclip_3p_reads = dict()
 
         self.meets_minlength_5p = False
         self.meets_minlength_3p = False
 
-        self.insertion_5p_reads = set()
-        self.insertion_3p_reads = set()
-        self.runthrough_reads = set()
-        self.deletion_reads = set()
-        self.upstream_deletion_reads = set()
-        self.downstream_deletion_reads = set()
+        self.insertion_5p_reads = ReadNameSet()
+        self.insertion_3p_reads = ReadNameSet()
+        self.runthrough_reads = ReadNameSet()
+        self.deletion_reads = ReadNameSet()
+        self.upstream_deletion_reads = ReadNameSet()
+        self.downstream_deletion_reads = ReadNameSet()
 
         self.keep_softclips_5p = True
         self.keep_softclips_3p = True
@@ -672,46 +1185,58 @@ class SoftclipSite:
         self.consensus_sequences_5p = []
         self.consensus_sequences_3p = []
 
-    def add_softclip_5p(self, read, meets_minlength):
-        self.softclip_5p_reads[read.query_name].add(read)
+    def add_softclip_5p(self, read, meets_minlength, profile=None):
+        clipped_read = (hash(read), sctools.right_softclipped_sequence(read, profile).encode(),
+                        bytes(sctools.right_softclip_qualities(read, profile)))
+        self.add_clipped_read(self.softclip_5p_reads, get_read_name_key(read.query_name), clipped_read)
 
         if not self.meets_minlength_5p and meets_minlength:
             self.meets_minlength_5p = True
 
     def add_softclip_5p_reads(self, reads):
         for read in reads:
-            self.softclip_5p_reads[read.query_name].add(read)
+            self.add_softclip_5p(read, False)
 
-    def add_softclip_3p(self, read, meets_minlength):
-        self.softclip_3p_reads[read.query_name].add(read)
+    def add_softclip_3p(self, read, meets_minlength, profile=None):
+        clipped_read = (hash(read), sctools.left_softclipped_sequence(read, profile).encode(),
+                        bytes(sctools.left_softclip_qualities(read, profile)))
+        self.add_clipped_read(self.softclip_3p_reads, get_read_name_key(read.query_name), clipped_read)
 
         if not self.meets_minlength_3p and meets_minlength:
             self.meets_minlength_3p = True
 
     def add_softclip_3p_reads(self, reads):
         for read in reads:
-            self.softclip_3p_reads[read.query_name].add(read)
+            self.add_softclip_3p(read, False)
+
+    def add_clipped_read(self, clipped_reads, name_key, clipped_read):
+        mates = clipped_reads.setdefault(name_key, [])
+        # The same alignment record is only counted once, as it was when whole reads were stored in a set.
+        for mate in mates:
+            if mate[0] == clipped_read[0]:
+                return
+        mates.append(clipped_read)
 
     def add_runthrough(self, read):
-        self.runthrough_reads.add(read.query_name)
+        self.runthrough_reads.add(get_read_name_key(read.query_name))
 
     def add_runthrough_reads(self, reads):
         self.runthrough_reads.update(reads)
 
     def add_insertion_5p(self, read):
-        self.insertion_5p_reads.add(read.query_name)
+        self.insertion_5p_reads.add(get_read_name_key(read.query_name))
 
     def add_insertion_5p_reads(self, reads):
         self.insertion_5p_reads.update(reads)
 
     def add_insertion_3p(self, read):
-        self.insertion_3p_reads.add(read.query_name)
+        self.insertion_3p_reads.add(get_read_name_key(read.query_name))
 
     def add_insertion_3p_reads(self, reads):
         self.insertion_3p_reads.update(reads)
 
     def add_deletion(self, read):
-        self.deletion_reads.add(read.query_name)
+        self.deletion_reads.add(get_read_name_key(read.query_name))
 
     def add_deletion_reads(self, reads):
         self.deletion_reads.update(reads)
@@ -786,15 +1311,22 @@ class SoftclipConsensus:
     orient = None
     softclip_pos = None
     min_count_consensus = None
+    consensus_engine = None
     softclipped_seqs = None
     softclipped_qualities = None
     consensus_seqs = None
 
-    def __init__(self, reads, orient, softclip_pos, min_count_consensus):
+    consensus_engines = {
+        'trie': flanktrie.Trie,
+        'pwm': flankpwm.PositionWeightMatrix
+    }
+
+    def __init__(self, reads, orient, softclip_pos, min_count_consensus, consensus_engine='trie'):
         self.reads = reads
         self.orient = orient
         self.softclip_pos = softclip_pos
         self.min_count_consensus = min_count_consensus
+        self.consensus_engine = self.consensus_engines[consensus_engine]
         self.softclipped_seqs = []
         self.softclipped_qualities = []
         self.consensus_seqs = []
@@ -851,160 +1383,104 @@ class SoftclipConsensus:
 
 
     def combine_softclip_seq_quals_3p(self, reads):
+        return self.combine_softclip_seq_quals(reads, reverse=True)
 
+    def combine_softclip_seq_quals_5p(self, reads):
+        return self.combine_softclip_seq_quals(reads, reverse=False)
+
+    def combine_softclip_seq_quals(self, reads, reverse):
+        # Mates are merged by keeping the higher quality base at each position. 3p clips are read reversed.
         if len(reads) == 1:
-            read = reads.pop()
-            return sctools.left_softclipped_sequence(read)[::-1], sctools.left_softclip_qualities(read)[::-1]
+            read_hash, seq, quals = reads[0]
+            if reverse:
+                return seq[::-1], quals[::-1]
+            return seq, quals
 
         elif len(reads) == 2:
-            read1 = reads.pop()
-            read2 = reads.pop()
-
-            read1_qualities = sctools.left_softclip_qualities(read1)[::-1]
-            read2_qualities = sctools.left_softclip_qualities(read2)[::-1]
-
-            read1_clipped_seq = sctools.left_softclipped_sequence(read1)[::-1]
-            read2_clipped_seq = sctools.left_softclipped_sequence(read2)[::-1]
+            read1, read2 = self.get_mate_order(reads)
 
-            outseq = ''
-            outquals = []
+            seq1, quals1 = np.frombuffer(read1[1], dtype=np.uint8), np.frombuffer(read1[2], dtype=np.uint8)
+            seq2, quals2 = np.frombuffer(read2[1], dtype=np.uint8), np.frombuffer(read2[2], dtype=np.uint8)
 
-            for pos in range(max([len(read1_qualities), len(read2_qualities)])):
-
-                if pos < len(read1_qualities) and pos < len(read2_qualities):
-                    qual1, qual2 = read1_qualities[pos], read2_qualities[pos]
-                    char1, char2 = read1_clipped_seq[pos], read2_clipped_seq[pos]
-
-                    if qual1 >= qual2:
-                        outquals.append(qual1)
-                        outseq += char1
-                    else:
-                        outquals.append(qual2)
-                        outseq += char2
-
-                elif pos < len(read1_qualities):
-                    outquals.append(read1_qualities[pos])
-                    outseq += read1_clipped_seq[pos]
-                elif pos < len(read2_qualities):
-                    outquals.append(read2_qualities[pos])
-                    outseq += read2_clipped_seq[pos]
-                else:
-                    print('ERROR: YOU MISSED SOMETHING')
-                    sys.exit()
+            if reverse:
+                seq1, quals1, seq2, quals2 = seq1[::-1], quals1[::-1], seq2[::-1], quals2[::-1]
 
+            if len(quals1) >= len(quals2):
+                outseq, outquals = seq1.copy(), quals1.copy()
+            else:
+                outseq, outquals = seq2.copy(), quals2.copy()
 
-            #print(read1_qualities)
-            #print(read2_qualities)
-            #print(outquals)
-            #print(read1_clipped_seq)
-            #print(read2_clipped_seq)
-            #print(outseq)
-            #print()
+            overlap = min(len(quals1), len(quals2))
+            use_read1 = quals1[:overlap] >= quals2[:overlap]
+            outseq[:overlap] = np.where(use_read1, seq1[:overlap], seq2[:overlap])
+            outquals[:overlap] = np.where(use_read1, quals1[:overlap], quals2[:overlap])
 
-            return outseq, outquals
+            return outseq.tobytes(), outquals.tobytes()
         else:
             print("READ NUMBER ERROR - ZERO OR MORE THAN TWO READS ASSOCIATED WITH QUERY NAME")
             sys.exit()
 
 
-    def combine_softclip_seq_quals_5p(self, reads):
-
-        if len(reads) == 1:
-            read = reads.pop()
-            return sctools.right_softclipped_sequence(read), sctools.right_softclip_qualities(read)
-
-        elif len(reads) == 2:
-            read1 = reads.pop()
-            read2 = reads.pop()
-
-            read1_qualities = sctools.right_softclip_qualities(read1)
-            read2_qualities = sctools.right_softclip_qualities(read2)
-
-            read1_clipped_seq = sctools.right_softclipped_sequence(read1)
-            read2_clipped_seq = sctools.right_softclipped_sequence(read2)
-
-            outseq = ''
-            outquals = []
-
-            for pos in range(max([len(read1_qualities), len(read2_qualities)])):
-
-                if pos < len(read1_qualities) and pos < len(read2_qualities):
-                    qual1, qual2 = read1_qualities[pos], read2_qualities[pos]
-                    char1, char2 = read1_clipped_seq[pos], read2_clipped_seq[pos]
-
-                    if qual1 >= qual2:
-                        outquals.append(qual1)
-                        outseq += char1
-                    else:
-                        outquals.append(qual2)
-                        outseq += char2
+    def get_mate_order(self, reads):
+        # Popping the same hashes from a set keeps the old tie-breaking between equal qualities.
+        read_hashes = set()
+        for read in reads:
+            read_hashes.add(read[0])
 
-                elif pos < len(read1_qualities):
-                    outquals.append(read1_qualities[pos])
-                    outseq += read1_clipped_seq[pos]
-                elif pos < len(read2_qualities):
-                    outquals.append(read2_qualities[pos])
-                    outseq += read2_clipped_seq[pos]
-                else:
-                    print('ERROR: YOU MISSED SOMETHING')
-                    sys.exit()
-
-            #print(read1_qualities)
-            #print(read2_qualities)
-            #print(outquals)
-            #print(read1_clipped_seq)
-            #print(read2_clipped_seq)
-            #print(outseq)
-            #print()
-
-            return outseq, outquals
+        first_hash = read_hashes.pop()
+        if reads[0][0] == first_hash:
+            return reads[0], reads[1]
         else:
-            print("READ NUMBER ERROR - ZERO OR MORE THAN TWO READS ASSOCIATED WITH QUERY NAME")
-            sys.exit()
-
+            return reads[1], reads[0]
 
 
     def get_sequence_clusters(self, sequence_dict, perc_similarity=0.75):
-
+        # Singletons come first, then the connected clusters in order of their first sequence.
         if len(sequence_dict) == 1:
             return [sequence_dict]
 
         sequences = list(sequence_dict.keys())
+        lengths = np.array([len(seq) for seq in sequences])
+        prefix_base_counts = self.get_prefix_base_counts(sequences, lengths.max())
+        max_distances = self.get_max_distances(lengths.max(), perc_similarity)
 
         no_match = set(sequences)
         has_match = set()
-        pairwise_matches = set()
-        for i, j in itertools.combinations(range(len(sequences)), r=2):
-
-            seq1, seq2 = sequences[i], sequences[j]
-            minlength = min([len(seq1), len(seq2)])
-            dist = levenshtein_distance(seq1[:minlength], seq2[:minlength])
-            similarity = 1 - (dist / minlength)
-
-            if similarity >= perc_similarity:
-                has_match.add(i)
-                has_match.add(j)
-                if seq1 in no_match: no_match.remove(seq1)
-                if seq2 in no_match: no_match.remove(seq2)
-                pairwise_matches.add((i, j))
-
-        pair_order = sorted(list(has_match))
-        adjacency_matrix = pd.DataFrame(np.zeros((len(pair_order), len(pair_order))), index=pair_order,
-                                        columns=pair_order)
-
-        for pair in pairwise_matches:
-            adjacency_matrix.loc[pair[0], pair[1]] = 1
-            adjacency_matrix.loc[pair[1], pair[0]] = 1
-
-        n_comp, assignments = connected_components(adjacency_matrix.values)
-        final_components = []
-        for i in range(n_comp):
-            comp = list(np.array(pair_order)[assignments == i])
-            final_components.append(comp)
+        clusters = misc.UnionFind(len(sequences))
+        for i in range(len(sequences) - 1):
+
+            others = np.arange(i + 1, len(sequences))
+            minlengths = np.minimum(lengths[i], lengths[others])
+            composition_distance = np.abs(prefix_base_counts[i, minlengths] -
+                                          prefix_base_counts[others, minlengths]).sum(axis=1)
+
+            # Every edit changes the base composition of the sequences by at most two.
+            candidates = others[composition_distance <= 2 * max_distances[minlengths]]
+
+            seq1 = sequences[i]
+            for j in candidates:
+                if clusters.find(i) == clusters.find(j):
+                    continue
+
+                seq2 = sequences[j]
+                minlength = min([len(seq1), len(seq2)])
+                max_dist = max_distances[minlength]
+                dist = misc.bounded_levenshtein_distance(seq1[:minlength], seq2[:minlength], max_dist)
+
+                if dist <= max_dist:
+                    has_match.add(i)
+                    has_match.add(j)
+                    if seq1 in no_match: no_match.remove(seq1)
+                    if seq2 in no_match: no_match.remove(seq2)
+                    clusters.union(i, j)
+
+        final_components = defaultdict(list)
+        for i in sorted(has_match):
+            final_components[clusters.find(i)].append(i)
 
         final_clusters = [{seq: sequence_dict[seq]} for seq in no_match]
 
-        for comp in final_components:
+        for comp in final_components.values():
             new_seq_cluster = dict()
             for i in comp:
                 new_seq_cluster[sequences[i]] = sequence_dict[sequences[i]]
@@ -1012,6 +1488,31 @@ class SoftclipConsensus:
 
         return final_clusters
 
+    def get_prefix_base_counts(self, sequences, maxlength):
+        # [i, k] holds the A, C, G, T and other base counts of the first k bases of sequence i.
+        base_codes = np.full((len(sequences), maxlength), 5, dtype=np.uint8)
+        for i, seq in enumerate(sequences):
+            encoded = np.frombuffer(seq.encode(), dtype=np.uint8)
+            base_codes[i, :len(seq)] = misc.BASE_CODES[encoded]
+
+        prefix_base_counts = np.zeros((len(sequences), maxlength + 1, 5), dtype=np.int32)
+        for code in range(5):
+            prefix_base_counts[:, 1:, code] = np.cumsum(base_codes == code, axis=1)
+
+        return prefix_base_counts
+
+    def get_max_distances(self, maxlength, perc_similarity):
+        max_distances = np.zeros(maxlength + 1, dtype=np.int64)
+        for length in range(1, maxlength + 1):
+            dist = int((1 - perc_similarity) * length)
+            while dist < length and 1 - ((dist + 1) / length) >= perc_similarity:
+                dist += 1
+            while dist > 0 and 1 - (dist / length) < perc_similarity:
+                dist -= 1
+            max_distances[length] = dist
+
+        return max_distances
+
     def get_cluster_consensus_seqs(self, seq_clusters):
         consensus_seqs = list()
 
@@ -1020,9 +1521,9 @@ class SoftclipConsensus:
             quals = [clust[seq][0] for seq in clust]
             counts = [clust[seq][1] for seq in clust]
 
-            mytrie = flanktrie.Trie()
-            mytrie.load_words(seqs, quals, counts)
-            consensus = mytrie.make_consensus_word(self.min_count_consensus)
+            engine = self.consensus_engine()
+            engine.load_words(seqs, quals, counts)
+            consensus = engine.make_consensus_word(self.min_count_consensus)
 
             consensus_seqs.append(consensus)
 
@@ -1033,8 +1534,7 @@ class SoftclipConsensus:
         seq_clusters = [list(cluster.keys()) for cluster in seq_clusters]
         out = []
         for clust in seq_clusters:
-            subtrie = flanktrie.make_subtrie(clust)
-            total_words = subtrie.total_words
+            total_words = flanktrie.calc_total_subtrie_words(clust)
             out.append(total_words)
 
         return out
@@ -1043,7 +1543,7 @@ class SoftclipConsensus:
         if self.orient == '5p':
             print('SOFTCLIPPED SEQS:')
             for seq in self.softclipped_seqs:
-                print('\t'+seq)
+                print('\t'+seq.decode())
             print('CONSENSUS SEQS:')
             for seq in self.consensus_seqs:
                 print('\t' + seq[1])
@@ -1051,7 +1551,7 @@ class SoftclipConsensus:
         else:
             print('SOFTCLIPPED SEQS:')
             for seq in self.softclipped_seqs:
-                print('\t' + seq[::-1])
+                print('\t' + seq[::-1].decode())
             print('CONSENSUS SEQS:')
             for seq in self.consensus_seqs:
                 print('\t' + seq[1])
@@ -0,0 +1,136 @@
+import warnings
+warnings.filterwarnings("ignore")
+from collections import defaultdict
+from mustache.misc import revcomp
+
+DEFAULT_QUALITY = 20
+
+
+class FlankAssembler:
+    """
+    An in-process local assembler for the handful of reads gathered at an insertion site (the softclipped reads and
+    the unmapped mates of nearby reads). Rather than assembling every contig, it grows the known flank sequence:
+    reads of either strand are placed on the end of the flank through shared k-mers, checked over their whole overlap,
+    and the flank is extended with the base of highest summed quality at every new position. Placing reads and
+    extending are repeated until no new read reaches past the end.
+
+    Extension stops at the first position covered by fewer than min_overlap_count reads, or where the best base holds
+    less than min_consensus_prop of the summed quality, so it does not run into repeats or mixed alleles.
+    """
+
+    def __init__(self, reads, quals=None, kmer_length=11, min_overlap_length=20, max_mismatch_prop=0.1,
+                 min_overlap_count=2, min_consensus_prop=0.75):
+
+        self.kmer_length = kmer_length
+        self.min_overlap_length = min_overlap_length
+        self.max_mismatch_prop = max_mismatch_prop
+        self.min_overlap_count = min_overlap_count
+        self.min_consensus_prop = min_consensus_prop
+
+        # Both strands of read i are stored, at 2 * i and 2 * i + 1.
+        self.sequences = []
+        self.qualities = []
+        for i in range(len(reads)):
+            read = reads[i].upper()
+            read_quals = get_phred_qualities(quals[i] if quals else None, len(read))
+            self.sequences += [read, revcomp(read)]
+            self.qualities += [read_quals, read_quals[::-1]]
+
+        self.kmer_index = defaultdict(list)
+        for seq_index, seq in enumerate(self.sequences):
+            for offset in range(len(seq) - kmer_length + 1):
+                self.kmer_index[seq[offset:offset + kmer_length]].append((seq_index, offset))
+
+    def extend_seed(self, seed, orient):
+        """
+        Returns seed extended away from the insertion site: to the right for a 5' flank ('R'), and to the left for a
+        3' flank ('L'). The seed is returned unchanged if no read extends it.
+        """
+
+        seed = seed.upper()
+        if orient == 'L':
+            return revcomp(self.extend_right(revcomp(seed)))
+        return self.extend_right(seed)
+
+    def extend_right(self, contig):
+
+        placements = {}
+        while True:
+            placements.update(self.place_reads(contig, placements))
+            extension = self.get_consensus_extension(contig, placements)
+            if extension == '':
+                return contig
+            contig += extension
+
+    def place_reads(self, contig, placements):
+        """
+        Finds the reads that are not placed yet and that overlap the end of the contig and reach past it. Returns the
+        position in the contig of the first base of each read, keyed by sequence index. A read is placed on one strand
+        only, at its position with the fewest mismatches.
+        """
+
+        placed_reads = set(seq_index // 2 for seq_index in placements)
+        min_overlap_length = min(self.min_overlap_length, len(contig))
+        anchor_start = max(len(contig) - 2 * min_overlap_length, 0)
+
+        best_placements = {}
+        for kmer_start in range(anchor_start, len(contig) - self.kmer_length + 1):
+            for seq_index, offset in self.kmer_index.get(contig[kmer_start:kmer_start + self.kmer_length], ()):
+                if seq_index // 2 in placed_reads:
+                    continue
+
+                start = kmer_start - offset
+                seq = self.sequences[seq_index]
+                overlap_start = max(start, 0)
+                overlap_length = len(contig) - overlap_start
+                if overlap_length < min_overlap_length or start + len(seq) <= len(contig):
+                    continue
+
+                mismatches = count_mismatches(contig, overlap_start, seq, overlap_start - start, overlap_length)
+                if mismatches > self.max_mismatch_prop * overlap_length:
+                    continue
+
+                read_index = seq_index // 2
+                if read_index not in best_placements or mismatches < best_placements[read_index][2]:
+                    best_placements[read_index] = (seq_index, start, mismatches)
+
+        return {seq_index: start for seq_index, start, mismatches in best_placements.values()}
+
+    def get_consensus_extension(self, contig, placements):
+
+        extension = ''
+        position = len(contig)
+        while True:
+            base_quals = defaultdict(int)
+            coverage = 0
+            for seq_index, start in placements.items():
+                read_position = position - start
+                if 0 <= read_position < len(self.sequences[seq_index]):
+                    base_quals[self.sequences[seq_index][read_position]] += self.qualities[seq_index][read_position]
+                    coverage += 1
+
+            if coverage < self.min_overlap_count:
+                return extension
+
+            best_base = max(base_quals, key=lambda base: base_quals[base])
+            total_qual = sum(base_quals.values())
+            if best_base == 'N' or base_quals[best_base] < self.min_consensus_prop * max(total_qual, 1):
+                return extension
+
+            extension += best_base
+            position += 1
+
+
+def count_mismatches(seq1, start1, seq2, start2, length):
+    mismatches = 0
+    for i in range(length):
+        if seq1[start1 + i] != seq2[start2 + i]:
+            mismatches += 1
+    return mismatches
+
+
+def get_phred_qualities(quals, length):
+    """Converts an ASCII quality string to phred scores, using a flat default when the string is missing or unusable."""
+    if quals is None or len(quals) != length:
+        return [DEFAULT_QUALITY] * length
+    return [ord(q) - 33 for q in quals]
@@ -0,0 +1,117 @@
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+from mustache import misc
+
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4, 5], dtype=np.int8)
+PADDING_CODE = 5
+
+NO_SCORE = -10 ** 6
+START, DIAGONAL, UP, LEFT = 0, 1, 2, 3
+
+
+def find_terminal_inverted_repeats(seqs, ir_distance_from_end, gap=12, threshold=15, match=3, mismatch=-4,
+                                   batch_size=256):
+    """
+    Finds the best inverted repeat at the termini of each sequence: a local alignment of the sequence against its
+    reverse complement, scored like einverted (match, mismatch and a linear gap penalty), whose first arm starts within
+    ir_distance_from_end bases of the start of the sequence, and whose second arm ends within ir_distance_from_end
+    bases of its end. The arms may not overlap.
+
+    Returns a (has IR, first arm sequence, second arm sequence) tuple for each sequence, with None for the arms when
+    no alignment scores at least threshold. The sequences are aligned in batches of batch_size, all at once.
+    """
+
+    results = []
+    for batch_start in range(0, len(seqs), batch_size):
+        results += align_terminal_arms(seqs[batch_start:batch_start + batch_size], ir_distance_from_end, gap,
+                                       threshold, match, mismatch)
+    return results
+
+
+def align_terminal_arms(seqs, ir_distance_from_end, gap, threshold, match, mismatch):
+
+    if len(seqs) == 0:
+        return []
+
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    maxlength = max(lengths.max(), 1)
+
+    codes = np.full((len(seqs), maxlength), PADDING_CODE, dtype=np.int8)
+    rc_codes = np.full((len(seqs), maxlength), PADDING_CODE, dtype=np.int8)
+    for k, seq in enumerate(seqs):
+        seq_codes = misc.BASE_CODES[np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)]
+        codes[k, :len(seq)] = seq_codes
+        rc_codes[k, :len(seq)] = COMPLEMENT_CODES[seq_codes[::-1]]
+
+    # Row i is position i of the sequence, and column j is position j of its reverse complement, which is position
+    # length - 1 - j of the sequence. The arms do not overlap while i < length - 1 - j.
+    columns = np.arange(maxlength)
+    column_gaps = gap * columns
+    starts_in_column = columns <= ir_distance_from_end
+
+    pointers = np.zeros((len(seqs), maxlength, maxlength), dtype=np.int8)
+    best_scores = np.full(len(seqs), NO_SCORE, dtype=np.int64)
+    best_cells = np.zeros((len(seqs), 2), dtype=np.int64)
+
+    previous_row = np.full((len(seqs), maxlength), NO_SCORE, dtype=np.int64)
+    for i in range(maxlength):
+        is_valid = columns[None, :] < (lengths - 1 - i)[:, None]
+
+        is_match = (codes[:, i, None] == rc_codes) & (codes[:, i, None] < 4)
+        scores = np.where(is_match, match, mismatch)
+
+        diagonal = np.full_like(previous_row, NO_SCORE)
+        diagonal[:, 1:] = previous_row[:, :-1]
+        diagonal = np.where(diagonal > NO_SCORE, diagonal + scores, NO_SCORE)
+        up = np.where(previous_row > NO_SCORE, previous_row - gap, NO_SCORE)
+
+        row = np.maximum(diagonal, up)
+        pointer = np.where(diagonal >= up, DIAGONAL, UP)
+
+        # Alignments start with a matching base, with the first arm starting within ir_distance_from_end bases of the
+        # start, and the second arm ending within ir_distance_from_end bases of the end.
+        if i < ir_distance_from_end:
+            is_start = starts_in_column[None, :] & is_match & (match > row)
+            row = np.where(is_start, match, row)
+            pointer = np.where(is_start, START, pointer)
+
+        row = np.where(is_valid, row, NO_SCORE)
+
+        # With a linear gap penalty, the best left move into a column is the best cell to its left, less the gap
+        # penalty for every column in between.
+        left = np.maximum.accumulate(row + column_gaps, axis=1) - column_gaps
+        is_left = is_valid & (left > row)
+        row = np.where(is_left, left, row)
+        pointer = np.where(is_left, LEFT, pointer)
+
+        pointers[:, i, :] = pointer
+
+        row_best = row.max(axis=1)
+        is_better = row_best > best_scores
+        best_scores = np.where(is_better, row_best, best_scores)
+        best_cells[is_better, 0] = i
+        best_cells[is_better, 1] = row.argmax(axis=1)[is_better]
+
+        previous_row = row
+
+    results = []
+    for k, seq in enumerate(seqs):
+        if best_scores[k] < threshold:
+            results.append((False, None, None))
+            continue
+
+        i, j = best_cells[k]
+        end_i, end_j = i, j
+        while pointers[k, i, j] != START:
+            if pointers[k, i, j] == DIAGONAL:
+                i, j = i - 1, j - 1
+            elif pointers[k, i, j] == UP:
+                i -= 1
+            else:
+                j -= 1
+
+        length = len(seq)
+        results.append((True, seq[i:end_i + 1], seq[length - 1 - end_j:length - j]))
+
+    return results
@@ -0,0 +1,96 @@
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+
+
+class PositionWeightMatrix:
+    """
+    A consensus engine for flank sequences that are all anchored at the softclip junction. It builds the same
+    per-position quality sums and read counts that flanktrie.Trie gathers level by level, as a (length x base) matrix
+    and a coverage vector, so no per-node objects are created.
+
+    Words are expected to come from a trie traversal, so that words sharing a prefix carry the same qualities and
+    counts over that prefix. As in the trie, every distinct prefix is only counted once.
+    """
+
+    __slots__ = ('alphabet', 'qual_matrix', 'char_present', 'coverage')
+
+    def __init__(self):
+        self.alphabet = np.array([], dtype='U1')
+        self.qual_matrix = np.zeros((0, 0), dtype=np.int64)
+        self.char_present = np.zeros((0, 0), dtype=bool)
+        self.coverage = np.zeros(0, dtype=np.int64)
+
+    def load_words(self, words, quals, counts):
+
+        if len(words) == 0:
+            return
+
+        lengths = np.array([len(word) for word in words], dtype=np.int64)
+        maxlength = lengths.max()
+
+        chars = np.frombuffer(''.join(words).encode('ascii', 'replace'), dtype=np.uint8)
+        flat_quals = np.fromiter((qual for word_quals in quals for qual in word_quals), dtype=np.int64,
+                                 count=len(chars))
+        flat_counts = np.fromiter((count for word_counts in counts for count in word_counts), dtype=np.int64,
+                                  count=len(chars))
+
+        word_index = np.repeat(np.arange(len(words)), lengths)
+        positions = np.arange(len(chars)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        shared_prefix_lengths = self.get_shared_prefix_lengths(chars, word_index, positions, lengths, maxlength)
+        is_new_prefix = positions >= shared_prefix_lengths[word_index]
+
+        alphabet_codes, char_codes = np.unique(chars[is_new_prefix], return_inverse=True)
+        positions = positions[is_new_prefix]
+        cells = positions * len(alphabet_codes) + char_codes
+        n_cells = maxlength * len(alphabet_codes)
+
+        self.alphabet = np.array([chr(code) for code in alphabet_codes], dtype='U1')
+        self.qual_matrix = np.bincount(cells, weights=flat_quals[is_new_prefix], minlength=n_cells).round()\
+            .astype(np.int64).reshape(maxlength, len(alphabet_codes))
+        self.char_present = np.bincount(cells, minlength=n_cells).reshape(maxlength, len(alphabet_codes)) > 0
+        self.coverage = np.bincount(positions, weights=flat_counts[is_new_prefix], minlength=maxlength).round()\
+            .astype(np.int64)
+
+    def get_shared_prefix_lengths(self, chars, word_index, positions, lengths, maxlength):
+        """
+        Returns, for every word, the length of the longest prefix it shares with another word that is counted before
+        it. Sorting the words groups every shared prefix together, so only neighbours need to be compared.
+        """
+
+        padded_chars = np.zeros((len(lengths), maxlength), dtype=np.int16) - 1
+        padded_chars[word_index, positions] = chars
+
+        order = np.lexsort(padded_chars.T[::-1])
+        sorted_chars = padded_chars[order]
+
+        mismatches = sorted_chars[1:] != sorted_chars[:-1]
+        neighbour_prefix_lengths = np.where(mismatches.any(axis=1), mismatches.argmax(axis=1), maxlength)
+        neighbour_prefix_lengths = np.minimum(neighbour_prefix_lengths,
+                                              np.minimum(lengths[order][1:], lengths[order][:-1]))
+
+        shared_prefix_lengths = np.zeros(len(lengths), dtype=np.int64)
+        shared_prefix_lengths[order[1:]] = neighbour_prefix_lengths
+
+        return shared_prefix_lengths
+
+    def make_consensus_word(self, mincount):
+        """
+        Takes the base with the highest summed quality at every position, or N when several bases tie, and stops at
+        the first position whose read count falls below mincount.
+        """
+
+        if len(self.coverage) == 0:
+            return ''
+
+        below_mincount = np.flatnonzero(self.coverage < mincount)
+        consensus_length = below_mincount[0] if len(below_mincount) > 0 else len(self.coverage)
+
+        quals = np.where(self.char_present, self.qual_matrix, -1)[:consensus_length]
+        best_quals = quals.max(axis=1)
+        is_tied = (quals == best_quals[:, None]).sum(axis=1) > 1
+
+        consensus_chars = np.where(is_tied, 'N', self.alphabet[quals.argmax(axis=1)])
+
+        return ''.join(consensus_chars)
@@ -3,60 +3,196 @@ warnings.filterwarnings("ignore")
 # Adapted from code by Shubhadeep Roychowdhury available at https://towardsdatascience.com/implementing-a-trie-data-structure-in-python-in-less-than-100-lines-of-code-a877ea23c1a1
 from typing import Tuple
 import sys
-from collections import defaultdict
+from array import array
+import numpy as np
 
-class TrieNode(object):
-    """
-    Our trie node implementation. Very basic. but does the job
-    """
-
-    def __init__(self, char: str, parent=None):
-        self.char = char
-        self.children = {}
-        self.parent = parent
-        self.word_count = 0
-        self.counter = 1
-        self.total_lifetime_children = 0
-        self.qual = 0
+BASES = 'ACGTN'
+# Translates the ASCII bytes of a word to the codes of its bases, and every other character to 255.
+BASE_CODES = bytes(BASES.index(chr(byte)) if chr(byte) in BASES else 255 for byte in range(256))
+ROOT = 0
+NO_NODE = -1
 
 
 class Trie:
+    """
+    A trie stored as columns with one entry per node, rather than as one object per node. Children of A, C, G, T and N
+    are found through a fixed five-way index table, and every node's children are also chained in the order they were
+    added so that traversals visit them in insertion order. Other characters are looked up along that chain.
+    """
+
+    __slots__ = ('alphabet', 'char_codes', 'chars', 'parents', 'depths', 'quals', 'counters', 'word_counts',
+                 'total_lifetime_children', 'child_index', 'first_children', 'last_children', 'next_siblings',
+                 'total_words', 'total_nodes', 'total_base_quality')
 
     def __init__(self):
-        self.root = TrieNode('')
+        self.alphabet = list(BASES)
+        self.char_codes = {char: code for code, char in enumerate(BASES)}
+
+        self.chars = array('i')
+        self.parents = array('i')
+        self.depths = array('i')
+        self.quals = array('q')
+        self.counters = array('q')
+        self.word_counts = array('q')
+        self.total_lifetime_children = array('i')
+        self.child_index = array('i')
+        self.first_children = array('i')
+        self.last_children = array('i')
+        self.next_siblings = array('i')
+
         self.total_words = 0
         self.total_nodes = 0
         self.total_base_quality = 0
 
-    def add(self, word: str, quals: list):
+        self.new_node(NO_NODE, NO_NODE)
+
+    def get_char_code(self, char):
+        code = self.char_codes.get(char)
+        if code is None:
+            code = len(self.alphabet)
+            self.alphabet.append(char)
+            self.char_codes[char] = code
+        return code
+
+    def new_node(self, code, parent):
+        node = len(self.chars)
+
+        self.chars.append(code)
+        self.parents.append(parent)
+        self.quals.append(0)
+        self.counters.append(1)
+        self.word_counts.append(0)
+        self.total_lifetime_children.append(0)
+        self.child_index.extend((NO_NODE,) * len(BASES))
+        self.first_children.append(NO_NODE)
+        self.last_children.append(NO_NODE)
+        self.next_siblings.append(NO_NODE)
+
+        if parent == NO_NODE:
+            self.depths.append(0)
+            return node
+
+        self.depths.append(self.depths[parent] + 1)
+
+        if code < len(BASES):
+            self.child_index[parent * len(BASES) + code] = node
+
+        if self.first_children[parent] == NO_NODE:
+            self.first_children[parent] = node
+        else:
+            self.next_siblings[self.last_children[parent]] = node
+        self.last_children[parent] = node
+        self.total_lifetime_children[parent] += 1
+
+        return node
+
+    def get_child(self, node, char):
+        code = self.char_codes.get(char)
+        if code is None:
+            return NO_NODE
+        if code < len(BASES):
+            return self.child_index[node * len(BASES) + code]
+
+        child = self.first_children[node]
+        while child != NO_NODE and self.chars[child] != code:
+            child = self.next_siblings[child]
+        return child
+
+    def get_children(self, node):
+        children = []
+        child = self.first_children[node]
+        while child != NO_NODE:
+            children.append(child)
+            child = self.next_siblings[child]
+        return children
+
+    def get_char(self, node):
+        code = self.chars[node]
+        return self.alphabet[code] if code != NO_NODE else ''
+
+    def add_branch(self, parent, word, quals, counts):
         """
-        Adding a word in the trie structure
+        Adds word, given as ASCII bytes, as a new chain of nodes below parent, which must not already have a child for
+        word[0].
+        """
+
+        n_bases = len(BASES)
+        first_node = len(self.chars)
+        n_nodes = len(word)
+        next_nodes = range(first_node + 1, first_node + n_nodes)
+
+        codes = list(word.translate(BASE_CODES))
+        if max(codes) >= n_bases:
+            codes = [code if code < n_bases else self.get_char_code(chr(byte)) for code, byte in zip(codes, word)]
+
+        self.chars.extend(codes)
+        self.parents.append(parent)
+        self.parents.extend(range(first_node, first_node + n_nodes - 1))
+        self.depths.extend(range(self.depths[parent] + 1, self.depths[parent] + n_nodes + 1))
+        self.quals.extend(quals)
+        self.counters.extend(counts)
+        self.word_counts.extend((0,) * n_nodes)
+        self.total_lifetime_children.extend((1,) * (n_nodes - 1))
+        self.total_lifetime_children.append(0)
+        self.child_index.extend((NO_NODE,) * (n_bases * n_nodes))
+        self.first_children.extend(next_nodes)
+        self.first_children.append(NO_NODE)
+        self.last_children.extend(next_nodes)
+        self.last_children.append(NO_NODE)
+        self.next_siblings.extend((NO_NODE,) * n_nodes)
+
+        for node, code in zip(range(first_node, first_node + n_nodes - 1), codes[1:]):
+            if code < n_bases:
+                self.child_index[node * n_bases + code] = node + 1
+
+        code = codes[0]
+        if code < n_bases:
+            self.child_index[parent * n_bases + code] = first_node
+        if self.first_children[parent] == NO_NODE:
+            self.first_children[parent] = first_node
+        else:
+            self.next_siblings[self.last_children[parent]] = first_node
+        self.last_children[parent] = first_node
+        self.total_lifetime_children[parent] += 1
+
+        return first_node + n_nodes - 1
+
+    def add(self, word, quals):
+        """
+        Adding a word in the trie structure. The word can be a str or ASCII bytes, and quals any sequence of integers.
         """
 
         if len(word) != len(quals):
             print("Added word and character quality vectors ahve different lengths")
             sys.exit()
 
-        node = self.root
-        for i in range(len(word)):
-            char = word[i]
-            qual = quals[i]
-            found_in_child = False
-            # Search for the character in the children of the present `node`
-
-            if char in node.children:
-                child = node.children[char]
-                child.counter += 1
-                child.qual += qual
-                node = child
+        child_index, counters, node_quals = self.child_index, self.counters, self.quals
+        n_bases = len(BASES)
+
+        if isinstance(word, str):
+            word = word.encode('ascii', 'replace')
+
+        node = ROOT
+        path = []
+        for i, code in enumerate(word.translate(BASE_CODES)):
+
+            if code < n_bases:
+                child = child_index[node * n_bases + code]
             else:
-                new_node = TrieNode(char, node)
-                new_node.qual += qual
-                node.children[char] = new_node
-                node.total_lifetime_children += 1
-                node = new_node
+                child = self.get_child(node, chr(word[i]))
+
+            if child == NO_NODE:
+                node = self.add_branch(node, word[i:], quals[i:], (1,) * (len(word) - i))
+                break
 
-        node.word_count += 1
+            path.append(child)
+            node = child
+
+        for child, qual in zip(path, quals):
+            counters[child] += 1
+            node_quals[child] += qual
+
+        self.word_counts[node] += 1
 
     def load(self, word, quals, counts):
         """
@@ -67,56 +203,65 @@ class Trie:
             print("Loading values have different lengths")
             sys.exit()
 
-        node = self.root
-        for i in range(len(word)):
-            char = word[i]
-            qual = quals[i]
-            count = counts[i]
-            found_in_child = False
-            # Search for the character in the children of the present `node`
-
-            if char in node.children:
-                child = node.children[char]
-                node = child
+        child_index = self.child_index
+        n_bases = len(BASES)
+
+        if isinstance(word, str):
+            word = word.encode('ascii', 'replace')
+
+        node = ROOT
+        for i, code in enumerate(word.translate(BASE_CODES)):
+
+            if code < n_bases:
+                child = child_index[node * n_bases + code]
             else:
-                new_node = TrieNode(char, node)
-                new_node.qual = qual
-                new_node.counter = count
-                node.children[char] = new_node
-                node.total_lifetime_children += 1
-                node = new_node
+                child = self.get_child(node, chr(word[i]))
+
+            if child == NO_NODE:
+                self.add_branch(node, word[i:], quals[i:len(word)], counts[i:len(word)])
+                break
+
+            node = child
 
     def make_subtrie(self, words):
         subtrie = Trie()
 
         for word in words:
-            trie_node = self.root
-            subtrie_node = subtrie.root
+            trie_node = ROOT
+            subtrie_node = ROOT
 
             for char in word:
 
-                trie_child = trie_node.children[char]
-
-                if char in subtrie_node.children:
-                    subtrie_child = subtrie_node.children[char]
-
-                else:
-                    subtrie_child = TrieNode(char, subtrie_node)
-
-                    subtrie_child.qual = trie_child.qual
-                    subtrie_child.word_count = trie_child.word_count
-                    subtrie.total_words += trie_child.word_count
+                trie_child = self.get_child(trie_node, char)
+                subtrie_child = subtrie.get_child(subtrie_node, char)
 
-                    subtrie_node.children[char] = subtrie_child
-                    subtrie_node.total_lifetime_children = len(subtrie_node.children)
+                if subtrie_child == NO_NODE:
+                    subtrie_child = subtrie.new_node(subtrie.get_char_code(char), subtrie_node)
 
+                    subtrie.quals[subtrie_child] = self.quals[trie_child]
+                    subtrie.word_counts[subtrie_child] = self.word_counts[trie_child]
+                    subtrie.total_words += self.word_counts[trie_child]
 
                 trie_node = trie_child
                 subtrie_node = subtrie_child
 
-
         return subtrie
 
+    def calc_total_subtrie_words(self, words):
+        """Returns the total_words of make_subtrie(words) without building the subtrie."""
+
+        visited = set()
+        total_words = 0
+
+        for word in words:
+            node = ROOT
+            for char in word:
+                node = self.get_child(node, char)
+                if node not in visited:
+                    visited.add(node)
+                    total_words += self.word_counts[node]
+
+        return total_words
 
     def load_words(self, words, quals, counts):
 
@@ -124,152 +269,136 @@ class Trie:
             word, qual, count = words[i], quals[i], counts[i]
             self.load(word, qual, count)
 
-
     def find_prefix(self, prefix: str) -> Tuple[bool, int]:
         """
         Check and return
           1. If the prefix exists in any of the words we added so far
           2. If yes then how may words actually have the prefix
         """
-        node = self.root
         # If the root node has no children, then return False.
         # Because it means we are trying to search in an empty trie
-        if not self.root.children:
+        if self.first_children[ROOT] == NO_NODE:
             return False, 0
+
+        node = ROOT
         for char in prefix:
-            char_not_found = True
-            # Search through all the children of the present `node`
-            for child in node.children:
-                if child.char == char:
-                    # We found the char existing in the child.
-                    char_not_found = False
-                    # Assign node as the child containing the char and break
-                    node = child
-                    break
-            # Return False anyway when we did not find a char.
-            if char_not_found:
+            node = self.get_child(node, char)
+            if node == NO_NODE:
                 return False, 0
-        # Well, we are here means we have found the prefix. Return true to indicate that
-        # And also the counter of the last node. This indicates how many words have this
-        # prefix
-        return True, node.counter
 
-    def traverse_seqs(self, prefix='', node=None):
-        if node is None:
-            node = self.root
+        return True, self.counters[node]
 
-        word = prefix + node.char
+    def get_leaves(self):
+        """Returns the leaf nodes in depth-first order, visiting children in the order they were added."""
 
-        if len(node.children) == 0:
-            return [word]
+        leaves = []
+        stack = [ROOT]
+        while stack:
+            node = stack.pop()
+            child = self.first_children[node]
 
-        words = []
-        for child in node.children.values():
-            words = words + self.traverse_seqs(word, child)
+            if child == NO_NODE:
+                leaves.append(node)
+                continue
 
-        return words
-
-    def traverse_quals(self, prefix=[], node=None):
-        if node is None:
-            node = self.root
-            qual = []
-        else:
-            qual = prefix + [node.qual]
+            children = []
+            while child != NO_NODE:
+                children.append(child)
+                child = self.next_siblings[child]
+            stack.extend(reversed(children))
 
-        if len(node.children) == 0:
-            return [qual]
+        return leaves
 
-        quals = []
-        for child in node.children.values():
-            quals = quals + self.traverse_quals(qual, child)
-
-        return quals
-
-    def traverse_counts(self, prefix=[], node=None):
-        if node is None:
-            node = self.root
-            count = []
-        else:
-            count = prefix + [node.counter]
+    def get_path(self, node):
+        path = []
+        while node != ROOT:
+            path.append(node)
+            node = self.parents[node]
+        path.reverse()
+        return path
 
-        if len(node.children) == 0:
-            return [count]
+    def traverse_seqs(self):
+        return [seq for seq, quals, counts in self.traverse_all()]
 
-        counts = []
-        for child in node.children.values():
-            counts = counts + self.traverse_counts(count, child)
+    def traverse_quals(self):
+        return [quals for seq, quals, counts in self.traverse_all()]
 
-        return counts
+    def traverse_counts(self):
+        return [counts for seq, quals, counts in self.traverse_all()]
 
     def traverse_all(self):
 
-        seqs = self.traverse_seqs()
-        quals = self.traverse_quals()
-        counts = self.traverse_counts()
+        alphabet, chars, quals, counters = self.alphabet, self.chars, self.quals, self.counters
 
-        all = list(zip(seqs, quals, counts))
-        return(all)
+        all = []
+        for leaf in self.get_leaves():
+            path = self.get_path(leaf)
+            all.append((''.join([alphabet[chars[node]] for node in path]),
+                        [quals[node] for node in path],
+                        [counters[node] for node in path]))
+        return all
 
     def calc_total_words(self, word):
         total_words = 0
-        node = self.root
+        node = ROOT
 
         for c in word:
-            total_words += node.children[c].word_count
-            node = node.children[c]
+            node = self.get_child(node, c)
+            total_words += self.word_counts[node]
 
         return total_words
 
     def calc_total_words_before_lifetime_child(self, word):
         total_words = 0
-        node = self.root
+        node = ROOT
 
         for c in word:
-            if node.total_lifetime_children > 1:
+            if self.total_lifetime_children[node] > 1:
                 break
-            total_words += node.children[c].word_count
-            node = node.children[c]
+            node = self.get_child(node, c)
+            total_words += self.word_counts[node]
 
         return total_words
 
     def calc_total_shared_words(self, word1, word2):
 
         shared_words = 0
-        node = self.root
+        node = ROOT
 
         for i in range(min([len(word1), len(word2)])):
             c1, c2 = word1[i], word2[i]
             if c1 != c2:
                 break
-            else:
-                shared_words += node.children[c1].word_count
 
-            node = node.children[c1]
+            node = self.get_child(node, c1)
+            shared_words += self.word_counts[node]
 
         return shared_words
 
     def calc_total_unique_shared_words(self, word1, word2):
 
         shared_words = 0
-        node = self.root
+        node = ROOT
 
         for i in range(min([len(word1), len(word2)])):
             c1, c2 = word1[i], word2[i]
             if c1 != c2:
                 break
-            elif len(node.children) > 1:
-                shared_words = node.children[c1].word_count
+
+            child = self.get_child(node, c1)
+            if len(self.get_children(node)) > 1:
+                shared_words = self.word_counts[child]
             else:
-                shared_words += node.children[c1].word_count
+                shared_words += self.word_counts[child]
 
-            node = node.children[c1]
+            node = child
 
         return shared_words
 
     def calc_total_unique_words(self, word1, word2):
 
         unique_words = 0
-        node = self.root
+        node = ROOT
 
         same_path = True
         for i in range(len(word1)):
@@ -277,67 +406,84 @@ class Trie:
             if i >= len(word2) or c1 != word2[i]:
                 same_path = False
 
+            node = self.get_child(node, c1)
             if not same_path:
-                unique_words += node.children[c1].word_count
+                unique_words += self.word_counts[node]
 
-            node = node.children[c1]
         return unique_words
 
+    def remove_child(self, parent, child):
+        code = self.chars[child]
+        if code < len(BASES):
+            self.child_index[parent * len(BASES) + code] = NO_NODE
+
+        previous = NO_NODE
+        node = self.first_children[parent]
+        while node != child:
+            previous, node = node, self.next_siblings[node]
+
+        if previous == NO_NODE:
+            self.first_children[parent] = self.next_siblings[child]
+        else:
+            self.next_siblings[previous] = self.next_siblings[child]
+        if self.last_children[parent] == child:
+            self.last_children[parent] = previous
+
     def delete_word(self, word):
-        node = self.root
+        node = ROOT
         for char in word:
-            node = node.children[char]
+            node = self.get_child(node, char)
 
         while True:
-            parent_node = node.parent
+            parent_node = self.parents[node]
 
-            if parent_node.char == '' or len(parent_node.children) > 1:
-                del parent_node.children[char]
+            if parent_node == ROOT or len(self.get_children(parent_node)) > 1:
+                self.remove_child(parent_node, node)
                 break
 
-            del parent_node.children[char]
+            self.remove_child(parent_node, node)
             node = parent_node
-            char = node.char
 
     def calc_word_count_diff(self, word1, word2):
 
-        node = self.root
+        node = ROOT
 
     def make_consensus_word(self, mincount):
+        """
+        Builds a consensus by taking, at every depth, the character with the highest summed quality over all nodes at
+        that depth, or N when several characters tie. Stops at the first depth whose summed counts fall below mincount.
+        """
 
-        total_count = sys.maxsize
-        current_position_nodes = set([self.root])
+        depths = np.frombuffer(self.depths, dtype=np.int32)[1:]
+        chars = np.frombuffer(self.chars, dtype=np.int32)[1:]
 
-        consensus = ''
-        while len(current_position_nodes) > 0:
+        if len(depths) == 0:
+            return ''
+
+        max_depth = depths.max()
+        depth_counts = np.zeros(max_depth + 1, dtype=np.int64)
+        np.add.at(depth_counts, depths, np.frombuffer(self.counters, dtype=np.int64)[1:])
 
-            total_count = 0
-            next_position_nodes = set()
-            charquals = defaultdict(int)
+        char_quals = np.zeros((max_depth + 1, len(self.alphabet)), dtype=np.int64)
+        np.add.at(char_quals, (depths, chars), np.frombuffer(self.quals, dtype=np.int64)[1:])
 
-            # Add up char qualities and counts
-            for n in current_position_nodes:
-                charquals[n.char] += n.qual
-                total_count += n.counter
-                if n == self.root:
-                    total_count = sys.maxsize
+        char_present = np.zeros((max_depth + 1, len(self.alphabet)), dtype=bool)
+        char_present[depths, chars] = True
+
+        consensus = ''
+        for depth in range(1, max_depth + 1):
 
-            if total_count < mincount:
+            if depth_counts[depth] < mincount:
                 break
 
-            # Get the next consensus character
-            best_chars = self.get_best_qual_chars(charquals)
+            present_quals = char_quals[depth][char_present[depth]]
+            best_qual = present_quals.max()
+            best_chars = np.flatnonzero(char_present[depth] & (char_quals[depth] == best_qual))
+
             if len(best_chars) > 1:
                 consensus += 'N'
             else:
-                consensus += best_chars.pop()
-
-            # Load up the next level of nodes
-            for n in current_position_nodes:
-                for char in n.children:
-                    next_position_nodes.add(n.children[char])
-
-            current_position_nodes = next_position_nodes
+                consensus += self.alphabet[best_chars[0]]
 
         return consensus
 
@@ -362,4 +508,4 @@ if __name__ == "__main__":
     print(trie.calc_total_shared_words('hellothere', 'hellothen'))
     print(trie.calc_total_unique_words('hellothere', 'hellothen'))
     print(trie.calc_total_unique_words('hellothen', 'hellothere'))
-    print(trie.calc_total_words_before_lifetime_child('hellothen'))
\ No newline at end of file
+    print(trie.calc_total_words_before_lifetime_child('hellothen'))
@@ -2,10 +2,9 @@ import warnings
 warnings.filterwarnings("ignore")
 import sys
 import click
-from mustache import bwatools, samtools
+from mustache import bwatools, samtools, processtools
 from os.path import dirname, basename, join, isfile
 import pysam
-from snakemake import shell
 import pygogo as gogo
 
 verbose=True
@@ -51,7 +50,7 @@ def format_for_mustache(in_sam, out_bam, read_format='rb', delete_in_sam=False):
     samfile.close()
     outbam.close()
     if delete_in_sam:
-        shell('rm {in_sam}'.format(in_sam=in_sam))
+        processtools.remove_files(in_sam)
 
     if isfile(out_bam):
         return out_bam
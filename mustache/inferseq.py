@@ -3,11 +3,9 @@ import pysam
 from collections import defaultdict, OrderedDict
 from os.path import join
 from random import randint
-from mustache import fastatools, bowtie2tools, pysamtools, sctools, misc
+from mustache import fastatools, bowtie2tools, pysamtools, sctools, referencestore, misc, processtools
 import pygogo as gogo
-from Bio import SeqIO
 import pandas as pd
-from snakemake import shell
 
 
 verbose=True
@@ -35,7 +33,7 @@ class InferSequence:
 
         self.pairs  = pairs
         self.genome_fasta = genome_fasta
-        self.genome_dict = {rec.id: rec.seq for rec in SeqIO.parse(genome_fasta, 'fasta')}
+        self.genome_dict = referencestore.ReferenceStore(genome_fasta)
         self.method_name = method_name
         self.tmp_dir = tmp_dir
 
@@ -52,7 +50,8 @@ class InferSequence:
         self.__align_pairs_to_fasta()
 
         if not self.keep_intermediate:
-            shell('rm {bam} {bam}.bai'.format(bam=self.bam.filename.decode('utf-8')))
+            bam_path = self.bam.filename.decode('utf-8')
+            processtools.remove_files(bam_path, bam_path + '.bai')
 
         self.__prefilter_reads()
 
@@ -87,7 +86,7 @@ class InferSequence:
 
 
         if not self.keep_intermediate:
-            shell('rm {fasta}'.format(fasta=fasta_prefix+'.fasta'))
+            processtools.remove_files(fasta_prefix + '.fasta')
 
 
     def get_flanks(self):
@@ -147,7 +146,7 @@ class InferSequence:
 
     def get_inferred_sequence(self, forward_read, reverse_read, is_reverse):
         contig, start, end = forward_read.reference_name, forward_read.reference_start, reverse_read.reference_end
-        inferred_sequence = ''.join(self.genome_dict[contig][start:end])
+        inferred_sequence = self.genome_dict[contig][start:end]
 
         inferred_sequence = sctools.left_softclipped_sequence_strict(forward_read) + \
                             inferred_sequence + \
@@ -8,14 +8,14 @@ from mustache import bowtie2tools
 from mustache import sctools
 from mustache import misc
 from mustache import pysamtools
+from mustache import pileupconsensus
+from mustache import referencestore
 from mustache.inferseq import InferSequence, AlignedPairs
 import pygogo as gogo
 import pysam
-from Bio import SeqIO
 from collections import OrderedDict
 from os.path import dirname, join
 from random import randint
-from snakemake import shell
 from collections import defaultdict
 
 verbose=True
@@ -80,22 +80,25 @@ class InferSequenceContext(InferSequence):
 
         self.ref_bam = pysam.AlignmentFile(ref_bam, 'rb')
         self.context_width = context_width
-        self.ref_genome_dict = {rec.id: rec.seq for rec in SeqIO.parse(ref_genome_fasta, 'fasta')}
+        self.ref_genome_dict = referencestore.ReferenceStore(ref_genome_fasta)
 
         self.all_aligned_pairs = defaultdict(AlignedPairsContext)
 
 
     def get_flanks(self):
 
-        context_flanks = []
+        windows = []
         for index, p in self.pairs.iterrows():
-            pair_id, contig_name, pos_5p, pos_3p, seq_5p, seq_3p = p['pair_id'], p['contig'], p['pos_5p'], p['pos_3p'], \
-                                                                   p['seq_5p'], p['seq_3p']
+            contig_name, pos_5p, pos_3p = p['contig'], p['pos_5p'], p['pos_3p']
+            windows.append(self.get_context_window(contig_name, pos_5p - self.context_width, pos_5p))
+            windows.append(self.get_context_window(contig_name, pos_3p + 1, pos_3p + 1 + self.context_width))
+
+        contexts = pileupconsensus.get_window_consensus(self.ref_bam, windows)
+
+        context_flanks = []
+        for (index, p), context_5p, context_3p in zip(self.pairs.iterrows(), contexts[0::2], contexts[1::2]):
+            pair_id, seq_5p, seq_3p = p['pair_id'], p['seq_5p'], p['seq_3p']
             seq_5p, seq_3p = seq_5p.rstrip('N'), seq_3p.lstrip('N')
-            context_5p = self.get_sequence_context(self.ref_genome_dict[contig_name], contig_name,
-                                                   pos_5p - self.context_width, pos_5p)
-            context_3p = self.get_sequence_context(self.ref_genome_dict[contig_name], contig_name,
-                                                   pos_3p + 1, pos_3p + 1 + self.context_width)
 
             context_flanks.append({'pair_id': str(pair_id),
                                    'seq_5p': context_5p + seq_5p,
@@ -104,8 +107,9 @@ class InferSequenceContext(InferSequence):
         return context_flanks
 
 
-    def get_sequence_context(self, contig, contig_name, start, end):
+    def get_context_window(self, contig_name, start, end):
 
+        contig = self.ref_genome_dict[contig_name]
         add_start_n = 0
         add_end_n = 0
         if start < 0:
@@ -116,37 +120,7 @@ class InferSequenceContext(InferSequence):
             end = len(contig)
 
         reference_sequence = 'N' * add_start_n + contig[start:end] + 'N' * add_end_n
-        sequence_context_dict = initialize_sequence_context(reference_sequence, start, end)
-
-        for read in self.ref_bam.fetch(contig_name, start, end):
-
-            ref_positions = read.get_reference_positions(full_length=True)
-            read_query = read.query_sequence
-            read_qualities = read.query_qualities
-
-            i = 0
-            for pos in ref_positions:
-                if pos is not None and pos in sequence_context_dict:
-                    sequence_context_dict[pos][read_query[i]] += read_qualities[i]
-                i += 1
-
-        consensus = self.get_consensus_context(sequence_context_dict)
-        return consensus
-
-
-    def get_consensus_context(self, sequence_context_dict):
-        start, end = min(sequence_context_dict.keys()), max(sequence_context_dict.keys()) + 1
-        consensus = ''
-        for pos in range(start, end):
-            best_qual = 0
-            best_nuc = ''
-            for nuc in sequence_context_dict[pos]:
-                qual = sequence_context_dict[pos][nuc]
-                if qual > best_qual:
-                    best_qual = qual
-                    best_nuc = nuc
-            consensus += best_nuc
-        return consensus
+        return contig_name, start, end, reference_sequence
 
 
     def get_inferred_sequence(self, forward_read, reverse_read, is_reverse):
@@ -154,7 +128,7 @@ class InferSequenceContext(InferSequence):
         start = forward_read.reference_start
         end = reverse_read.reference_end
 
-        inferred_sequence = ''.join(self.genome_dict[contig][start:end])
+        inferred_sequence = self.genome_dict[contig][start:end]
 
         inferred_sequence = sctools.left_softclipped_sequence_strict(forward_read) + \
                             inferred_sequence + \
@@ -283,16 +257,6 @@ def get_inferred_sequences(pairs, genome_dict, add_softclipped_bases=False):
 
     return inferred_sequences
 
-def initialize_sequence_context(target_region, expanded_start, expanded_end):
-    target_region_reads = defaultdict(lambda: defaultdict(int))
-    i = 0
-    for pos in range(expanded_start, expanded_end):
-        target_region_reads[pos][target_region[i]] += 1
-        i += 1
-    return target_region_reads
-
-
-
 def index_genome(inferseq_assembly):
     if not bowtie2tools.genome_is_indexed(inferseq_assembly):
         logger.info("Indexing inferseq assembly...")
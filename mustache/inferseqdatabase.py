@@ -7,13 +7,14 @@ from mustache import bowtie2tools
 from mustache import sctools
 from mustache import misc
 from mustache import pysamtools
+from mustache import referencestore
+from mustache import processtools
 import pygogo as gogo
 import pysam
-from Bio import SeqIO
 from collections import OrderedDict
 from os.path import dirname, join
 from random import randint
-from snakemake import shell
+from glob import glob
 from collections import defaultdict
 
 verbose=True
@@ -30,7 +31,7 @@ def _inferseq_database(pairsfile, inferseq_database, min_perc_identity, max_inte
 
     index_database(inferseq_database)
 
-    database_dict = {rec.id: rec.seq for rec in SeqIO.parse(inferseq_database, 'fasta')}
+    database_dict = referencestore.ReferenceStore(inferseq_database)
 
     tmp_dir = dirname(output_file)
 
@@ -52,7 +53,7 @@ def _inferseq_database(pairsfile, inferseq_database, min_perc_identity, max_inte
                                                            min_perc_identity, max_internal_softclip_prop, max_edge_distance)
 
     if not keep_intermediate:
-        shell('rm {fasta_prefix}* {outbam}*'.format(fasta_prefix=assembly_flanks_fasta_prefix, outbam=assembly_outbam))
+        processtools.remove_files(*(glob(assembly_flanks_fasta_prefix + '*') + glob(assembly_outbam + '*')))
 
     method1 = make_dataframe(sequences_inferred_database, method='inferred_database')
 
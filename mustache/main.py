@@ -10,7 +10,7 @@ from mustache.inferseqoverlap import _inferseq_overlap
 from mustache.inferseqreference import _inferseq_reference
 from mustache.inferseqdatabase import _inferseq_database
 from mustache.formatbam import _formatbam
-from mustache.recall import _recall
+from mustache.recall import _recall, _recall_cohort
 from mustache.help import CustomHelp
 
 import pygogo as gogo
@@ -38,12 +38,21 @@ def cli():
 @click.option('--max_indel_ratio', '-maxir', default=0.03, help="For a softclipped site to be considered, the proportion of small insertions/deletions at this site must not be above this value. default=0.03")
 @click.option('--min_count_consensus', '-mcc', default=2, help="When building the consensus sequence, stop building consensus if read count drops below this cutoff. default=2")
 @click.option('--min_softclip_length', '-minlen', default=8, help="For a softclipped site to be considered, there must be at least one softclipped read of this length. default=8")
+@click.option('--one_pass/--no_one_pass', default=False, help="Collect unclipped read information while scanning the BAM file, instead of fetching reads at each candidate site afterwards. The results are the same. default=False")
+@click.option('--threads', '-t', default=1, help="The number of processors to run while finding flanks. The BAM file is split into regions that are searched in parallel. default=1")
+@click.option('--consensus_engine', '-ce', type=click.Choice(['trie', 'pwm']), default='trie', help="How consensus flank sequences are built. 'trie' builds them from a sequence trie, and 'pwm' builds the same sequences from a position weight matrix. default=trie")
+@click.option('--evidence_file', '-ef', default=None, help="Also save the read evidence at every softclipped site to this file, so that the filters can be re-run with --from_evidence. default=None")
+@click.option('--from_evidence', is_flag=True, default=False, help="Read BAMFILE as an evidence file saved with --evidence_file, and re-run the filters and consensus building without reading the BAM file. default=False")
+@click.option('--regions', '-r', type=click.Path(exists=True), default=None, help="A BED file of intervals. Only softclipped sites inside these intervals are searched for, and only reads overlapping them are read from the indexed BAM file. default=None")
+@click.option('--exclude', '-x', type=click.Path(exists=True), default=None, help="A BED file of intervals, such as rRNA operons or prophages, where softclipped sites are not searched for. Reads inside them are skipped. default=None")
 def findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_quality, min_alignment_inner_length,
-               min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, output_file):
+               min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, one_pass, threads,
+               consensus_engine, evidence_file, from_evidence, regions, exclude, output_file):
     """A click access point for the findflanks module. This is used for creating the command line interface."""
 
     _findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_quality, min_alignment_inner_length,
-                min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, output_file)
+                min_distance_to_mate, min_softclip_ratio, max_indel_ratio, min_count_consensus, output_file,
+                one_pass, threads, consensus_engine, evidence_file, from_evidence, regions, exclude)
 
 
 @cli.command(short_help="Pair identified flanks with each other to represent 5' and 3' ends of inserted sequence.", help_priority=2)
@@ -54,25 +63,30 @@ def findflanks(bamfile, min_softclip_length, min_softclip_count, min_alignment_q
 @click.option('--min_alignment_quality', '-minq', default=20, help="For a read to be considered, it must meet this alignment quality cutoff. default=20")
 @click.option('--min_alignment_inner_length', '-minial', default=21, help="If a read is softclipped on both ends, the aligned portion must be at least this long. Ideally, set this equal to 1 + maximum direct repeat length. default=21")
 @click.option('--max_junction_spanning_prop', '-maxjsp', default=0.15, help="Removes pairs where this proportion of readsextend across both insertion junctions without softclipping, an indication that the site is a duplicated region. default=0.15")
+@click.option('--pair_assignment', '-pa', type=click.Choice(['greedy', 'matching']), default='greedy', help="How flanks are assigned to pairs. 'greedy' takes pairs in order of priority, 'matching' keeps as many pairs as possible among flanks that compete for the same partners. default=greedy")
+@click.option('--ir_engine', '-ie', type=click.Choice(['einverted', 'native']), default='einverted', help="How inverted repeats at the flank termini are found. 'einverted' runs EMBOSS einverted on each pair. 'native' aligns all pairs within mustache; it is experimental, and its calls can differ from einverted's. default=einverted")
 @click.option('--output_file', '-o', default='mustache.pairflanks.tsv', help="The output file to save the results. default=mustache.pairflanks.tsv")
 def pairflanks(flanksfile, bamfile, genome, max_direct_repeat_length, min_alignment_quality,
-               min_alignment_inner_length, max_junction_spanning_prop, output_file=None):
+               min_alignment_inner_length, max_junction_spanning_prop, pair_assignment, ir_engine, output_file=None):
     _pairflanks(flanksfile, bamfile, genome, max_direct_repeat_length, min_alignment_quality,
-                min_alignment_inner_length, max_junction_spanning_prop, output_file)
+                min_alignment_inner_length, max_junction_spanning_prop, output_file, ir_engine, pair_assignment)
 
 
 @cli.command(help_priority=3)
 @click.argument('pairsfile', type=click.Path(exists=True))
 @click.argument('bamfile', type=click.Path(exists=True))
 @click.option('--threads', '-t', default=1, help="The number of processors to run while finding flank extensions. default=1")
+@click.option('--assembler', '-as', type=click.Choice(['minimus', 'native']), default='minimus', help="How the reads at each site are assembled. 'minimus' runs the AMOS minimus pipeline, and 'native' extends each flank in-process, without any external tools. default=minimus")
+@click.option('--batch_size', '-bs', type=click.IntRange(min=1), default=1, help="The number of pairs whose reads are assembled together in one AMOS run by the minimus assembler. Larger batches pay the start-up cost of the AMOS tools and BWA once for many pairs. default=1")
 @click.option('--output_file', '-o', default='mustache.extendpairs.tsv', help="The output file to save the results. default=mustache.extendpairs.tsv")
-def extendpairs(pairsfile, bamfile, threads, output_file=None):
+def extendpairs(pairsfile, bamfile, threads, assembler, batch_size, output_file=None):
     """
     Experimental. Extends the consensus flanks using a local assembly of paired end reads.
     BAM file must be processed using the 'formatbam' command first.
-    Requires an installation of the AMOS sequence assembly software: http://amos.sourceforge.net/wiki/index.php/AMOS
+    The default assembler requires an installation of the AMOS sequence assembly software:
+    http://amos.sourceforge.net/wiki/index.php/AMOS
     """
-    _extendpairs(pairsfile, bamfile, threads, output_file)
+    _extendpairs(pairsfile, bamfile, threads, output_file, assembler, batch_size)
 
 
 @cli.command(short_help='Infers the identity of an inserted sequence by aligning flank pairs to an assembled genome.', help_priority=4)
@@ -166,6 +180,21 @@ def recall(pairsfile, bamfile, min_alignment_quality, min_alignment_inner_length
     _recall(pairsfile, bamfile, min_alignment_quality, min_alignment_inner_length, output_file)
 
 
+@cli.command(short_help='Recall softclip counts and runthrough counts at specified pairflank insertions across many BAM files.', help_priority=10)
+@click.argument('pairsfile', type=click.Path(exists=True))
+@click.argument('bamfiles', type=click.Path(exists=True), nargs=-1)
+@click.option('--bam_manifest', '-bm', type=click.Path(exists=True), default=None, help="A file listing more BAM files to recall, one per line, either as a path or as a sample name and a path separated by a tab. default=None")
+@click.option('--min_alignment_quality', '-minq', default=20, help="For a read to be considered, it must meet this alignment quality cutoff. default=20")
+@click.option('--min_alignment_inner_length', '-minial', default=21, help="If a read is softclipped on both ends, the aligned portion must be at least this long. Ideally, set this equal to 1 + maximum direct repeat length. default=21")
+@click.option('--threads', '-t', type=click.IntRange(min=1), default=1, help="The number of BAM files to recall in parallel. default=1")
+@click.option('--output_format', '-of', type=click.Choice(['long', 'wide']), default='long', help="'long' writes one row per sample and site, with a sample column. 'wide' writes one row per site, with a column per sample and count. default=long")
+@click.option('--output_file', '-o', default='mustache.recall_cohort.tsv', help="The output file to save results to. default=mustache.recall_cohort.tsv")
+def recall_cohort(pairsfile, bamfiles, bam_manifest, min_alignment_quality, min_alignment_inner_length, threads,
+                  output_format, output_file):
+    _recall_cohort(pairsfile, bamfiles, bam_manifest, min_alignment_quality, min_alignment_inner_length, threads,
+                   output_format, output_file)
+
+
 if __name__ == '__main__':
 
     cli()
\ No newline at end of file
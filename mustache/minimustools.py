@@ -1,16 +1,19 @@
 import warnings
 warnings.filterwarnings("ignore")
 import sys
-from snakemake import shell
 import os
-from os.path import join, isfile
+from os.path import join
+from glob import glob
+from shutil import rmtree
 from Bio import SeqIO
 import pysam
-from mustache.bwatools import index_genome, align_to_genome_se
+from mustache.bwatools import index_genome, align_to_genome_se, add_sequence_to_secondary_alignment
 from mustache.sctools import left_softclipped_sequence_strict, right_softclipped_sequence_strict
 from mustache.misc import revcomp
+from mustache import processtools
 from mustache.pysamtools import query_qualities_to_phred
 from random import randint, sample
+from collections import defaultdict
 
 
 class MinimusAssembler:
@@ -27,9 +30,10 @@ class MinimusAssembler:
 
     bam_path = None
 
-    def __init__(self, reads, quals=None, outdir=None, outprefix=None, read_names=None):
+    def __init__(self, reads, quals=None, outdir=None, outprefix=None, read_names=None, timeout=600):
 
         self.outdir = outdir
+        self.timeout = timeout
         self.outprefix = outprefix
 
         if self.outdir is None:
@@ -54,66 +58,47 @@ class MinimusAssembler:
 
 
     def delete_files(self):
-        shell('rm -rf {reads} {quals} {afg} {align_seq_fasta} {align_sam} '
-              '{outprefix}.bnk {outprefix}.fasta'.format(outprefix=self.full_outprefix, afg=self.afg_path,
-                                                         align_seq_fasta=self.align_seq_fasta_path,
-                                                         align_sam=self.align_sam_path, quals=self.quals_path,
-                                                         reads=self.reads_path))
+        processtools.remove_files(self.reads_path, self.quals_path, self.afg_path, self.align_seq_fasta_path,
+                                  self.align_sam_path, self.full_outprefix + '.fasta')
+        rmtree(self.full_outprefix + '.bnk', ignore_errors=True)
 
 
     def delete_afg_bank(self):
-        shell('rm -rf {afg} {outprefix}.bnk'.format(outprefix=self.full_outprefix, afg=self.afg_path))
+        processtools.remove_files(self.afg_path)
+        rmtree(self.full_outprefix + '.bnk', ignore_errors=True)
 
 
     def assemble(self, min_overlap_length=10, min_overlap_count=2, stranded=False):
+        """
+        Assembles the reads with the AMOS minimus pipeline and returns the path of the fasta of contigs. Each tool is
+        run once the previous one has exited, and an ExternalToolError is raised if any of them fails or runs past
+        the timeout.
+        """
         self.write_reads_as_fasta()
         self.delete_afg_bank()
 
-        #print("toAmos")
         bank_file = self.full_outprefix + '.bnk'
         if self.quals:
-            while not (isfile(self.reads_path) and isfile(self.quals_path)):
-                continue
-
-            shell("TMPDIR={tmpdir}; toAmos -s \"{reads_path}\" -q {quals_path} -o \"{afg_path}\" &> /dev/null;".format(
-                tmpdir=self.outdir, reads_path=self.reads_path, quals_path=self.quals_path, afg_path=self.afg_path), read=True)
+            processtools.run_command(['toAmos', '-s', self.reads_path, '-q', self.quals_path, '-o', self.afg_path],
+                                     timeout=self.timeout, env={'TMPDIR': self.outdir})
         else:
-            while not (isfile(self.reads_path) and isfile(self.quals_path)):
-                continue
+            processtools.run_command(['toAmos', '-s', self.reads_path, '-o', self.afg_path],
+                                     timeout=self.timeout, env={'TMPDIR': self.outdir})
 
-            shell("toAmos -s \"{reads_path}\" -o \"{afg_path}\" &> /dev/null;".format(
-                reads_path=self.reads_path, afg_path=self.afg_path), read=True)
-        #print("bank-transact")
-        while not isfile(self.afg_path):
-            continue
-
-        shell("bank-transact -f -z -b \"{bank_file}\" -m \"{afg_path}\" &> /dev/null;".format(
-            bank_file=bank_file, afg_path=self.afg_path), read=True)
-        #print("hash-overlap")
-
-        if stranded:
-            shell(
-                "hash-overlap -s -o {min_olen} -B \"{bank_file}\" &> /dev/null;".format(bank_file=bank_file,
-                                                                                        min_olen=min_overlap_length),
-                read=True)
-        else:
-            shell("hash-overlap -o {min_olen} -B \"{bank_file}\" &> /dev/null;".format(
-                bank_file=bank_file, min_olen=min_overlap_length), read=True)
+        processtools.run_command(['bank-transact', '-f', '-z', '-b', bank_file, '-m', self.afg_path],
+                                 timeout=self.timeout)
 
-        #print("tigger")
-        shell("tigger -b \"{bank_file}\" &> /dev/null;".format(bank_file=bank_file), read=True)
+        hash_overlap_flags = ['-s'] if stranded else []
+        processtools.run_command(['hash-overlap'] + hash_overlap_flags + ['-o', str(min_overlap_length), '-B',
+                                                                          bank_file], timeout=self.timeout)
 
-        #print("make-consensus")
-        shell("make-consensus -o {min_ocount} -B -b \"{bank_file}\" &> /dev/null".format(
-            bank_file=bank_file, min_ocount=min_overlap_count), read=True)
+        processtools.run_command(['tigger', '-b', bank_file], timeout=self.timeout)
 
-        #print("bank2fasta")
-        self.out_fasta = join(self.full_outprefix + '.fasta')
-        shell("bank2fasta -d -b \"{bank_file}\" > \"{out_fasta}\" 2> /dev/null;".format(
-            bank_file=bank_file, out_fasta=self.out_fasta), read=True)
+        processtools.run_command(['make-consensus', '-o', str(min_overlap_count), '-B', '-b', bank_file],
+                                 timeout=self.timeout)
 
-        while not isfile(self.out_fasta):
-            continue
+        self.out_fasta = self.full_outprefix + '.fasta'
+        processtools.run_command(['bank2fasta', '-d', '-b', bank_file], stdout=self.out_fasta, timeout=self.timeout)
 
         return self.out_fasta
 
@@ -175,43 +160,168 @@ class MinimusAssembler:
         self.write_seq_to_fasta(seq)
         index_genome(self.out_fasta)
         align_to_genome_se(self.align_seq_fasta_path, self.out_fasta, self.align_sam_path)
-        shell('rm -f %s.*' % self.out_fasta)
+        processtools.remove_files(*glob(self.out_fasta + '.*'))
 
 
     def retrieve_extended_sequence(self, orient):
         outsam = pysam.AlignmentFile(self.align_sam_path, 'r')
+        contigs = {contig.id: str(contig.seq) for contig in self.get_assembled_sequences()}
 
         extension = None
         for read in outsam:
             if read.is_unmapped:
                 return None
 
-            query_length = len(read.query_sequence)
-
-            current_contig = None
-            for contig in self.get_assembled_sequences():
-                if contig.id == read.reference_name:
-                    current_contig = str(contig.seq)
-
-            if orient == 'R' and (not read.is_reverse):
-                if len(current_contig) - read.reference_start <= query_length:
-                    return None
-                softclip = left_softclipped_sequence_strict(read)
-                extension = softclip + current_contig[read.reference_start:]
-            elif orient == 'R' and read.is_reverse:
-                if read.reference_end <= query_length:
-                    return None
-                softclip = right_softclipped_sequence_strict(read)
-                extension = revcomp(current_contig[:read.reference_end] + softclip)
-            elif orient == 'L' and (not read.is_reverse):
-                if read.reference_end <= query_length:
-                    return None
-                softclip = right_softclipped_sequence_strict(read)
-                extension = current_contig[:read.reference_end] + softclip
-            elif orient == 'L' and read.is_reverse:
-                if len(current_contig) - read.reference_start <= query_length:
-                    return None
-                softclip = left_softclipped_sequence_strict(read)
-                extension = revcomp(softclip + current_contig[read.reference_start:])
+            extension = get_seed_extension(read, contigs[read.reference_name], orient)
+            if extension is None:
+                return None
 
         return extension
+
+
+class MinimusBatchAssembler(MinimusAssembler):
+    """
+    Assembles the reads of many flanks in a single AMOS bank, so that the AMOS tools, the BWA index and the alignment
+    of the seed flanks are run once per batch rather than once per flank. Reads are named after their flank, and each
+    contig is given back to every flank that has reads in it. Flanks that share an element can therefore share a
+    contig; the alignment of each seed is only looked up among the contigs of its own flank.
+    """
+
+    def __init__(self, flank_reads, flank_quals=None, outdir=None, outprefix=None, timeout=600):
+
+        reads, quals, read_names = [], [], []
+        for flank_id in flank_reads:
+            reads += flank_reads[flank_id]
+            if flank_quals:
+                quals += flank_quals[flank_id]
+            read_names += ['%s_%d' % (flank_id, i) for i in range(len(flank_reads[flank_id]))]
+
+        MinimusAssembler.__init__(self, reads, quals if flank_quals else None, outdir=outdir, outprefix=outprefix,
+                                  read_names=read_names, timeout=timeout)
+
+        self.layout_path = self.full_outprefix + '.contig'
+        self.contigs_path = self.full_outprefix + '.contigs.fasta'
+        self.flank_contigs = None
+
+
+    def delete_files(self):
+        MinimusAssembler.delete_files(self)
+        processtools.remove_files(self.layout_path, self.contigs_path, *glob(self.contigs_path + '.*'))
+
+
+    def assemble(self, min_overlap_length=10, min_overlap_count=2, stranded=False):
+        """Assembles all of the reads, and splits the contigs between the flanks using the read layout of the bank."""
+        MinimusAssembler.assemble(self, min_overlap_length, min_overlap_count, stranded)
+        processtools.run_command(['bank2contig', '-b', self.full_outprefix + '.bnk'], stdout=self.layout_path,
+                                 timeout=self.timeout)
+
+        self.flank_contigs = defaultdict(list)
+        for contig_id, contig_seq, contig_read_names in read_contig_layout(self.layout_path):
+            for flank_id in sorted(set(read_name.rsplit('_', 1)[0] for read_name in contig_read_names)):
+                self.flank_contigs[flank_id].append(('%s_contig%s' % (flank_id, contig_id), contig_seq))
+
+        return self.flank_contigs
+
+
+    def extend_seeds(self, seeds):
+        """
+        Aligns every seed, given as {flank id: (sequence, orientation)}, to the contigs of all flanks at once, and
+        returns {flank id: extended sequence}, with None where a seed was not extended.
+        """
+
+        extensions = {flank_id: None for flank_id in seeds}
+        contig_seqs = {}
+        with open(self.contigs_path, 'w') as out:
+            for flank_id in self.flank_contigs:
+                for contig_name, contig_seq in self.flank_contigs[flank_id]:
+                    out.write('>%s\n%s\n' % (contig_name, contig_seq))
+                    contig_seqs[contig_name] = contig_seq
+        seeds_with_contigs = [flank_id for flank_id in seeds if flank_id in self.flank_contigs]
+        if len(seeds_with_contigs) == 0:
+            return extensions
+
+        with open(self.align_seq_fasta_path, 'w') as out:
+            for flank_id in seeds_with_contigs:
+                out.write('>%s\n%s\n' % (flank_id, seeds[flank_id][0]))
+
+        # With -a, bwa reports every hit of a seed, so that its hits to the contigs of its own flank are kept even when
+        # the best hit is to a contig of another flank. Secondary hits are written without a sequence, so it is added.
+        index_genome(self.contigs_path)
+        align_to_genome_se(self.align_seq_fasta_path, self.contigs_path, self.align_sam_path + '.tmp',
+                           additional_flags='-a')
+        add_sequence_to_secondary_alignment(self.align_sam_path + '.tmp', self.align_sam_path)
+        processtools.remove_files(self.align_sam_path + '.tmp')
+
+        best_scores = {}
+        for read in pysam.AlignmentFile(self.align_sam_path, 'r'):
+            flank_id = read.query_name
+            if read.is_unmapped or read.is_supplementary or read.query_sequence is None or \
+                    not read.reference_name.startswith(flank_id + '_contig'):
+                continue
+
+            score = read.get_tag('AS') if read.has_tag('AS') else 0
+            if flank_id in best_scores and score <= best_scores[flank_id]:
+                continue
+            best_scores[flank_id] = score
+            extensions[flank_id] = get_seed_extension(read, contig_seqs[read.reference_name], seeds[flank_id][1])
+
+        return extensions
+
+
+def get_seed_extension(read, contig_seq, orient):
+    """
+    Returns the seed flank, given as read, extended with the assembled contig it aligns to, in the orientation of the
+    seed. Returns None if the contig does not reach past the end of the seed.
+    """
+
+    query_length = len(read.query_sequence)
+
+    extension = None
+    if orient == 'R' and (not read.is_reverse):
+        if len(contig_seq) - read.reference_start <= query_length:
+            return None
+        softclip = left_softclipped_sequence_strict(read)
+        extension = softclip + contig_seq[read.reference_start:]
+    elif orient == 'R' and read.is_reverse:
+        if read.reference_end <= query_length:
+            return None
+        softclip = right_softclipped_sequence_strict(read)
+        extension = revcomp(contig_seq[:read.reference_end] + softclip)
+    elif orient == 'L' and (not read.is_reverse):
+        if read.reference_end <= query_length:
+            return None
+        softclip = right_softclipped_sequence_strict(read)
+        extension = contig_seq[:read.reference_end] + softclip
+    elif orient == 'L' and read.is_reverse:
+        if len(contig_seq) - read.reference_start <= query_length:
+            return None
+        softclip = left_softclipped_sequence_strict(read)
+        extension = revcomp(softclip + contig_seq[read.reference_start:])
+
+    return extension
+
+
+def read_contig_layout(layout_path):
+    """
+    Reads the TIGR contig format written by bank2contig, and yields the id, the ungapped consensus sequence and the
+    read names of each contig.
+    """
+
+    contig_id, seq_lines, read_names = None, [], []
+    in_contig_seq = False
+    with open(layout_path) as infile:
+        for line in infile:
+            line = line.strip()
+            if line.startswith('##'):
+                if contig_id is not None:
+                    yield contig_id, ''.join(seq_lines).replace('-', ''), read_names
+                contig_id, seq_lines, read_names = line[2:].split()[0], [], []
+                in_contig_seq = True
+            elif line.startswith('#'):
+                read_names.append(line[1:].split('(')[0])
+                in_contig_seq = False
+            elif in_contig_seq:
+                seq_lines.append(line)
+
+    if contig_id is not None:
+        yield contig_id, ''.join(seq_lines).replace('-', ''), read_names
@@ -3,6 +3,16 @@ warnings.filterwarnings("ignore")
 import sys
 from scipy.stats import poisson
 from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from jellyfish import levenshtein_distance
+import numpy as np
+import pygogo as gogo
+
+logger = gogo.Gogo(__name__, verbose=False).logger
+
+# Maps ASCII bytes to A, C, G, T = 0-3, in either case, and any other base to 4.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = np.arange(8) % 4
 
 
 def revcomp(read):
@@ -77,6 +87,152 @@ def takeClosestLarger(sorted_list, number):
 
 
 
+def bounded_levenshtein_distance(seq1, seq2, max_dist):
+    """Returns the Levenshtein distance between seq1 and seq2 if it is at most max_dist, and max_dist + 1 otherwise."""
+    return min(levenshtein_distance(seq1, seq2), max_dist + 1)
+
+
+try:
+    from mustache._editdistance import bounded_levenshtein_distance
+except ImportError:
+    logger.warning("The compiled mustache._editdistance module could not be imported, using the slower jellyfish "
+                   "distance. Install cython and reinstall mustache to build it.")
+
+
+class UnionFind:
+    """Disjoint sets over the integers 0 to n-1, with path halving and union by size."""
+
+    def __init__(self, n):
+        self.parents = list(range(n))
+        self.sizes = [1] * n
+
+    def find(self, i):
+        parents = self.parents
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return root_i
+        if self.sizes[root_i] < self.sizes[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parents[root_j] = root_i
+        self.sizes[root_i] += self.sizes[root_j]
+        return root_i
+
+
+def read_bed_file(bed_file):
+    """Returns the (contig, start, end) intervals in a BED file, skipping header, track and comment lines."""
+
+    intervals = []
+    with open(bed_file) as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) < 3 or line.startswith(('#', 'track', 'browser')):
+                continue
+            intervals.append((fields[0], int(fields[1]), int(fields[2])))
+    return intervals
+
+
+class IntervalIndex:
+    """
+    Half-open (start, end) intervals on each contig, merged and sorted by start, so that a position or a range can be
+    looked up with a binary search.
+    """
+
+    def __init__(self, intervals=()):
+        contig_intervals = OrderedDict()
+        for contig, start, end in intervals:
+            if end > start:
+                contig_intervals.setdefault(contig, []).append((start, end))
+
+        self.starts = OrderedDict()
+        self.ends = OrderedDict()
+        for contig, unmerged_intervals in contig_intervals.items():
+            starts, ends = [], []
+            for start, end in sorted(unmerged_intervals):
+                if len(ends) > 0 and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[contig] = starts
+            self.ends[contig] = ends
+
+    def contains(self, contig, pos):
+        starts = self.starts.get(contig)
+        if starts is None:
+            return False
+        i = bisect_right(starts, pos) - 1
+        return i >= 0 and pos < self.ends[contig][i]
+
+    def get_intervals(self, contig, start=None, end=None):
+        """Returns the intervals on a contig that overlap start to end, trimmed to that range."""
+
+        starts, ends = self.starts.get(contig, []), self.ends.get(contig, [])
+        first = 0 if start is None else bisect_right(ends, start)
+
+        intervals = []
+        for i in range(first, len(starts)):
+            if end is not None and starts[i] >= end:
+                break
+            interval_start = starts[i] if start is None else max(starts[i], start)
+            interval_end = ends[i] if end is None else min(ends[i], end)
+            intervals.append((interval_start, interval_end))
+        return intervals
+
+    def subtract(self, other):
+        """Returns a new IntervalIndex holding the parts of these intervals that are not covered by other."""
+
+        remaining = []
+        for contig in self.starts:
+            for start, end in zip(self.starts[contig], self.ends[contig]):
+                for other_start, other_end in other.get_intervals(contig, start, end):
+                    if other_start > start:
+                        remaining.append((contig, start, other_start))
+                    start = other_end
+                if start < end:
+                    remaining.append((contig, start, end))
+        return IntervalIndex(remaining)
+
+    def pad(self, margin, contig_lengths):
+        """Returns a new IntervalIndex with every interval extended by margin on both sides, within its contig."""
+
+        padded = []
+        for contig in self.starts:
+            for start, end in zip(self.starts[contig], self.ends[contig]):
+                padded.append((contig, max(start - margin, 0), min(end + margin, contig_lengths[contig])))
+        return IntervalIndex(padded)
+
+    def count_intervals(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+
+def group_overlapping_windows(windows):
+    """
+    Groups the indices of the non-empty (contig, start, end, ...) windows into runs of overlapping windows on the same
+    contig, so that each run can be fetched from a bam as one span. Runs are returned in sorted order.
+    """
+
+    order = sorted((w for w in range(len(windows)) if windows[w][2] > windows[w][1]),
+                   key=lambda w: (windows[w][0], windows[w][1]))
+
+    spans = []
+    span_contig, span_end = None, None
+    for w in order:
+        contig, start, end = windows[w][:3]
+        if contig != span_contig or start >= span_end:
+            spans.append((contig, []))
+            span_contig, span_end = contig, end
+        spans[-1][1].append(w)
+        span_end = max(span_end, end)
+
+    return spans
+
+
 if __name__ == "__main__":
     print(takeClosestSmaller([], 100), 100)
     print()
@@ -113,4 +269,4 @@ if __name__ == "__main__":
     print(takeClosestLarger([1, 2, 3], 2), 2)
     print(takeClosestLarger([1, 2, 3], 3), 3)
     print(takeClosestLarger([1, 2, 3], 4), 4)
-    print(takeClosestLarger([1, 2, 3], 5), 5)
\ No newline at end of file
+    print(takeClosestLarger([1, 2, 3], 5), 5)
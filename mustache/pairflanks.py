@@ -4,26 +4,28 @@ warnings.filterwarnings("ignore")
 import pygogo as gogo
 import pandas as pd
 import numpy as np
-from snakemake import shell
 from random import randint
-from mustache import fastatools, embosstools, pysamtools, sctools
+from mustache import fastatools, embosstools, pysamtools, sctools, flankir, pileupconsensus, referencestore, misc, \
+    processtools
 from os.path import basename, join, dirname
-from Bio import SeqIO
 import pysam
-from collections import defaultdict
+from scipy.optimize import linear_sum_assignment
+from collections import defaultdict, OrderedDict
 verbose=True
 logger = gogo.Gogo(__name__, verbose=verbose).logger
 
 
 def _pairflanks(flanksfile, bamfile, genome, max_direct_repeat_length, min_alignment_quality,
-                min_alignment_inner_length, max_junction_spanning_prop=0.15, output_file=None):
+                min_alignment_inner_length, max_junction_spanning_prop=0.15, output_file=None, ir_engine='einverted',
+                pair_assignment='greedy'):
     tmp_output_prefix = '.'.join(basename(output_file).split('.')[:-1])
 
     flanks = pd.read_csv(flanksfile, sep='\t')
     bam = pysam.AlignmentFile(bamfile, 'rb')
 
     flank_pairer = FlankPairer(flanks, bam, genome, max_direct_repeat_length, min_alignment_quality,
-                               min_alignment_inner_length, max_junction_spanning_prop,
+                               min_alignment_inner_length, max_junction_spanning_prop, ir_engine=ir_engine,
+                               pair_assignment=pair_assignment,
                                tmp_dir=dirname(output_file), tmp_output_prefix=tmp_output_prefix)
 
     if flanks.shape[0] == 0:
@@ -57,6 +59,8 @@ class FlankPairer:
     max_junction_spanning_prop = None
     truncated_flank_length = None
     ir_distance_from_end = None
+    ir_engine = None
+    pair_assignment = None
 
     insertion_spanning_length = None
 
@@ -69,7 +73,7 @@ class FlankPairer:
     def __init__(self, flanks, bam, genome, max_direct_repeat_length,
                  min_alignment_quality, min_alignment_inner_length, max_junction_spanning_prop,
                  truncated_flank_length=40, ir_distance_from_end=15, insertion_spanning_length=10,
-                 tmp_dir='/tmp', tmp_output_prefix='mustache'):
+                 ir_engine='einverted', pair_assignment='greedy', tmp_dir='/tmp', tmp_output_prefix='mustache'):
         self.flanks = flanks
         self.bam = bam
         self.genome = genome
@@ -80,6 +84,8 @@ class FlankPairer:
         self.truncated_flank_length = truncated_flank_length
         self.ir_distance_from_end = ir_distance_from_end
         self.insertion_spanning_length = insertion_spanning_length
+        self.ir_engine = ir_engine
+        self.pair_assignment = pair_assignment
 
         self.tmp_dir = tmp_dir
         self.tmp_output_prefix = tmp_output_prefix
@@ -88,21 +94,30 @@ class FlankPairer:
     def run_pair_flanks(self):
         logger.info("Finding all flank pairs within %d bases of each other ..." % self.max_direct_repeat_length)
         pairs = self.pair_all_nearby_flanks(self.flanks)
-        logger.info("Finding all inverted repeats at termini in %d candidate pairs..." % pairs.shape[0])
-        pairs = self.check_pairs_for_ir(pairs)
+
+        # Inverted repeats only decide between candidate pairs that share a flank. The search for them is by far the
+        # slowest step, so the other pairs are only searched once they have been assigned and filtered.
+        is_contested = self.get_contested_pairs(pairs)
+        logger.info("Finding all inverted repeats at termini in %d candidate pairs that share a flank..." % is_contested.sum())
+        pairs = self.check_pairs_for_ir(pairs, is_contested)
         logger.info("Assigning pairs according to existence of inverted repeats, read count difference, and flank length difference...")
         assigned_pairs = self.assign_pairs(pairs)
         logger.info("Filtering out pairs with evidence of reads spanning both clipped junctions...")
         analyzed_pairs = self.count_insertion_spanning_reads(assigned_pairs)
 
         logger.info("Identified %d flank pairs in total..." % analyzed_pairs.shape[0])
-        logger.info("Identified %d flank pairs with inverted repeats..." % analyzed_pairs.query('has_IR==True').shape[0])
         logger.info("Identified %d flank pairs with reads that span the insertion..." % analyzed_pairs.query('spanning_count > 0').shape[0])
 
         logger.info("Filtering sites with junction-spanning reads...")
         filtered_pairs = self.filter_junction_spanning(analyzed_pairs)
         logger.info("%d flank pairs remain after filtering..." % filtered_pairs.shape[0])
 
+        needs_ir = ~is_contested.loc[filtered_pairs.index]
+        logger.info("Finding all inverted repeats at termini in %d remaining pairs..." % needs_ir.sum())
+        filtered_pairs = self.check_pairs_for_ir(filtered_pairs, needs_ir)
+        filtered_pairs['IR_length'] = self.get_ir_lengths(filtered_pairs['IR_5p'])
+        logger.info("Identified %d flank pairs with inverted repeats..." % filtered_pairs.query('has_IR==True').shape[0])
+
 
         logger.info("Getting direct repeats and surrounding genomic region...")
         final_pairs = self.get_direct_repeats(filtered_pairs)
@@ -128,113 +143,145 @@ class FlankPairer:
 
 
     def pair_all_nearby_flanks(self, flanks):
-
+        # The 3' flanks are sorted by contig and position, so each 5' flank's candidates are one slice.
         column_names = ['contig', 'index_5p', 'index_3p', 'pos_5p', 'pos_3p', 'softclip_count_5p', 'softclip_count_3p',
                         'total_count_5p', 'total_count_3p']
 
         column_names += ['seq_5p', 'seq_3p']
 
-        outpairs = dict()
-
-        for index_5p, row in flanks.iterrows():
-
-            if row.orient != '5p':
-                continue
+        contig_codes = pd.factorize(flanks['contig'])[0].astype(np.int64)
+        positions = flanks['pos'].values.astype(np.int64)
+        orients = flanks['orient'].values
+        rows_5p = np.flatnonzero(orients == '5p')
+        rows_3p = np.flatnonzero(orients == '3p')
+
+        # Each contig gets its own range of keys, wide enough that the search window of a 5' flank never reaches
+        # into the range of another contig.
+        min_pos = positions.min() if len(positions) > 0 else 0
+        window = self.max_direct_repeat_length + 1
+        contig_span = (positions.max() - min_pos + window + 1) if len(positions) > 0 else 1
+        keys = contig_codes * contig_span + (positions - min_pos + window)
+
+        sorted_rows_3p = rows_3p[np.lexsort((rows_3p, keys[rows_3p]))]
+        sorted_keys_3p = keys[sorted_rows_3p]
+
+        first = np.searchsorted(sorted_keys_3p, keys[rows_5p] - window, side='left')
+        last = np.searchsorted(sorted_keys_3p, keys[rows_5p], side='left')
+        n_candidates = last - first
+
+        pair_rows_5p = np.repeat(rows_5p, n_candidates)
+        candidate_offsets = np.arange(n_candidates.sum()) - np.repeat(np.cumsum(n_candidates) - n_candidates,
+                                                                      n_candidates)
+        pair_rows_3p = sorted_rows_3p[np.repeat(first, n_candidates) + candidate_offsets]
+
+        order = np.lexsort((pair_rows_3p, pair_rows_5p))
+        pair_rows_5p, pair_rows_3p = pair_rows_5p[order], pair_rows_3p[order]
+
+        outpairs = OrderedDict()
+        outpairs['contig'] = flanks['contig'].values[pair_rows_5p]
+        outpairs['index_5p'] = flanks.index.values[pair_rows_5p]
+        outpairs['index_3p'] = flanks.index.values[pair_rows_3p]
+        outpairs['pos_5p'] = positions[pair_rows_5p]
+        outpairs['pos_3p'] = positions[pair_rows_3p]
+        outpairs['softclip_count_5p'] = flanks['consensus_softclip_count'].values[pair_rows_5p]
+        outpairs['softclip_count_3p'] = flanks['consensus_softclip_count'].values[pair_rows_3p]
+        outpairs['total_count_5p'] = flanks['total_count'].values[pair_rows_5p]
+        outpairs['total_count_3p'] = flanks['total_count'].values[pair_rows_3p]
+        outpairs['seq_5p'] = flanks['consensus_seq'].values[pair_rows_5p]
+        outpairs['seq_3p'] = flanks['consensus_seq'].values[pair_rows_3p]
+
+        outpairs = pd.DataFrame(outpairs, columns=column_names)
+        return outpairs
 
-            contig, pos_5p = row['contig'], row['pos']
-            softclip_count_5p, total_count_5p, seq_5p = row['consensus_softclip_count'], row['total_count'], row['consensus_seq']
 
-            min_pos = pos_5p - self.max_direct_repeat_length - 1
+    def get_contested_pairs(self, pairs):
+        return pairs['index_5p'].duplicated(keep=False) | pairs['index_3p'].duplicated(keep=False)
 
-            candidate_pairs = flanks.query('contig == @contig & pos >= @min_pos & pos < @pos_5p & orient == "3p"')
 
-            for index_3p, row2 in candidate_pairs.iterrows():
-                pos_3p, softclip_count_3p, total_count_3p, seq_3p = row2['pos'], row2['consensus_softclip_count'], \
-                                                                         row2['total_count'], row2['consensus_seq']
+    def check_pairs_for_ir(self, pairs, needs_ir=None):
+        # Pairs outside needs_ir keep their results, and repeated flank sequences are only searched once.
+        if needs_ir is None:
+            needs_ir = [True] * pairs.shape[0]
 
-                out = [contig, index_5p, index_3p, pos_5p, pos_3p, softclip_count_5p, softclip_count_3p, total_count_5p, total_count_3p]
+        if 'has_IR' in pairs.columns:
+            has_ir_all = list(pairs['has_IR'])
+            ir_5p_all = list(pairs['IR_5p'])
+            ir_3p_all = list(pairs['IR_3p'])
+        else:
+            has_ir_all = [False] * pairs.shape[0]
+            ir_5p_all = [None] * pairs.shape[0]
+            ir_3p_all = [None] * pairs.shape[0]
 
-                out += [seq_5p, seq_3p]
-                outpairs[len(outpairs)] =  out
+        combined_seqs = [None] * pairs.shape[0]
+        for i, (seq_5p, seq_3p, check_pair) in enumerate(zip(pairs['seq_5p'], pairs['seq_3p'], needs_ir)):
 
-        outpairs = pd.DataFrame.from_dict(outpairs, orient='index', columns=column_names)
-        return outpairs
+            if not check_pair:
+                continue
 
+            trunc_seq_5p = self.truncate_sequence(seq_5p, self.truncated_flank_length, orient='5p')
+            trunc_seq_3p = self.truncate_sequence(seq_3p, self.truncated_flank_length, orient='3p')
 
-    def check_pairs_for_ir(self, pairs):
+            combined_seqs[i] = str('N'*20).join([trunc_seq_5p, trunc_seq_3p])
 
-        has_ir_all = []
-        ir_5p_all = []
-        ir_3p_all = []
+        unique_seqs = list(OrderedDict.fromkeys(seq for seq in combined_seqs if seq is not None))
+        ir_results = dict(zip(unique_seqs, self.find_terminal_irs(unique_seqs)))
 
-        for index, row in pairs.iterrows():
+        for i, combined_seq in enumerate(combined_seqs):
+            if combined_seq is not None:
+                has_ir_all[i], ir_3p_all[i], ir_5p_all[i] = ir_results[combined_seq]
 
-            contig, index_5p, index_3p, pos_5p, pos_3p, softclip_count_5p, softclip_count_3p, \
-            runthrough_count_5p, runthrough_count_3p, seq_5p, seq_3p = row
+        pairs['has_IR'] = has_ir_all
+        pairs['IR_5p'] = ir_5p_all
+        pairs['IR_3p'] = ir_3p_all
 
-            trunc_seq_5p = self.truncate_sequence(seq_5p, self.truncated_flank_length, orient='5p')
-            trunc_seq_3p = self.truncate_sequence(seq_3p, self.truncated_flank_length, orient='3p')
+        return pairs
 
-            combined_seq = str('N'*20).join([trunc_seq_5p, trunc_seq_3p])
 
+    def find_terminal_irs(self, combined_seqs):
+        if self.ir_engine == 'einverted':
+            return [self.find_terminal_ir(combined_seq) for combined_seq in combined_seqs]
 
-            tmp_fasta_path = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.fasta')
-            fastatools.write_sequences_to_fasta([combined_seq], tmp_fasta_path)
+        return flankir.find_terminal_inverted_repeats(combined_seqs, self.ir_distance_from_end)
 
-            tmp_einverted_outfile = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.out')
-            tmp_einverted_outseq = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.fa')
-            embosstools.run_einverted(tmp_fasta_path, outfile=tmp_einverted_outfile, outseq=tmp_einverted_outseq)
 
-            has_ir = False
-            ir_length = 0
-            keep_ir1 = None
-            keep_ir2 = None
-            for ir1, ir2 in embosstools.read_emboss_seq_results(tmp_einverted_outseq):
-                if self.pair_has_ir(ir1, ir2, self.ir_distance_from_end, len(combined_seq)):
-                    has_ir = True
-                    if len(ir1.seq) > ir_length:
-                        keep_ir1 = ir1.seq
-                        keep_ir2 = ir2.seq
+    def find_terminal_ir(self, combined_seq):
+        tmp_fasta_path = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.fasta')
+        fastatools.write_sequences_to_fasta([combined_seq], tmp_fasta_path)
 
-            shell('rm -f %s' % tmp_fasta_path)
-            shell('rm -f %s' % tmp_einverted_outfile)
-            shell('rm -f %s' % tmp_einverted_outseq)
+        tmp_einverted_outfile = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.out')
+        tmp_einverted_outseq = join(self.tmp_dir, self.tmp_output_prefix + '.' + str(randint(0, 1e20)) + '.fa')
+        embosstools.run_einverted(tmp_fasta_path, outfile=tmp_einverted_outfile, outseq=tmp_einverted_outseq)
 
-            has_ir_all.append(has_ir)
-            ir_3p_all.append(keep_ir1)
-            ir_5p_all.append(keep_ir2)
+        has_ir = False
+        ir_length = 0
+        keep_ir1 = None
+        keep_ir2 = None
+        for ir1, ir2 in embosstools.read_emboss_seq_results(tmp_einverted_outseq):
+            if self.pair_has_ir(ir1, ir2, self.ir_distance_from_end, len(combined_seq)):
+                has_ir = True
+                if len(ir1.seq) > ir_length:
+                    keep_ir1 = ir1.seq
+                    keep_ir2 = ir2.seq
 
-        pairs['has_IR'] = has_ir_all
-        pairs['IR_5p'] = ir_5p_all
-        pairs['IR_3p'] = ir_3p_all
+        processtools.remove_files(tmp_fasta_path, tmp_einverted_outfile, tmp_einverted_outseq)
 
-        return pairs
+        return has_ir, keep_ir1, keep_ir2
 
 
     def assign_pairs(self, pairs):
         pairs.loc[:, 'direct_repeat_length'] = pairs.loc[:, 'pos_5p'] - pairs.loc[:, 'pos_3p'] -1
 
-        pairs['IR_length'] = np.array([len(seq) if seq is not None else 0 for seq in list(pairs.loc[:,'IR_5p'])])
+        pairs['IR_length'] = self.get_ir_lengths(pairs['IR_5p'])
         pairs['diffcount'] = abs(pairs['softclip_count_5p'] - pairs['softclip_count_3p'])
         pairs['difflength'] = abs(np.array(list(map(len, pairs['seq_5p']))) - np.array(list(map(len, pairs['seq_3p']))))
-        pairs['ignore_pair'] = False
         sorted_pairs = pairs.sort_values(['IR_length', 'diffcount', 'difflength'], ascending=[False, True, True])
 
-        keep_row = []
-
-        for index in sorted_pairs.index:
-            row = sorted_pairs.loc[index, :]
-
-            if not row['ignore_pair']:
-                keep_row.append(True)
-                index_5p, index_3p = row['index_5p'], row['index_3p']
-                has_pair_member = sorted_pairs.query("index_5p == @index_5p | index_3p == @index_3p")
-                has_pair_member_indices = has_pair_member.query("index_5p != @index_5p | index_3p != @index_3p").index.values
-                sorted_pairs.loc[has_pair_member_indices, 'ignore_pair'] = True
-            else:
-                keep_row.append(False)
+        if self.pair_assignment == 'matching':
+            keep_row = self.match_pairs(sorted_pairs)
+        else:
+            keep_row = self.greedy_assign_pairs(sorted_pairs)
 
-        sorted_pairs.loc[:, 'keep_pair'] = np.array(keep_row)
+        sorted_pairs.loc[:, 'keep_pair'] = keep_row
 
         assigned_pairs = sorted_pairs.query("keep_pair == True").loc[:,
                          self.get_header_list()].sort_values(['contig', 'pos_5p', 'pos_3p'])
@@ -242,6 +289,71 @@ class FlankPairer:
         return assigned_pairs
 
 
+    def greedy_assign_pairs(self, sorted_pairs):
+        used_flanks_5p = set()
+        used_flanks_3p = set()
+        keep_row = np.zeros(sorted_pairs.shape[0], dtype=bool)
+
+        for i, (index_5p, index_3p) in enumerate(zip(sorted_pairs['index_5p'].values, sorted_pairs['index_3p'].values)):
+            if index_5p not in used_flanks_5p and index_3p not in used_flanks_3p:
+                keep_row[i] = True
+                used_flanks_5p.add(index_5p)
+                used_flanks_3p.add(index_3p)
+
+        return keep_row
+
+
+    def match_pairs(self, sorted_pairs):
+        # Solved as an assignment problem for each group of flanks linked by candidate pairs.
+        keep_row = np.zeros(sorted_pairs.shape[0], dtype=bool)
+        if sorted_pairs.shape[0] == 0:
+            return keep_row
+
+        codes_5p = pd.factorize(sorted_pairs['index_5p'])[0]
+        codes_3p = pd.factorize(sorted_pairs['index_3p'])[0]
+        n_flanks_5p = codes_5p.max() + 1
+
+        flank_groups = misc.UnionFind(n_flanks_5p + codes_3p.max() + 1)
+        for code_5p, code_3p in zip(codes_5p, codes_3p):
+            flank_groups.union(code_5p, n_flanks_5p + code_3p)
+        pair_groups = np.array([flank_groups.find(code_5p) for code_5p in codes_5p])
+
+        # A single score that ranks pairs in the same order as the sort keys.
+        ir_lengths = sorted_pairs['IR_length'].values.astype(np.int64)
+        diffcounts = sorted_pairs['diffcount'].values.astype(np.int64)
+        difflengths = sorted_pairs['difflength'].values.astype(np.int64)
+        length_scale = difflengths.max() + 1
+        count_scale = (diffcounts.max() + 1) * length_scale
+        scores = ir_lengths * count_scale - diffcounts * length_scale - difflengths
+        costs = (scores.max() - scores).astype(np.float64)
+
+        group_order = np.argsort(pair_groups, kind='mergesort')
+        group_bounds = np.flatnonzero(np.diff(pair_groups[group_order])) + 1
+        for rows in np.split(group_order, group_bounds):
+
+            if len(rows) == 1:
+                keep_row[rows[0]] = True
+                continue
+
+            local_5p, group_codes_5p = np.unique(codes_5p[rows], return_inverse=True)
+            local_3p, group_codes_3p = np.unique(codes_3p[rows], return_inverse=True)
+
+            # Leaving a flank unpaired costs more than any set of real pairs, so as many pairs as possible are kept.
+            unpaired_cost = costs[rows].max() * min(len(local_5p), len(local_3p)) + 1
+            cost_matrix = np.full((len(local_5p), len(local_3p)), unpaired_cost)
+            cost_matrix[group_codes_5p, group_codes_3p] = costs[rows]
+
+            pair_rows = {(code_5p, code_3p): row for code_5p, code_3p, row in zip(group_codes_5p, group_codes_3p, rows)}
+            for code_5p, code_3p in zip(*linear_sum_assignment(cost_matrix)):
+                if (code_5p, code_3p) in pair_rows:
+                    keep_row[pair_rows[(code_5p, code_3p)]] = True
+
+        return keep_row
+
+
+    def get_ir_lengths(self, ir_seqs):
+        return np.array([len(seq) if seq is not None else 0 for seq in list(ir_seqs)])
+
     def pair_has_ir(self, ir1, ir2, ir_distance_from_end, seqlen):
         if self.ir_near_5prime_end(ir1, ir_distance_from_end) and self.ir_near_3prime_end(ir2, ir_distance_from_end, seqlen):
             return True
@@ -268,7 +380,7 @@ class FlankPairer:
 
     def get_direct_repeats(self, flank_pairs):
 
-        genome_dict = {rec.id: rec.seq for rec in SeqIO.parse(self.genome, 'fasta')}
+        genome_dict = referencestore.ReferenceStore(self.genome)
         positions = self.get_reference_direct_repeats(flank_pairs, genome_dict)
         positions = self.get_read_direct_repeats(positions, genome_dict)
 
@@ -279,7 +391,7 @@ class FlankPairer:
 
     def get_read_direct_repeats(self, positions, genome_dict, target_region_size=50):
 
-        direct_repeats = []
+        windows = []
         for index, row in positions.iterrows():
             contig, start, end = row['contig'], row['pos_3p'], row['pos_5p']
 
@@ -297,21 +409,15 @@ class FlankPairer:
                 expanded_end = len(genome_dict[contig])
 
             target_region = 'N' * add_start_n + genome_dict[contig][expanded_start:expanded_end] + 'N' * add_end_n
-            target_region_positions = range(expanded_start, expanded_end)
+            windows.append((contig, expanded_start, expanded_end, target_region))
 
-            target_region_reads = self.initialize_target_region_reads(target_region, expanded_start, expanded_end)
-            for read in self.bam.fetch(contig, expanded_start, expanded_end):
-                ref_positions = read.get_reference_positions(full_length=True)
-                read_query = read.query_sequence
-                read_qualities = read.query_qualities
+        consensus_target_regions = pileupconsensus.get_window_consensus(self.bam, windows)
 
-                i = 0
-                for pos in ref_positions:
-                    if pos is not None and pos in target_region_reads:
-                        target_region_reads[pos][read_query[i]] += read_qualities[i]
-                    i += 1
-
-            consensus_target_region = self.get_consensus_target_region(target_region_reads)
+        direct_repeats = []
+        for (index, row), window, consensus_target_region in zip(positions.iterrows(), windows,
+                                                                 consensus_target_regions):
+            start, end = row['pos_3p'], row['pos_5p']
+            target_region_positions = range(window[1], window[2])
             consensus_direct_repeat = consensus_target_region[target_region_positions.index((start+1)):target_region_positions.index(end)]
 
             direct_repeats.append(consensus_direct_repeat)
@@ -321,30 +427,6 @@ class FlankPairer:
         return positions
 
 
-    def get_consensus_target_region(self, target_region_reads):
-        start, end = min(target_region_reads.keys()), max(target_region_reads.keys())+1
-        consensus = ''
-        for pos in range(start, end):
-            best_qual = 0
-            best_nuc = ''
-            for nuc in target_region_reads[pos]:
-                qual = target_region_reads[pos][nuc]
-                if qual > best_qual:
-                    best_qual = qual
-                    best_nuc = nuc
-            consensus += best_nuc
-        return consensus
-
-
-    def initialize_target_region_reads(self, target_region, expanded_start, expanded_end):
-        target_region_reads = defaultdict(lambda: defaultdict(int))
-        i = 0
-        for pos in range(expanded_start, expanded_end):
-            target_region_reads[pos][target_region[i]] += 1
-            i += 1
-        return target_region_reads
-
-
     def get_reference_direct_repeats(self, flank_pairs, genome_dict, target_region_size=50):
         positions = flank_pairs.loc[:, ['contig', 'pos_5p', 'pos_3p']].drop_duplicates().reset_index(drop=True)
 
@@ -352,51 +434,55 @@ class FlankPairer:
         for index, row in positions.iterrows():
             contig, start, end = row['contig'], row['pos_3p'], row['pos_5p']
 
-            direct_repeat = genome_dict[contig][(start+1):end]
-            direct_repeats.append(''.join(direct_repeat))
+            direct_repeats.append(genome_dict[contig][(start+1):end])
 
         positions['direct_repeat_reference'] = direct_repeats
         return positions
 
 
     def count_insertion_spanning_reads(self, assigned_pairs):
-
-        spanning_reads = []
+        # Each span of overlapping windows is fetched once. A read counts for every window it spans.
         contig_lengths = pysamtools.get_bam_contig_dict(self.bam)
+        windows = []
         for index, row in assigned_pairs.iterrows():
-            spanning_read_names = set()
             contig, pos_3p, pos_5p = row['contig'], row['pos_3p'], row['pos_5p']
-            reads = self.get_reads_at_site(contig, pos_3p, pos_5p, self.bam, contig_lengths)
-
-            for read in reads:
-
-                if read.reference_start < pos_3p - self.insertion_spanning_length and \
-                    read.reference_end > pos_5p + self.insertion_spanning_length + 1:
-                    spanning_read_names.add(read.query_name)
+            start, end = max(pos_3p - 1, 0), min(pos_5p + 2, contig_lengths[contig])
+            windows.append((contig, start, end, pos_3p - self.insertion_spanning_length,
+                            pos_5p + self.insertion_spanning_length + 1))
+
+        spanning_reads = [0] * len(windows)
+        for contig, span_windows in misc.group_overlapping_windows(windows):
+            span_start = min(windows[w][1] for w in span_windows)
+            span_end = max(windows[w][2] for w in span_windows)
+            read_starts, read_ends, read_ids = self.get_reads_in_span(contig, span_start, span_end)
+            if len(read_starts) == 0:
+                continue
+            max_read_length = (read_ends - read_starts).max()
 
-            spanning_reads.append(len(spanning_read_names))
+            for w in span_windows:
+                contig, start, end, max_read_start, min_read_end = windows[w]
+                first = np.searchsorted(read_starts, start - max_read_length, side='left')
+                last = np.searchsorted(read_starts, min(end, max_read_start), side='left')
+                is_spanning = read_ends[first:last] > max(start, min_read_end)
+                spanning_reads[w] = len(np.unique(read_ids[first:last][is_spanning]))
 
         assigned_pairs['spanning_count'] = spanning_reads
         assigned_pairs = assigned_pairs.loc[:, self.get_header_list()]
         return assigned_pairs
 
-    def get_reads_at_site(self, contig, pos_3p, pos_5p, bam, contig_lengths):
-
-        reads = []
-
-        start = pos_3p - 1
-        end = pos_5p + 2
-
-        if start < 0:
-            start = 0
-        if end > contig_lengths[contig]:
-            end = contig_lengths[contig]
-
-        for read in bam.fetch(contig, start, end):
+    def get_reads_in_span(self, contig, start, end):
+        # Reads without an alignment end get the one-base end that bam.fetch gives them.
+        read_starts, read_ends, read_ids = [], [], []
+        name_ids = {}
+        for read in self.bam.fetch(contig, start, end):
             if self.passes_read_filters(read):
-                reads.append(read)
+                read_end = read.reference_end
+                read_starts.append(read.reference_start)
+                read_ends.append(read_end if read_end is not None else read.reference_start + 1)
+                read_ids.append(name_ids.setdefault(read.query_name, len(name_ids)))
 
-        return reads
+        return (np.array(read_starts, dtype=np.int64), np.array(read_ends, dtype=np.int64),
+                np.array(read_ids, dtype=np.int64))
 
 
     def passes_read_filters(self, read):
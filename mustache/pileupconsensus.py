@@ -0,0 +1,99 @@
+import warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+from mustache import misc
+
+# Each (position, base) cell is keyed as position * N_CHARS + base byte.
+N_CHARS = 256
+REFERENCE_RANK = -1
+
+
+def get_window_consensus(bam, windows):
+    """
+    Builds a read consensus for each (contig, start, end, prior_sequence) window. Every position of [start, end) starts
+    with a count of one for its base in prior_sequence, and every aligned read base adds its quality to its base at that
+    position. The consensus takes the base with the highest sum at each position. Ties go to the prior base, and then to
+    the base seen in the earliest read.
+
+    Windows are sorted and merged into spans, and each span is fetched from the bam just once, so overlapping windows
+    share their reads. Returns one consensus string per window, in the order of the windows.
+    """
+
+    consensus = [''] * len(windows)
+
+    for contig, span_windows in misc.group_overlapping_windows(windows):
+        span_start = min(windows[w][1] for w in span_windows)
+        span_end = max(windows[w][2] for w in span_windows)
+
+        positions, chars, quals, ranks = get_aligned_bases(bam, contig, span_start, span_end)
+        span_consensus = tally_window_consensus(
+            [windows[w] for w in span_windows], positions, chars, quals, ranks
+        )
+        for w, window_consensus in zip(span_windows, span_consensus):
+            consensus[w] = window_consensus
+
+    return consensus
+
+
+def get_aligned_bases(bam, contig, start, end):
+    """
+    Returns the reference position, base byte, quality and read rank of every aligned base of the reads fetched from
+    contig:start-end. Reads are ranked in the order they are fetched.
+    """
+
+    positions, chars, quals, ranks = [], [], [], []
+    for rank, read in enumerate(bam.fetch(contig, start, end)):
+        if read.query_sequence is None or read.query_qualities is None:
+            continue
+
+        aligned_pairs = np.array(read.get_aligned_pairs(matches_only=True), dtype=np.int64).reshape(-1, 2)
+        read_chars = np.frombuffer(read.query_sequence.encode('ascii', 'replace'), dtype=np.uint8)
+        read_quals = np.frombuffer(read.query_qualities, dtype=np.uint8)
+
+        positions.append(aligned_pairs[:, 1])
+        chars.append(read_chars[aligned_pairs[:, 0]])
+        quals.append(read_quals[aligned_pairs[:, 0]])
+        ranks.append(np.full(len(aligned_pairs), rank, dtype=np.int64))
+
+    if len(positions) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8),
+                np.zeros(0, dtype=np.int64))
+
+    return np.concatenate(positions), np.concatenate(chars), np.concatenate(quals), np.concatenate(ranks)
+
+
+def tally_window_consensus(windows, positions, chars, quals, ranks):
+    """
+    Sums the prior base counts and the read qualities of every window into one table of (window position, base) cells,
+    and picks the best base of every window position from it.
+    """
+
+    lengths = np.array([end - start for contig, start, end, prior_sequence in windows], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+
+    keys = [np.arange(lengths.sum(), dtype=np.int64) * N_CHARS + np.frombuffer(
+        ''.join(str(prior_sequence)[:end - start] for contig, start, end, prior_sequence in windows)
+        .encode('ascii', 'replace'), dtype=np.uint8)]
+    values = [np.ones(lengths.sum(), dtype=np.int64)]
+    cell_ranks = [np.full(lengths.sum(), REFERENCE_RANK, dtype=np.int64)]
+
+    for (contig, start, end, prior_sequence), offset in zip(windows, offsets):
+        in_window = (positions >= start) & (positions < end)
+        keys.append((offset + positions[in_window] - start) * N_CHARS + chars[in_window])
+        values.append(quals[in_window].astype(np.int64))
+        cell_ranks.append(ranks[in_window])
+
+    cells, cell_index = np.unique(np.concatenate(keys), return_inverse=True)
+    cell_index = cell_index.reshape(-1)
+    cell_quals = np.bincount(cell_index, weights=np.concatenate(values), minlength=len(cells))
+    first_ranks = np.full(len(cells), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_ranks, cell_index, np.concatenate(cell_ranks))
+
+    # Every window position has a prior cell, so the first cell of each position in this order is its consensus base.
+    cell_positions = cells // N_CHARS
+    order = np.lexsort((first_ranks, -cell_quals, cell_positions))
+    is_best = np.ones(len(order), dtype=bool)
+    is_best[1:] = cell_positions[order][1:] != cell_positions[order][:-1]
+    consensus_chars = (cells[order][is_best] % N_CHARS).astype(np.uint8).tobytes().decode('ascii')
+
+    return [consensus_chars[offset:offset + length] for offset, length in zip(offsets, lengths)]
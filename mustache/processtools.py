@@ -0,0 +1,142 @@
+import warnings
+warnings.filterwarnings("ignore")
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+import pygogo as gogo
+
+verbose=False
+logger = gogo.Gogo(__name__, verbose=verbose).logger
+
+STDERR_TAIL_LINES = 20
+
+
+class ExternalToolError(RuntimeError):
+    """Raised when an external tool cannot start, exits with an error, or runs past its timeout."""
+
+    def __init__(self, command, reason, stderr=b''):
+        self.command = command
+        self.reason = reason
+        self.stderr = stderr.decode('utf-8', 'replace') if isinstance(stderr, bytes) else stderr
+
+        message = "%s %s" % (' '.join(command), reason)
+        stderr_tail = self.stderr.strip().splitlines()[-STDERR_TAIL_LINES:]
+        if stderr_tail:
+            message += ':\n' + '\n'.join(stderr_tail)
+        RuntimeError.__init__(self, message)
+
+
+def run_command(command, stdout=None, stdin=None, timeout=None, env=None, cwd=None):
+    """
+    Runs command, a list of arguments, without a shell, and blocks until it exits. stdout and stdin may be paths to
+    write to and read from. If stdout is subprocess.PIPE, the output is returned as bytes. stderr is read through a
+    pipe and kept for the error message. Raises ExternalToolError on a non-zero exit code, or kills the tool and raises
+    it if it runs for more than timeout seconds.
+    """
+
+    logger.debug("Executing command: %s" % ' '.join(command))
+
+    with open_stream(stdout, 'wb', subprocess.DEVNULL) as stdout_handle, \
+            open_stream(stdin, 'rb', subprocess.DEVNULL) as stdin_handle:
+        try:
+            result = subprocess.run(command, stdout=stdout_handle, stdin=stdin_handle, stderr=subprocess.PIPE,
+                                    timeout=timeout, env=get_environment(env), cwd=cwd)
+        except subprocess.TimeoutExpired as error:
+            raise ExternalToolError(command, "timed out after %s seconds" % timeout, error.stderr or b'')
+        except OSError as error:
+            raise ExternalToolError(command, "could not be started (%s)" % error)
+
+    if result.returncode != 0:
+        raise ExternalToolError(command, "exited with code %d" % result.returncode, result.stderr)
+
+    return result.stdout if stdout == subprocess.PIPE else None
+
+
+def run_pipeline(commands, stdout=None, stdin=None, timeout=None, env=None, cwd=None):
+    """
+    Runs commands connected by pipes, as in 'command1 | command2 | ...', and blocks until all of them exit. stdout and
+    stdin apply to the last and first commands, as in run_command. Raises ExternalToolError for the first command that
+    fails, and kills the whole pipeline if it runs for more than timeout seconds.
+    """
+
+    logger.debug("Executing pipeline: %s" % ' | '.join(' '.join(command) for command in commands))
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    processes, stderr_files = [], []
+
+    with open_stream(stdout, 'wb', subprocess.DEVNULL) as stdout_handle, \
+            open_stream(stdin, 'rb', subprocess.DEVNULL) as stdin_handle:
+        try:
+            previous_stdout = stdin_handle
+            for i, command in enumerate(commands):
+                is_last = i == len(commands) - 1
+                stderr_file = tempfile.TemporaryFile()
+                stderr_files.append(stderr_file)
+                try:
+                    process = subprocess.Popen(command, stdin=previous_stdout,
+                                               stdout=stdout_handle if is_last else subprocess.PIPE,
+                                               stderr=stderr_file, env=get_environment(env), cwd=cwd)
+                except OSError as error:
+                    raise ExternalToolError(command, "could not be started (%s)" % error)
+                # Only the next process holds the read end, so it sees end of file when this one exits.
+                if i > 0:
+                    previous_stdout.close()
+                processes.append(process)
+                previous_stdout = process.stdout
+
+            for command, process, stderr_file in zip(commands, processes, stderr_files):
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    process.wait(timeout=remaining)
+                except subprocess.TimeoutExpired:
+                    raise ExternalToolError(command, "timed out after %s seconds" % timeout,
+                                            read_stderr(stderr_file))
+
+            for command, process, stderr_file in zip(commands, processes, stderr_files):
+                if process.returncode != 0:
+                    raise ExternalToolError(command, "exited with code %d" % process.returncode,
+                                            read_stderr(stderr_file))
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            for stderr_file in stderr_files:
+                stderr_file.close()
+
+    return None
+
+
+@contextmanager
+def open_stream(path, mode, default):
+    """Opens path for a subprocess stream, and passes through None (as default), pipes and open handles."""
+    if path is None:
+        yield default
+    elif isinstance(path, str):
+        with open(path, mode) as handle:
+            yield handle
+    else:
+        yield path
+
+
+def get_environment(env):
+    """Returns the current environment updated with env, or None to inherit it unchanged."""
+    if env is None:
+        return None
+    environment = dict(os.environ)
+    environment.update(env)
+    return environment
+
+
+def read_stderr(stderr_file):
+    stderr_file.seek(0)
+    return stderr_file.read()
+
+
+def remove_files(*paths):
+    """Removes each file that exists, like rm -f."""
+    for path in paths:
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
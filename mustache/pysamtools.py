@@ -1,6 +1,14 @@
 import warnings
 warnings.filterwarnings("ignore")
+from bisect import bisect_left
 from mustache.sctools import *
+from mustache import misc
+
+# The reads that bam.pileup() leaves out: unmapped, secondary, QC-failed and duplicate reads. With its default
+# ignore_orphans=True, it also leaves out paired reads that are not in a proper pair.
+PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+PAIRED_FLAG = 0x1
+PROPER_PAIR_FLAG = 0x2
 
 def get_left_softclipped_reads_at_site(bam_file, contig, left_site, get_quals=False, softclip_only=False):
     left_softclipped_reads = []
@@ -110,6 +118,92 @@ def get_left_unmapped_reads(bam_file, contig, left_site, get_quals=False, search
         return left_unmapped_reads
 
 
+def get_reads_to_assemble_at_sites(bam_file, sites, search_region_length=500, min_base_quality=13):
+    """
+    Gathers the reads to assemble at every (contig, site, orientation) in sites in one sweep over the bam. At an 'R'
+    site these are the reads right softclipped at the site, and the MT/MQ mate sequences of the forward reads with an
+    unmapped mate in the search_region_length bases before it. At an 'L' site, they are the reads left softclipped at
+    the site, and the mates of the reverse reads in the search_region_length bases after it.
+
+    This collects the reads of get_*_softclipped_reads_at_site and get_*_unmapped_reads without a pileup. Softclipped
+    reads are kept on the same terms as pileup keeps them: they must pass PILEUP_SKIP_FLAGS, must not be orphans (paired
+    but not in a proper pair), and must have a base quality of at least min_base_quality next to the site. Unlike
+    pileup, the qualities of overlapping mates are not adjusted, so a mate is not dropped, nor given zero qualities,
+    because it overlaps the other. Each site has a window of one search region, and overlapping windows are fetched
+    together as one span.
+
+    Returns (softclipped reads, softclipped qualities, unmapped reads, unmapped qualities) for each site, in the order
+    of the sites.
+    """
+
+    site_reads = [([], [], [], []) for site in sites]
+    contig_lengths = dict(zip(bam_file.references, bam_file.lengths))
+
+    windows = []
+    for i, (contig, site, orient) in enumerate(sites):
+        if orient == 'R':
+            windows.append((contig, max(site - search_region_length, 0), site, i))
+        else:
+            windows.append((contig, site + 1, min(site + 1 + search_region_length, contig_lengths[contig]), i))
+
+    for contig, span_windows in misc.group_overlapping_windows(windows):
+        # Every window has the same length unless it is cut by the end of the contig, so the windows of a span end in
+        # the same order as they start.
+        span_windows = sorted(span_windows, key=lambda w: windows[w][1:3])
+        window_starts = [windows[w][1] for w in span_windows]
+        window_ends = [windows[w][2] for w in span_windows]
+        first_window = 0
+
+        for read in bam_file.fetch(contig, window_starts[0], max(window_ends)):
+            read_start = read.reference_start
+            read_end = read.reference_end if read.reference_end is not None else read_start + 1
+
+            while first_window < len(span_windows) and window_ends[first_window] <= read_start:
+                first_window += 1
+            if first_window == len(span_windows):
+                break
+
+            profile = None
+            for w in span_windows[first_window:bisect_left(window_starts, read_end)]:
+                i = windows[w][3]
+                site, orient = sites[i][1:]
+                softclipped_reads, softclipped_quals, unmapped_reads, unmapped_quals = site_reads[i]
+
+                if read.mate_is_unmapped and read.is_reverse == (orient == 'L'):
+                    unmapped_reads.append(read.get_tag('MT'))
+                    unmapped_quals.append(read.get_tag('MQ'))
+
+                column = site - 1 if orient == 'R' else site + 1
+                if read.flag & PILEUP_SKIP_FLAGS or not read_start <= column < read_end:
+                    continue
+                if read.flag & PAIRED_FLAG and not read.flag & PROPER_PAIR_FLAG:
+                    continue
+
+                if profile is None:
+                    profile = get_clip_profile(read)
+                if orient == 'R' and not is_right_softclipped_lenient_at_site(read, contig, site, profile):
+                    continue
+                if orient == 'L' and not is_left_softclipped_lenient_at_site(read, contig, site, profile):
+                    continue
+                if get_base_quality_at(read, column) < min_base_quality:
+                    continue
+
+                softclipped_reads.append(read.query_sequence)
+                softclipped_quals.append(get_query_qualities_ascii(read, bam_file))
+
+    return site_reads
+
+
+def get_base_quality_at(read, ref_pos):
+    """Returns the quality of the read base aligned to ref_pos, or -1 if no base is aligned there."""
+    if read.query_qualities is None:
+        return -1
+    for query_pos, pair_ref_pos in read.get_aligned_pairs(matches_only=True):
+        if pair_ref_pos == ref_pos:
+            return read.query_qualities[query_pos]
+    return -1
+
+
 def contig_length(bam, contig):
     return dict(zip(bam.references, bam.lengths))[contig]
 
@@ -169,10 +263,7 @@ def query_qualities_to_phred(quals):
     return [ord(q)-33 for q in quals]
 
 def get_perc_identity(read):
-    total = read.query_alignment_length
-    matches = len(read.get_aligned_pairs(matches_only=True))
-    identity = matches/total
-    return(identity)
+    return get_clip_profile(read).perc_identity
 
 def get_bam_contig_dict(bam_file):
     contig_dict = {}
@@ -2,8 +2,11 @@ import warnings
 warnings.filterwarnings("ignore")
 import sys
 import click
-from mustache import pysamtools, sctools
-from mustache.findflanks import SoftclipParser, SoftclipSite
+from mustache import pysamtools, sctools, misc
+from mustache.findflanks import SoftclipParser, SoftclipSite, get_read_name_key
+from multiprocessing import Pool
+from collections import OrderedDict, deque
+from os.path import basename
 import pandas as pd
 import pysam
 import pygogo as gogo
@@ -16,7 +19,7 @@ def _recall(pairsfile, bamfile, min_alignment_quality, min_alignment_inner_lengt
     pairs = pd.read_csv(pairsfile, sep='\t')
     bam = pysam.AlignmentFile(bamfile)
 
-    recaller = Recaller(bam, pairs)
+    recaller = Recaller(bam, pairs, min_alignment_quality, min_alignment_inner_length)
 
     recaller.parse_clipped_and_unclipped_read_info()
     recall_out = recaller.make_dataframe()
@@ -28,79 +31,198 @@ def _recall(pairsfile, bamfile, min_alignment_quality, min_alignment_inner_lengt
     return recall_out
 
 
+def _recall_cohort(pairsfile, bamfiles, bam_manifest, min_alignment_quality, min_alignment_inner_length, threads,
+                   output_format, output_file):
+    pairs = pd.read_csv(pairsfile, sep='\t')
+    samples = [(get_sample_name(bamfile), bamfile) for bamfile in bamfiles]
+    if bam_manifest:
+        samples += read_bam_manifest(bam_manifest)
+
+    if len(samples) == 0:
+        logger.info("No BAM files were given, exiting...")
+        sys.exit()
+    if len(set(sample for sample, bamfile in samples)) < len(samples):
+        raise click.BadParameter("Sample names must be unique.")
+
+    sites = get_recall_sites(pairs)
+    logger.info("Recalling %d sites in %d BAM files using %d processes..." % (len(sites), len(samples), threads))
+
+    sample_args = [(sample, bamfile, sites, min_alignment_quality, min_alignment_inner_length)
+                   for sample, bamfile in samples]
+
+    sample_dfs = []
+    with Pool(processes=min(threads, len(samples))) as pool:
+        for sample, sample_df in pool.imap_unordered(recall_sample, sample_args):
+            sample_dfs.append((sample, sample_df))
+            logger.info("Recalled sites in sample %s (%d of %d)..." % (sample, len(sample_dfs), len(samples)))
+
+    # Samples finish in any order, but are written in the order they were given.
+    sample_order = {sample: i for i, (sample, bamfile) in enumerate(samples)}
+    sample_dfs.sort(key=lambda sample_result: sample_order[sample_result[0]])
+
+    recall_out = make_cohort_dataframe(sample_dfs, output_format)
+
+    if output_file:
+        logger.info("Saving results to file %s" % output_file)
+        recall_out.to_csv(output_file, sep='\t', index=False)
+
+    return recall_out
+
+
+def recall_sample(sample_args):
+
+    sample, bamfile, sites, min_alignment_quality, min_alignment_inner_length = sample_args
+
+    bam = pysam.AlignmentFile(bamfile)
+    recaller = Recaller(bam, min_alignment_quality=min_alignment_quality,
+                        min_alignment_inner_length=min_alignment_inner_length, sites=sites, verbose=False)
+    recaller.parse_clipped_and_unclipped_read_info()
+    bam.close()
+
+    return sample, recaller.make_dataframe()
+
+
+def make_cohort_dataframe(sample_dfs, output_format='long'):
+    """
+    Combines the recall results of each sample. The long format stacks them with a leading sample column. The wide
+    format has one row per site, and one column per sample and count, named SAMPLE_COUNT. Every sample is recalled
+    at the same sites, so the rows of each sample line up.
+    """
+
+    if output_format == 'long':
+        long_dfs = []
+        for sample, sample_df in sample_dfs:
+            sample_df.insert(0, 'sample', sample)
+            long_dfs.append(sample_df)
+        return pd.concat(long_dfs).reset_index(drop=True)
+
+    wide_dfs = [sample_dfs[0][1].loc[:, ['contig', 'pos']]]
+    for sample, sample_df in sample_dfs:
+        counts = sample_df.drop(['contig', 'pos'], axis=1)
+        counts.columns = [sample + '_' + column for column in counts.columns]
+        wide_dfs.append(counts)
+    return pd.concat(wide_dfs, axis=1)
+
+
+def read_bam_manifest(bam_manifest):
+    """
+    Reads a manifest of BAM files, one per line, either as a path alone or as a sample name and a path separated by a
+    tab. Samples without a name are named after their BAM file. Blank lines and lines starting with # are skipped.
+    """
+
+    samples = []
+    with open(bam_manifest) as infile:
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0].strip() == '' or fields[0].startswith('#'):
+                continue
+            if len(fields) == 1:
+                samples.append((get_sample_name(fields[0]), fields[0]))
+            else:
+                samples.append((fields[0], fields[1]))
+    return samples
+
+
+def get_sample_name(bamfile):
+    sample = basename(bamfile)
+    if sample.endswith('.bam'):
+        sample = sample[:-len('.bam')]
+    return sample
+
+
+def get_recall_sites(pairs_dataframe):
+    """Returns the distinct (contig, pos) sites of the pairs, with the 5p site of each pair before its 3p site."""
+
+    sites = OrderedDict()
+    for contig, pos_5p, pos_3p in zip(pairs_dataframe['contig'], pairs_dataframe['pos_5p'],
+                                      pairs_dataframe['pos_3p']):
+        sites[(contig, int(pos_5p))] = None
+        sites[(contig, int(pos_3p))] = None
+    return list(sites)
+
+
 class Recaller(SoftclipParser):
 
     pairs_dataframe = None
+    sites = None
 
-    def __init__(self, bam, pairs_dataframe):
-        SoftclipParser.__init__(self, bam)
+    def __init__(self, bam, pairs_dataframe=None, min_alignment_quality=20, min_alignment_inner_length=21, sites=None,
+                 verbose=True):
+        SoftclipParser.__init__(self, bam, verbose=verbose, min_alignment_quality=min_alignment_quality,
+                                min_alignment_inner_length=min_alignment_inner_length)
 
         self.pairs_dataframe = pairs_dataframe
+        self.sites = sites if sites is not None else get_recall_sites(pairs_dataframe)
         self.load_pairs()
 
     def load_pairs(self):
-        for index, row in self.pairs_dataframe.iterrows():
-            self.softclipped_sites[row['contig']][row['pos_5p']] = SoftclipSite()
-            self.softclipped_sites[row['contig']][row['pos_3p']] = SoftclipSite()
+        for contig, pos in self.sites:
+            self.softclipped_sites[contig][pos] = SoftclipSite()
 
-    def parse_clipped_and_unclipped_read_info(self):
-        if verbose:
+    def parse_clipped_and_unclipped_read_info(self, merge_distance=500):
+        """
+        Collects the clipped and unclipped reads at every site in one sweep over the BAM file. Sites up to about
+        merge_distance bases apart are fetched together as one span, so every read is decoded and filtered once, and is
+        then counted at each site it touches.
+        """
+
+        if self.verbose:
             logger.info("Getting clipped and unclipped read information near softclipped sites...")
             pass
 
+        margin = merge_distance // 2
+        windows = []
         for contig in self.softclipped_sites:
             for pos in self.softclipped_sites[contig]:
+                windows.append((contig, pos - 1 - margin, pos + 2 + margin, pos))
 
-                reads_at_site = self.get_reads_at_site(contig, pos)
-
-                softclipped_5p_reads, softclipped_3p_reads = self.get_clipped_read_info_at_site(contig, pos, reads_at_site)
-
-                runthrough_reads, insertion_5p_reads, insertion_3p_reads, deletion_reads = \
-                    self.get_unclipped_read_info_at_site(contig, pos, reads_at_site)
-
-                self.softclipped_sites[contig][pos].add_softclip_5p_reads(softclipped_5p_reads)
-                self.softclipped_sites[contig][pos].add_softclip_3p_reads(softclipped_3p_reads)
+        for contig, span_windows in misc.group_overlapping_windows(windows):
+            span_sites = [windows[w][3] for w in span_windows]
+            start = max(min(span_sites) - 1, 0)
+            end = min(max(span_sites) + 2, self.contig_lengths[contig])
+            if end > start:
+                self.parse_reads_in_span(contig, start, end, span_sites)
 
-                self.softclipped_sites[contig][pos].add_runthrough_reads(runthrough_reads)
-                self.softclipped_sites[contig][pos].add_insertion_5p_reads(insertion_5p_reads)
-                self.softclipped_sites[contig][pos].add_insertion_3p_reads(insertion_3p_reads)
-                self.softclipped_sites[contig][pos].add_deletion_reads(deletion_reads)
+    def parse_reads_in_span(self, contig, start, end, span_sites):
+        """
+        Adds the reads in contig:start-end to the span_sites they are clipped at, and resolves the unclipped reads at
+        each site with the same sliding window of reads that findflanks uses in one-pass mode.
+        """
 
-                upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = None, None, None, None
-                downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads= None, None, None, None
+        contig_sites = self.softclipped_sites[contig]
+        site_set = set(span_sites)
 
+        # A sorted list is already a heap.
+        pending_sites = sorted(site_set)
+        pending_site_set = set(site_set)
+        window_reads = deque()
 
-                if pos - 1 >= 0:
-                    upstream_runthrough_reads, upstream_insertion_5p_reads, upstream_insertion_3p_reads, upstream_deletion_reads = \
-                        self.get_unclipped_read_info_at_site(contig, pos - 1, reads_at_site)
+        for read in self.bam.fetch(contig, start, end):
 
-                if pos + 1 < self.contig_lengths[contig]:
-                    downstream_runthrough_reads, downstream_insertion_5p_reads, downstream_insertion_3p_reads, downstream_deletion_reads = \
-                        self.get_unclipped_read_info_at_site(contig, pos + 1, reads_at_site)
+            self.resolve_window_sites(contig, pending_sites, pending_site_set, window_reads,
+                                      max_pos=read.reference_start - 2)
 
-                if upstream_deletion_reads:
-                    self.softclipped_sites[contig][pos].add_upstream_deletion_reads(upstream_deletion_reads)
+            profile = sctools.get_clip_profile(read)
 
-                if downstream_deletion_reads:
-                    self.softclipped_sites[contig][pos].add_downstream_deletion_reads(downstream_deletion_reads)
-
-    def get_clipped_read_info_at_site(self, contig, pos, reads):
-
-        softclipped_5p_reads = set()
-        softclipped_3p_reads = set()
+            if not self.passes_read_filters(read, profile):
+                continue
 
-        for read in reads:
+            right_site, left_site = None, None
 
-            if not self.passes_read_filters(read):
-                continue
+            if sctools.is_right_softclipped_lenient(read, profile):
+                right_site = profile.right_site
+                if right_site in site_set:
+                    contig_sites[right_site].add_softclip_5p(read, False, profile)
 
-            if sctools.is_left_softclipped_lenient_at_site(read, contig, pos):
-                softclipped_3p_reads.add(read)
+            if sctools.is_left_softclipped_lenient(read, profile):
+                left_site = profile.left_site
+                if left_site in site_set:
+                    contig_sites[left_site].add_softclip_3p(read, False, profile)
 
-            if sctools.is_right_softclipped_lenient_at_site(read, contig, pos):
-                softclipped_5p_reads.add(read)
+            window_reads.append((read.reference_start, read.reference_end, get_read_name_key(read.query_name),
+                                 read.get_blocks(), right_site, left_site))
 
-        return softclipped_5p_reads, softclipped_3p_reads
+        self.resolve_window_sites(contig, pending_sites, pending_site_set, window_reads)
 
     def make_dataframe(self):
 
@@ -0,0 +1,102 @@
+import warnings
+warnings.filterwarnings("ignore")
+import pysam
+from collections import OrderedDict
+
+
+class ReferenceStore:
+    """
+    Read-only access to the contigs of a FASTA file through its .fai index, which is built next to the FASTA if it is
+    missing. Nothing is loaded up front: sequence is decoded in fixed windows as it is asked for, and the most recently
+    used windows are kept in an LRU cache, so nearby lookups do not touch the file again.
+
+    store[contig] returns a ReferenceSequence, which supports len() and slicing like the {rec.id: rec.seq} dicts it
+    replaces, but returns plain strings.
+    """
+
+    def __init__(self, fasta, window_size=65536, max_windows=256):
+        self.fasta = fasta
+        self.fasta_file = pysam.FastaFile(fasta)
+        self.lengths = dict(zip(self.fasta_file.references, self.fasta_file.lengths))
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self.windows = OrderedDict()
+
+    def __getitem__(self, contig):
+        if contig not in self.lengths:
+            raise KeyError(contig)
+        return ReferenceSequence(self, contig)
+
+    def __contains__(self, contig):
+        return contig in self.lengths
+
+    def __iter__(self):
+        return iter(self.fasta_file.references)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def contig_length(self, contig):
+        return self.lengths[contig]
+
+    def fetch(self, contig, start, end):
+        """Returns the sequence of contig:start-end, for 0 <= start <= end <= the length of the contig."""
+
+        if end <= start:
+            return ''
+
+        first_window, last_window = start // self.window_size, (end - 1) // self.window_size
+        if last_window - first_window >= self.max_windows:
+            return self.fasta_file.fetch(contig, start, end)
+
+        sequence = ''.join(self.get_window(contig, w) for w in range(first_window, last_window + 1))
+        offset = first_window * self.window_size
+        return sequence[start - offset:end - offset]
+
+    def get_window(self, contig, window):
+        key = (contig, window)
+        if key in self.windows:
+            self.windows.move_to_end(key)
+            return self.windows[key]
+
+        window_start = window * self.window_size
+        sequence = self.fasta_file.fetch(contig, window_start, min(window_start + self.window_size,
+                                                                   self.lengths[contig]))
+        self.windows[key] = sequence
+        if len(self.windows) > self.max_windows:
+            self.windows.popitem(last=False)
+        return sequence
+
+    def close(self):
+        self.windows.clear()
+        self.fasta_file.close()
+
+
+class ReferenceSequence:
+    """A view of one contig in a ReferenceStore, sliced with the usual Python semantics."""
+
+    __slots__ = ('store', 'contig')
+
+    def __init__(self, store, contig):
+        self.store = store
+        self.contig = contig
+
+    def __len__(self):
+        return self.store.contig_length(self.contig)
+
+    def __getitem__(self, index):
+        length = len(self)
+        if isinstance(index, slice):
+            start, end, step = index.indices(length)
+            if step != 1:
+                return self.store.fetch(self.contig, 0, length)[index]
+            return self.store.fetch(self.contig, start, max(start, end))
+
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('reference index out of range')
+        return self.store.fetch(self.contig, index, index + 1)
+
+    def __str__(self):
+        return self.store.fetch(self.contig, 0, len(self))
@@ -2,15 +2,16 @@ import warnings
 warnings.filterwarnings("ignore")
 import sys
 from glob import glob
-from snakemake import shell
+import os
 import pygogo as gogo
 from os.path import isfile
+from mustache import processtools
 
 def remove_secondary_alignments(in_bam, out_bam, delete_in_bam=False):
-    shell('samtools view -b -h -F 0x900 {in_bam} > {out_bam}'.format(in_bam=in_bam, out_bam=out_bam))
+    processtools.run_command(['samtools', 'view', '-b', '-h', '-F', '0x900', in_bam], stdout=out_bam)
 
     if delete_in_bam:
-        shell('rm {in_bam}'.format(in_bam=in_bam))
+        os.remove(in_bam)
 
     if isfile(out_bam):
         return True
@@ -19,10 +20,10 @@ def remove_secondary_alignments(in_bam, out_bam, delete_in_bam=False):
 
 
 def sort_coordinate(in_bam, out_bam, delete_in_bam=False):
-    shell('samtools sort {in_bam} > {out_bam}'.format(in_bam=in_bam, out_bam=out_bam))
+    processtools.run_command(['samtools', 'sort', '-O', 'bam', '-o', out_bam, in_bam])
 
     if delete_in_bam:
-        shell('rm {in_bam}'.format(in_bam=in_bam))
+        os.remove(in_bam)
 
     if isfile(out_bam):
         return True
@@ -30,7 +31,7 @@ def sort_coordinate(in_bam, out_bam, delete_in_bam=False):
         return False
 
 def index(in_bam):
-    shell('samtools index {in_bam}'.format(in_bam=in_bam))
+    processtools.run_command(['samtools', 'index', in_bam])
 
     if isfile(in_bam+'.bai'):
         return True
@@ -1,6 +1,112 @@
 import warnings
 warnings.filterwarnings("ignore")
 import sys
+from collections import namedtuple
+import pygogo as gogo
+
+logger = gogo.Gogo(__name__, verbose=False).logger
+
+CLIP_NONE = 0
+CLIP_SOFTCLIP = 1
+CLIP_MISMATCH = 2
+
+ClipProfile = namedtuple('ClipProfile', ['left_clip_type', 'left_clip_length', 'left_site',
+                                         'right_clip_type', 'right_clip_length', 'right_site',
+                                         'inner_length', 'perc_identity'])
+
+
+def make_clip_profile(cigartuples, md, reference_start, query_sequence):
+    """
+    Computes the lenient softclip profile of a read in a single pass over its CIGAR and MD tag. A read end counts as
+    clipped if it is softclipped, or if its terminal aligned base is a mismatch. Returns a tuple with the clip type,
+    clip length and clipped site of each end, the aligned length between the clips and the percent identity.
+    Pure-Python fallback for mustache._clipprofile.
+    """
+
+    query_length = 0
+    ref_pos = reference_start
+    aligned_length = 0
+    softclipped_length = 0
+    first_aligned_query, first_aligned_ref = -1, -1
+    last_aligned_query, last_aligned_ref = -1, -1
+
+    for op, length in cigartuples:
+        if op == 0 or op == 7 or op == 8:
+            if first_aligned_ref < 0:
+                first_aligned_query, first_aligned_ref = query_length, ref_pos
+            query_length += length
+            ref_pos += length
+            aligned_length += length
+            last_aligned_query, last_aligned_ref = query_length - 1, ref_pos - 1
+        elif op == 1:
+            query_length += length
+        elif op == 4:
+            query_length += length
+            softclipped_length += length
+        elif op == 2 or op == 3:
+            ref_pos += length
+
+    left_op, left_cigar_length = cigartuples[0]
+    right_op, right_cigar_length = cigartuples[-1]
+
+    left_clip_type, left_clip_length, left_site = CLIP_NONE, 0, None
+    if left_op == 4:
+        left_clip_type, left_clip_length, left_site = CLIP_SOFTCLIP, left_cigar_length, first_aligned_ref - 1
+    else:
+        md_starts_with_zero = md[:1] == '0'
+        if md_starts_with_zero:
+            left_clip_type, left_clip_length = CLIP_MISMATCH, 1
+        if (md_starts_with_zero and md[1:2].isalpha()) or \
+                (query_sequence and query_sequence[0] != query_sequence[first_aligned_query]):
+            left_site = first_aligned_ref
+
+    right_clip_type, right_clip_length, right_site = CLIP_NONE, 0, None
+    if right_op == 4:
+        right_clip_type, right_clip_length, right_site = CLIP_SOFTCLIP, right_cigar_length, last_aligned_ref + 1
+    else:
+        md_ends_with_zero = md[-1:] == '0'
+        if md_ends_with_zero and len(md) > 1 and not md[-2].isdigit():
+            right_clip_type, right_clip_length = CLIP_MISMATCH, 1
+        if (md_ends_with_zero and md_ends_with_mismatch(md)) or \
+                (query_sequence and query_sequence[-1] != query_sequence[last_aligned_query]):
+            right_site = last_aligned_ref
+
+    inner_length = query_length - left_clip_length - right_clip_length
+
+    alignment_length = query_length - softclipped_length
+    perc_identity = aligned_length / alignment_length if alignment_length > 0 else 0.0
+
+    return (left_clip_type, left_clip_length, left_site,
+            right_clip_type, right_clip_length, right_site,
+            inner_length, perc_identity)
+
+
+def md_ends_with_mismatch(md):
+    # A trailing zero after a run of letters marks a mismatch, unless the letters are a deletion (^ACG).
+    i = len(md) - 2
+    while i >= 0 and md[i].isalpha():
+        i -= 1
+    return i < len(md) - 2 and (i < 0 or md[i] != '^')
+
+
+try:
+    from mustache._clipprofile import make_clip_profile
+except ImportError:
+    logger.warning("The compiled mustache._clipprofile module could not be imported, using the slower pure-Python "
+                   "clip profile. Install cython and reinstall mustache to build it.")
+
+
+def get_clip_profile(read):
+    # Unmapped reads have no CIGAR to build a clip profile from.
+    if read.reference_end is None:
+        return None
+    try:
+        md = read.get_tag('MD')
+    except KeyError:
+        md = ''
+    query_sequence = read.query_sequence or ''
+    return ClipProfile(*make_clip_profile(read.cigartuples, md, read.reference_start, query_sequence))
+
 
 def left_softclip_length(read):
     return read.cigartuples[0][1]
@@ -14,42 +120,42 @@ def left_softclipped_position(read):
 def right_softclipped_position(read):
     return read.get_reference_positions()[-1] + 1
 
-def is_right_softclipped_lenient(read):
-    if read.cigartuples[-1][0] == 4:
-        return True
-    elif read.get_tag('MD')[-1] == '0' and not read.get_tag('MD')[-2].isdigit():
-        return True
-    else:
-        return False
+def is_right_softclipped_lenient(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    return profile.right_clip_type != CLIP_NONE
 
-def is_left_softclipped_lenient(read):
-    if read.cigartuples[0][0] == 4:
-        return True
-    elif read.get_tag('MD')[0] == '0':
-        return True
-    else:
-        return False
+def is_left_softclipped_lenient(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    return profile.left_clip_type != CLIP_NONE
 
-def is_left_softclipped_lenient_at_site(read, contig, pos):
-    if not is_left_softclipped_lenient(read):
+def is_left_softclipped_lenient_at_site(read, contig, pos, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if not is_left_softclipped_lenient(read, profile):
         return False
-    if left_softclipped_site_lenient(read) == (contig, pos):
+    if left_softclipped_site_lenient(read, profile) == (contig, pos):
         return True
     else:
         return False
 
-def is_right_softclipped_lenient_at_site(read, contig, pos):
-    if not is_right_softclipped_lenient(read):
+def is_right_softclipped_lenient_at_site(read, contig, pos, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if not is_right_softclipped_lenient(read, profile):
         return False
-    if right_softclipped_site_lenient(read) == (contig, pos):
+    if right_softclipped_site_lenient(read, profile) == (contig, pos):
         return True
     else:
         return False
 
-def is_softclipped_lenient_at_site(read, contig, pos):
-    if is_right_softclipped_lenient_at_site(read, contig, pos):
+def is_softclipped_lenient_at_site(read, contig, pos, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if is_right_softclipped_lenient_at_site(read, contig, pos, profile):
         return True
-    elif is_left_softclipped_lenient_at_site(read, contig, pos):
+    elif is_left_softclipped_lenient_at_site(read, contig, pos, profile):
         return True
     else:
         return False
@@ -66,14 +172,10 @@ def is_right_softclipped_strict(read):
     else:
         return False
 
-def get_right_softclip_length(read):
-    if is_right_softclipped_lenient(read):
-        if read.cigartuples[-1][0] == 4:
-            return read.cigartuples[-1][1]
-        else:
-            return 1
-    else:
-        return 0
+def get_right_softclip_length(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    return profile.right_clip_length
 
 def get_right_softclip_length_strict(read):
     if is_right_softclipped_strict(read):
@@ -81,14 +183,10 @@ def get_right_softclip_length_strict(read):
     else:
         return 0
 
-def get_left_softclip_length(read):
-    if is_left_softclipped_lenient(read):
-        if read.cigartuples[0][0] == 4:
-            return read.cigartuples[0][1]
-        else:
-            return 1
-    else:
-        return 0
+def get_left_softclip_length(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    return profile.left_clip_length
 
 def get_left_softclip_length_strict(read):
     if is_left_softclipped_strict(read):
@@ -96,24 +194,23 @@ def get_left_softclip_length_strict(read):
     else:
         return 0
 
-def right_softclipped_site_lenient(read):
-    if read.cigartuples[-1][0] == 4:
-        return read.reference_name, read.get_reference_positions()[-1] + 1
-    elif read.query_sequence[-1] != read.get_reference_sequence()[-1]:
-        return read.reference_name, read.get_reference_positions()[-1]
-
-def left_softclipped_site_lenient(read):
-    if read.cigartuples[0][0] == 4:
-        return read.reference_name, read.get_reference_positions()[0] - 1
-    elif read.query_sequence[0] != read.get_reference_sequence()[0]:
-        return read.reference_name, read.get_reference_positions()[0]
-
-def right_softclipped_sequence(read):
-    if is_right_softclipped_lenient(read):
-        if read.cigartuples[-1][0] == 4:
-            return read.query_sequence[-read.cigartuples[-1][1]:]
-        else:
-            return read.query_sequence[-1]
+def right_softclipped_site_lenient(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.right_site is not None:
+        return read.reference_name, profile.right_site
+
+def left_softclipped_site_lenient(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.left_site is not None:
+        return read.reference_name, profile.left_site
+
+def right_softclipped_sequence(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.right_clip_length > 0:
+        return read.query_sequence[-profile.right_clip_length:]
     else:
         return ''
 
@@ -123,21 +220,19 @@ def right_softclipped_sequence_strict(read):
     else:
         return ''
 
-def right_softclip_qualities(read):
-    if is_right_softclipped_lenient(read):
-        if read.cigartuples[-1][0] == 4:
-            return list(read.query_qualities)[-read.cigartuples[-1][1]:]
-        else:
-            return [list(read.query_qualities)[-1]]
+def right_softclip_qualities(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.right_clip_length > 0:
+        return list(read.query_qualities[-profile.right_clip_length:])
     else:
         return []
 
-def left_softclipped_sequence(read):
-    if is_left_softclipped_lenient(read):
-        if read.cigartuples[0][0] == 4:
-            return read.query_sequence[:read.cigartuples[0][1]]
-        else:
-            return read.query_sequence[0]
+def left_softclipped_sequence(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.left_clip_length > 0:
+        return read.query_sequence[:profile.left_clip_length]
     else:
         return ''
 
@@ -147,34 +242,30 @@ def left_softclipped_sequence_strict(read):
     else:
         return ''
 
-def left_softclip_qualities(read):
-    if is_left_softclipped_lenient(read):
-        if read.cigartuples[0][0] == 4:
-            return list(read.query_qualities)[:read.cigartuples[0][1]]
-        else:
-            return [list(read.query_qualities)[0]]
+def left_softclip_qualities(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if profile.left_clip_length > 0:
+        return list(read.query_qualities[:profile.left_clip_length])
     else:
         return []
 
-def is_double_softclipped_lenient(read):
-
-    if is_left_softclipped_lenient(read) and is_right_softclipped_lenient(read):
+def is_double_softclipped_lenient(read, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
+    if is_left_softclipped_lenient(read, profile) and is_right_softclipped_lenient(read, profile):
         return True
     else:
         return False
 
-def read_meets_min_alignment_inner_length(read, min_alignment_inner_length):
+def read_meets_min_alignment_inner_length(read, min_alignment_inner_length, profile=None):
+    if profile is None:
+        profile = get_clip_profile(read)
 
-    if not is_double_softclipped_lenient(read):
+    if not is_double_softclipped_lenient(read, profile):
         return True
 
-    right_length = len(right_softclipped_sequence(read))
-    left_length = len(left_softclipped_sequence(read))
-
-    total_length = len(read.query_sequence)
-    aligned_length = total_length - right_length - left_length
-
-    if aligned_length >= min_alignment_inner_length:
+    if profile.inner_length >= min_alignment_inner_length:
         return True
     else:
         return False
@@ -1,4 +1,12 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+
+# The compiled kernels are optional, mustache.sctools and mustache.misc fall back to pure Python without them.
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([Extension('mustache._clipprofile', ['mustache/_clipprofile.pyx']),
+                             Extension('mustache._editdistance', ['mustache/_editdistance.pyx'])])
+except ImportError:
+    ext_modules = []
 
 setup(
     name="mustache",
@@ -9,6 +17,7 @@ setup(
     author_email="mdurrant@stanford.edu",
     license="MIT",
     packages=find_packages(),
+    ext_modules=ext_modules,
     include_package_data=True,
     install_requires=[
         'click',